@@ -1,6 +1,15 @@
+import hashlib
 import logging
 import os
+import zipfile
+import numpy as np
 import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+try:
+    import pyarrow  # Parquet cache of parsed extracts; without it nothing is cached
+except ImportError:
+    pyarrow = None
 
 # LOGGING
 logging.basicConfig(
@@ -27,6 +36,10 @@ expected_cols = [
     'DX Code', 
     'Diagnosis Code Description']
 
+cache_dirname = '.bhtd_cache'  # parsed extracts are cached here, next to the workbook
+hash_block_size = 1024 * 1024
+cache_version = 1  # part of every cache file name; bump when the cached frame changes
+
 lookback_months = 6   # number of months to establish new episode
 lookforward_days = 90  # number of days in follow-up period
 required_follow_up = 3  # number of visits required in follow-up period
@@ -74,21 +87,62 @@ active_duty = ['USA ACTIVE DUTY OFFICER','USA ACTIVE DUTY ENLISTED',
 # ======================================================================
 
 # Excel validation functions
+#   The workbook is opened in read-only (streaming) mode and only the sheet names
+#   and the header row are read, so validating a large extract takes milliseconds
 def validate_raw_data(file):
-    if is_xlsx(file):
-        return has_worksheet(file) and has_columns(file)
-    else:
-        return False
+    return not get_schema_problems(file)
 
 def is_xlsx(file):
     return (os.path.splitext(file)[1] == '.xlsx')
 
+def read_schema(file):
+    # Returns (sheet names, header row of the data worksheet or None if it's missing)
+    workbook = load_workbook(file, read_only=True)
+    try:
+        header = None
+        if data_worksheet in workbook.sheetnames:
+            worksheet = workbook[data_worksheet]
+            worksheet.reset_dimensions() # some exporters write a stale <dimension> (e.g. A1); read the whole row
+            rows = worksheet.iter_rows(min_row=1, max_row=1, values_only=True)
+            header = list(next(rows, ()))
+            while header and header[-1] is None: # trailing empty cells
+                header.pop()
+        return workbook.sheetnames, header
+    finally:
+        workbook.close()
+
+def get_schema_problems(file):
+    # Every reason the file isn't a usable PI-EDW extract ([] if it is)
+    if not is_xlsx(file):
+        return [f'Expected an *.xlsx file, got \'{os.path.splitext(file)[1]}\'']
+    try:
+        sheet_names, header = read_schema(file)
+    except (OSError, zipfile.BadZipFile, InvalidFileException, KeyError) as ex:
+        return [f'Unable to read workbook ({type(ex).__name__})']
+
+    if header is None:
+        return [f'Missing worksheet \'{data_worksheet}\' (found: {", ".join(sheet_names)})']
+
+    problems = []
+    actual_cols = [str(col) if col is not None else '' for col in header]
+    missing = [col for col in expected_cols if col not in actual_cols]
+    unexpected = [col for col in actual_cols if col not in expected_cols]
+    if missing:
+        problems.append(f'Missing columns: {missing}')
+    if unexpected:
+        problems.append(f'Unexpected columns: {unexpected}')
+    duplicated = sorted({col for col in actual_cols if actual_cols.count(col) > 1})
+    if duplicated:
+        problems.append(f'Duplicated columns: {duplicated}')
+    if not problems and actual_cols != expected_cols:
+        problems.append(f'Columns out of order; expected {expected_cols}')
+    return problems
+
 def has_worksheet(file):
-    return (data_worksheet in pd.ExcelFile(file).sheet_names)
+    return (data_worksheet in read_schema(file)[0])
 
 def has_columns(file):
-    actual_cols = pd.read_excel(file, sheet_name=data_worksheet).columns.tolist()
-    return (actual_cols == expected_cols)
+    return (read_schema(file)[1] == expected_cols)
 
 
 # Loads the PI-EDW raw data into a dataframe
@@ -97,6 +151,74 @@ def load_raw_data(xlsx_file):
     return df
 
 
+# One-time ingest: the header is checked from the first row before the sheet is
+# parsed, and the parsed data is cached by file hash as Parquet (when pyarrow is
+# installed; there is no cache otherwise), so later loads of the same extract skip
+# Excel parsing entirely. Both apps load through ingest_raw_data, so every cache
+# entry holds the same frame; bump cache_version when read_workbook changes it.
+def hash_file(file):
+    digest = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(hash_block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_cache_path(xlsx_file, file_hash):
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(xlsx_file)), cache_dirname)
+    return os.path.join(cache_dir, f'{file_hash}-v{cache_version}.parquet')
+
+def read_cached_data(xlsx_file, file_hash):
+    cache_path = get_cache_path(xlsx_file, file_hash)
+    if pyarrow is None or not os.path.exists(cache_path):
+        return None
+    try:
+        df = pd.read_parquet(cache_path)
+    except Exception as ex: # unreadable cache file; parse the workbook again
+        log.error(f'Unable to read cached data ({type(ex).__name__})')
+        return None
+    if df.columns.tolist() != expected_cols:
+        log.error('Cached data does not match the expected columns; ignoring it')
+        return None
+    return df
+
+def write_cached_data(xlsx_file, file_hash, df):
+    if pyarrow is None:
+        log.info('pyarrow is not installed; parsed data is not cached')
+        return
+    cache_path = get_cache_path(xlsx_file, file_hash)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        df.to_parquet(cache_path, index=False)
+    except (OSError, TypeError, ValueError) as ex: # read-only share, or mixed-type columns Parquet can't hold
+        log.error(f'Unable to cache parsed data ({type(ex).__name__})')
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+def read_workbook(xlsx_file):
+    # Parses the data worksheet; ingest_raw_data has already checked the header
+    df = pd.read_excel(xlsx_file, sheet_name=data_worksheet)
+    df['Date of DX'] = pd.to_datetime(df['Date of DX'])
+    return df
+
+def ingest_raw_data(xlsx_file):
+    # Returns (raw data, []) for a valid extract, from the cache when possible, or
+    # (None, problems) if it isn't one; the header is checked once, before parsing
+    problems = get_schema_problems(xlsx_file)
+    if problems:
+        for problem in problems:
+            log.error(problem)
+        return None, problems
+    file_hash = hash_file(xlsx_file)
+    df = read_cached_data(xlsx_file, file_hash)
+    if df is not None:
+        log.info(f'Loaded cached data for {os.path.basename(xlsx_file)}')
+        return df, []
+
+    df = read_workbook(xlsx_file)
+    write_cached_data(xlsx_file, file_hash, df)
+    return df, []
+
+
 # Return the date range in a dataframe column (as pd.Timestamp)
 def get_date_range(df, col):
     min = df[col].min()
@@ -219,27 +341,69 @@ def get_dmis(location):
 def get_clinic(location):
     return location.split('-', 1)[1]
 
-def get_lookback_count(row, raw_df):
-    patient = row['EDIPI']
-    category = row['DX Category']
-    index_date = row['Date of DX']
-    lookback_date = row['Lookback Date']
-    filter = (raw_df['EDIPI'] == patient) & \
-        (raw_df['DX Category'] == category) & \
-        (raw_df['Date of DX'] < index_date) & \
-        (raw_df['Date of DX'] >= lookback_date)
-    return len(raw_df[filter])
-
-def get_lookforward_count(row, raw_df):
-    patient = row['EDIPI']
-    category = row['DX Category']
-    index_date = row['Date of DX']
-    lookforward_date = get_lookforward_date(index_date)
-    filter = (raw_df['EDIPI'] == patient) & \
-        (raw_df['DX Category'] == category) & \
-        (raw_df['Date of DX'] > index_date) & \
-        (raw_df['Date of DX'] <= lookforward_date)
-    return len(raw_df[filter])
+# Derived columns: each function above runs once per distinct value, not per row
+def add_derived_columns(raw_df):
+    def map_distinct(col, func):
+        values = raw_df[col].unique()
+        return raw_df[col].map(dict(zip(values, map(func, values))))
+
+    location = 'Person Location- Nurse Unit / Ambulatory (Admit) Display'
+    raw_df['DX Category'] = map_distinct('DX Code', categorize_dx)
+    raw_df['Active Duty'] = map_distinct('Codified Value', is_active_duty).astype(bool)
+    raw_df['DMIS'] = map_distinct(location, get_dmis)
+    raw_df['Clinic'] = map_distinct(location, get_clinic)
+    return raw_df
+
+# Window counts: for each candidate, the number of raw encounters with the same
+# patient and DX category whose date falls in a window around the index visit.
+# The encounters are sorted once by (patient/category, date) into an encounter
+# index; each window is then two binary searches instead of a full scan of the raw
+# data per candidate, and one index serves every observation month.
+def build_encounter_index(raw_df):
+    keys = ['EDIPI', 'DX Category']
+    encounters = raw_df[raw_df['EDIPI'].notna() & raw_df['Date of DX'].notna()]
+
+    # number the patient/category pairs and rank the encounter dates, so that
+    # (pair, date) fits in one sortable integer
+    pairs = pd.MultiIndex.from_frame(encounters[keys]).unique()
+    pair_codes = pairs.get_indexer(pd.MultiIndex.from_frame(encounters[keys])).astype(np.int64)
+    dates = encounters['Date of DX'].to_numpy(dtype='datetime64[ns]')
+    unique_dates, date_ranks = np.unique(dates, return_inverse=True)
+    span = len(unique_dates) + 1
+    return {
+        'pairs': pairs,
+        'dates': unique_dates,
+        'span': span,
+        'keys': np.sort(pair_codes * span + date_ranks.astype(np.int64)),
+    }
+
+def get_window_counts(candidates, encounter_index, window_start, window_end, include_start, include_end):
+    keys = ['EDIPI', 'DX Category']
+    pair_codes = encounter_index['pairs'].get_indexer(pd.MultiIndex.from_frame(candidates[keys])).astype(np.int64)
+
+    # window bounds as ranks among the encounter dates: an encounter is in the
+    # window when start_rank <= its rank < end_rank
+    dates = encounter_index['dates']
+    start_ranks = np.searchsorted(dates, window_start.to_numpy(dtype='datetime64[ns]'), side='left' if include_start else 'right')
+    end_ranks = np.searchsorted(dates, window_end.to_numpy(dtype='datetime64[ns]'), side='right' if include_end else 'left')
+
+    span = encounter_index['span']
+    first = np.searchsorted(encounter_index['keys'], pair_codes * span + start_ranks)
+    last = np.searchsorted(encounter_index['keys'], pair_codes * span + end_ranks)
+    counts = np.where((pair_codes >= 0) & (last > first), last - first, 0)
+    return pd.Series(counts, index=candidates.index)
+
+def get_lookback_counts(candidates, raw_df, encounter_index=None):
+    # visits in [Lookback Date, Date of DX)
+    encounter_index = encounter_index or build_encounter_index(raw_df)
+    return get_window_counts(candidates, encounter_index, candidates['Lookback Date'], candidates['Date of DX'],
+        include_start=True, include_end=False)
+
+def get_lookforward_counts(candidates, raw_df, encounter_index=None):
+    # visits in (Date of DX, Date of DX + lookforward_days]
+    encounter_index = encounter_index or build_encounter_index(raw_df)
+    return get_window_counts(candidates, encounter_index, candidates['Date of DX'], get_lookforward_date(candidates['Date of DX']),
+        include_start=False, include_end=True)
 
 def met_therapy_dosage(num_visits):
     if num_visits >= required_follow_up:
@@ -247,86 +411,65 @@ def met_therapy_dosage(num_visits):
     else:
         return 0
 
+candidate_cols = ['Patient Name, Full',
+                  'EDIPI',
+                  'Date of DX',
+                  'FIN',
+                  'Encounter Type',
+                  'Person Location- Nurse Unit / Ambulatory (Admit) Display',
+                  'DX Code',
+                  'Diagnosis Code Description',
+                  'DX Category',
+                  'Active Duty',
+                  'DMIS',
+                  'Clinic']
+
+def get_first_visits(encounters):
+    # Encounters on the earliest date of their patient-diagnosis group; every encounter
+    # tied on that date is kept. Rows come out in group order (EDIPI, DX Category), then
+    # in their original order, as the per-group loop produced them.
+    earliest = encounters.groupby(['EDIPI', 'DX Category'])['Date of DX'].transform('min')
+    first_visits = encounters[encounters['Date of DX'] == earliest]
+    first_visits = first_visits.sort_values(['EDIPI', 'DX Category'], kind='stable')
+    first_visits = first_visits.rename(columns={'Formatted Financial Nbr': 'FIN'})
+    return first_visits[candidate_cols].reset_index(drop=True)
+
 def get_candidates(raw_df, date):
     log.info(f'Encounters in raw data (total):  {len(raw_df)}')
-    # Set the start and end dates for the observation period
-    cohort_start, cohort_end = set_observation_period(date.month, date.year)
-    
-    # Add the diagnosis category column to the raw data
-    raw_df['DX Category'] = raw_df['DX Code'].apply(categorize_dx)
-
-    # Add the Active Duty column to the raw data
-    raw_df['Active Duty'] = raw_df['Codified Value'].apply(is_active_duty)
-
-    # Add the DMIS (facility) column to the raw data
-    raw_df['DMIS'] = raw_df['Person Location- Nurse Unit / Ambulatory (Admit) Display'].apply(get_dmis)
 
-    # Add the clinic column to the raw data
-    raw_df['Clinic'] = raw_df['Person Location- Nurse Unit / Ambulatory (Admit) Display'].apply(get_clinic)
+    # Add the DX Category, Active Duty, DMIS (facility) and Clinic columns to the raw data
+    add_derived_columns(raw_df)
 
     # Make a new dataframe with just active duty
     active_duty = raw_df[raw_df['Active Duty'] == True]
     log.info(f'Active duty encounters (total):  {len(active_duty)}')
+    return select_candidates(active_duty, date)
+
+def select_candidates(active_duty, date):
+    # Set the start and end dates for the observation period
+    cohort_start, cohort_end = set_observation_period(date.month, date.year)
 
     # Extract possible candidates (i.e., patients in observation window)
     possible_candidates = active_duty[(active_duty['Date of DX'] > cohort_start) & 
         (active_duty['Date of DX'] < cohort_end)]
     log.info(f'Active duty encounters (observation period):  {len(possible_candidates)}')
 
-    # Group by patient and diagnosis category
-    grp_by_pt = possible_candidates.groupby(['EDIPI', 'DX Category'])
-
-    # Create a list of the first encounter for each patient-diagnosis group
-    first_visits = []
-
-    for key, group in grp_by_pt:
-        earliest = group['Date of DX'].min()
-        
-        for idx, row in group.iterrows():
-            if row['Date of DX'] == earliest:
-                name = row['Patient Name, Full']
-                EDIPI = row['EDIPI']
-                date = row['Date of DX']
-                FIN = row['Formatted Financial Nbr']
-                enc_type = row['Encounter Type']
-                facility = row['Person Location- Nurse Unit / Ambulatory (Admit) Display']
-                dx_code = row['DX Code']
-                dx = row['Diagnosis Code Description']
-                dx_category = row['DX Category']
-                active_duty = row['Active Duty']
-                dmis = row['DMIS']
-                clinic = row['Clinic']
-            
-                first_visits.append([name, EDIPI, date, FIN, enc_type, facility, dx_code, dx, dx_category, active_duty, dmis, clinic])
-                
-    # Create a new dataframe with the refined candidate list
-    cols = ['Patient Name, Full',
-            'EDIPI',
-            'Date of DX',
-            'FIN',
-            'Encounter Type',
-            'Person Location- Nurse Unit / Ambulatory (Admit) Display',
-            'DX Code',
-            'Diagnosis Code Description',
-            'DX Category',
-            'Active Duty',
-            'DMIS',
-            'Clinic']
-
     # candidates lists the first encounter for each diagnostic category in the observation period.
-    candidates = pd.DataFrame(columns=cols, data=first_visits)
+    candidates = get_first_visits(possible_candidates)
     log.info(f'First-only active duty encounters (observation period):  {len(candidates)}')
     return candidates
 
 
 def prepare_cohort(raw_df, observation_period):
     candidates = get_candidates(raw_df, observation_period)
+    return complete_cohort(candidates, build_encounter_index(raw_df), observation_period)
 
+def complete_cohort(candidates, encounter_index, observation_period):
     # Add a column showing lookback date to candidates
-    candidates['Lookback Date'] = candidates['Date of DX'].apply(get_lookback_date)
+    candidates['Lookback Date'] = get_lookback_date(candidates['Date of DX'])
 
     # Add a column with number of visits in the lookback period
-    candidates['Lookback Count'] = candidates.apply(lambda row: get_lookback_count(row, raw_df), axis=1)
+    candidates['Lookback Count'] = get_lookback_counts(candidates, None, encounter_index)
 
     # Add a column for whether the case counts as a new episode
     candidates['New Episode'] = candidates['Lookback Count'].apply(lambda x: x == 0)
@@ -339,9 +482,85 @@ def prepare_cohort(raw_df, observation_period):
     log.info(f'Final cohort for {display_date}:  {len(cohort)} eligible encounters')
     
     # Add a column with number of visits in the 90 days after the index visit
-    cohort['Lookforward Count'] = cohort.apply(lambda row: get_lookforward_count(row, raw_df), axis=1)
+    cohort['Lookforward Count'] = get_lookforward_counts(cohort, None, encounter_index)
 
     # Add a column if met therapy dosage (>= 3); success is 1 (for True), failure is 0 (for False)
     cohort['Met Therapy Dosage'] = cohort['Lookforward Count'].apply(met_therapy_dosage)
 
-    return cohort
\ No newline at end of file
+    return cohort
+
+# Reporting functions
+dx_categories = ['PTSD', 'anxiety', 'depression']
+
+def get_report_by_site(cohort):
+    df = cohort.groupby(['DMIS', 'Clinic', 'DX Category']).agg({'Met Therapy Dosage':['sum', 'count']})
+    df.columns = ['Met Therapy Goal','Cases']
+    df['Met Therapy Goal'] = df['Met Therapy Goal'].astype(int)
+    df['Percent'] = df['Met Therapy Goal']/df['Cases']
+    return df
+
+def get_pivot_by_site(cohort):
+    df = get_report_by_site(cohort)
+
+    table = pd.pivot_table(df, values=['Cases', 'Met Therapy Goal'], index=['DMIS', 'Clinic'], columns=['DX Category'], aggfunc='sum', fill_value=0)
+
+    # a month without cases in a category still gets its columns
+    for category in dx_categories:
+        for col in ['Cases', 'Met Therapy Goal']:
+            if (col, category) not in table:
+                table[(col, category)] = 0
+    for category in dx_categories:
+        table[('Metric', category)] = table[('Met Therapy Goal', category)] / table[('Cases', category)]
+    table = table.fillna(0)
+    return table
+
+
+# Batch mode: cohorts and site reports for a range of observation months in one
+# pass. The derived columns and the encounter index are computed once, and the
+# active-duty encounters are sorted by date once so each month's observation
+# window is a slice rather than a filter over the whole frame.
+def get_observation_months(start, end):
+    # First day of every month from start through end
+    return list(pd.date_range(pd.Timestamp(start.year, start.month, 1), end, freq='MS'))
+
+def prepare_cohorts(raw_df, observation_periods):
+    add_derived_columns(raw_df)
+    encounter_index = build_encounter_index(raw_df)
+
+    active_duty = raw_df[(raw_df['Active Duty'] == True) & raw_df['Date of DX'].notna()]
+    active_duty = active_duty.sort_values('Date of DX', kind='stable')
+    log.info(f'Active duty encounters (total):  {len(active_duty)}')
+
+    cohorts = {}
+    for observation_period in observation_periods:
+        cohort_start, cohort_end = set_observation_period(observation_period.month, observation_period.year)
+        first = active_duty['Date of DX'].searchsorted(cohort_start, side='right')
+        last = active_duty['Date of DX'].searchsorted(cohort_end, side='left')
+        # back to file order, which get_first_visits keeps for same-day encounters
+        possible_candidates = active_duty.iloc[first:last].sort_index()
+        candidates = select_candidates(possible_candidates, observation_period)
+        cohorts[observation_period] = complete_cohort(candidates, encounter_index, observation_period)
+    return cohorts
+
+def prepare_reports(raw_df, observation_periods):
+    # observation period -> (cohort, pivot by site)
+    cohorts = prepare_cohorts(raw_df, observation_periods)
+    return {period: (cohort, get_pivot_by_site(cohort)) for period, cohort in cohorts.items()}
+
+def get_trend_by_site(cohorts):
+    # One row per site; cases and share that met therapy dosage for each observation month
+    frames = [cohort.assign(Month=period.strftime('%Y-%m')) for period, cohort in cohorts.items()]
+    combined = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if combined.empty:
+        return pd.DataFrame()
+    table = pd.pivot_table(combined, values='Met Therapy Dosage', index=['DMIS', 'Clinic'], columns='Month',
+        aggfunc=['count', 'mean'], fill_value=0)
+    return table.rename(columns={'count': 'Cases', 'mean': 'Metric'}, level=0)
+
+def write_reports(reports, xlsx_file):
+    # Trend sheet first, then the site report of each observation month (from prepare_reports)
+    with pd.ExcelWriter(xlsx_file) as writer:
+        get_trend_by_site({period: cohort for period, (cohort, report) in reports.items()}).to_excel(writer, sheet_name='Trend')
+        for period, (cohort, report) in reports.items():
+            report.to_excel(writer, sheet_name=period.strftime('%Y-%m'))
+    log.info(f'Saved {len(reports)} monthly reports to {xlsx_file}')
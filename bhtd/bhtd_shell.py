@@ -7,6 +7,7 @@ import datetime
 from dateutil.relativedelta import relativedelta
 import calendar
 import logging
+import bhtd as bh
 
 
 # ======================================================================
@@ -39,7 +40,7 @@ WARNING:  I am not a professional programmer. This application contains
           programming experience and is comfortable with python. 
 
 EDITING METRIC PARAMETERS: 
-    Any of the options under "METRIC PARAMETERS" can be safely adjusted
+    Any of the options under "METRIC PARAMETERS" in bhtd.py can be safely adjusted
     without disrupting the application, for example, updating the list
     of ICD-10 codes or further restricting the active duty category.
 
@@ -70,43 +71,9 @@ expected_cols = [
 # METRIC PARAMETERS
 lookback_months = -6   # number of months to establish new episode
 lookforward_days = 90  # number of days in follow-up period
-required_follow_up = 3  # number of visits required in follow-up period
 tolerance = 4 # number of days for flexibility determining valid lookback dates
+# the follow-up requirement, ICD-10 codes and active duty categories are in bhtd.py
 
-depression_ICD10_codes = ['F32.9', 'F32.0', 'F32.1', 'F33.2', 
-                          'F32.4', 'F32.2', 'F33.9', 'F33.0',
-                          'F33.1', 'F33.2', 'F33.41', 'F33.3',
-                          'F32.9']
-
-PTSD_ICD10_codes = ['F43.10', 'F43.11', 'F43.12']
-
-anxiety_ICD10_codes = ['F40.00', 'F40.01', 'F40.02', 'F40.10', 
-                       'F40.11', 'F40.8', 'F40.9', 'F41.0', 
-                       'F41.1', 'F41.3', 'F41.8', 'F41.9']
-
-active_duty = ['USA ACTIVE DUTY OFFICER','USA ACTIVE DUTY ENLISTED',
-               'USA AD RES OFFICER','USA AD RES ENLISTED',
-               'USA RES-30 DAYS OR LESS, NOT IN LOD','USA AD RECRUIT',
-               'USA CADET','USA NG OFFICER','USA NG ENLISTED',
-               'USA NG-30 DAYS OR LESS, NOT IN LOD','USA RES INACT DUTY TRG OFFICER',
-               'USA RES INACT DUTY TRG ENLISTED',
-               'USA RES INACT DUTY TRG - NOT IN LOD','USA NG INACT DUTY TRG OFF',
-               'USA NG INACT DUTY TRG ENL','USA NG INACT DUTY TRG - NOT IN LOD',
-               'NOAA ACTIVE DUTY','USCG ACTIVE DUTY','USCG AD RES','USCG AD RECRUIT',
-               'USCG ACADEMY CADET','USCG RES INACT DUTY TRG','USAF ACTIVE DUTY',
-               'USAF AD RES','USAF RES-30 DAYS OR LESS,NOT IN LOD','USAF AD RECRUIT',
-               'USAF ACADEMY CADET','USAF NG','USAF NG-30 DAYS OR LESS, NOT IN LOD',
-               'USAF RES INACT DUTY TRG','USAF RES INACT DTY TRG - NOT IN LOD',
-               'USAF NG INACT DUTY TRG','USAF NG INACT DUTY TRG - NOT IN LOD',
-               'AD INTEG DISABILITY EVAL SYS MBR','USMC ACTIVE DUTY',
-               'USMC AD RES','USMC RES-30 DAYS OR LESS,NOT IN LOD',
-               'USMC AD RECRUIT','USMC RES INACT DUTY TRG',
-               'USMC RES INACT DTY TRG - NOT IN LOD','USN ACTIVE DUTY',
-               'USN AD RES','USN RES-30 DAYS OR LESS, NOT IN LOD',
-               'USN AD RECRUIT','USN ACADEMY CADET','USN RES INACT DUTY TRG',
-               'USN RES INACT DUTY TRG - NOT IN LOD','USPHS ACTIVE DUTY',
-               'USPHS AD RES','USPHS RES INACT DUTY TRG','NATO RECIP AGREE - SR',
-               'NATO RECIP AGREE - FLEX','NON-NATO RECIP AGREE']
 
 # PANDAS - Disable the SettingWithCopy warning
 pandas.options.mode.chained_assignment = None  # default='warn'
@@ -120,46 +87,6 @@ log.setLevel(logging.DEBUG)
 # ======================================================================
 # FUNCTIONS FOR DATA VALIDATION
 # ======================================================================
-def validate_data_format(data_file):
-    # 1) Has the proper extension (*.xlsx)?
-    file_ext = os.path.splitext(data_file)[1]
-    if file_ext != '.xlsx':
-        tk.messagebox.showerror(
-            'Invalid extension',
-            'Raw data file must have a *.xslx extension.'
-        )
-        log.error('Invalid extension. Expecting \'*.xlsx\'')
-        return False
-    log.info(f'Validated file extension ({file_ext})')
-
-    # 2) Data on the first sheet ("Diagnoses")?
-    first_sheet = pandas.ExcelFile(data_file).sheet_names[0]
-    if first_sheet != raw_data_worksheet:
-        tk.messagebox.showerror(
-            'Invalid worksheet name',
-            f'Raw data worksheet must be named {raw_data_worksheet}.'
-        )
-        log.error(f'Invalid worksheet name. Expecting \'{raw_data_worksheet}\'')
-        return False
-    log.info(f'Validated worksheet name ({first_sheet})')
-    
-    # 3) Has the expected columns?
-    df = pandas.read_excel(data_file, sheet_name=raw_data_worksheet)
-    actual_cols = df.columns.tolist()
-    if actual_cols != expected_cols:
-        tk.messagebox.showerror(
-            'Invalid column names',
-            f'Raw data must have contain the following columns:\n {expected_cols}'
-        )
-        log.error(f'Invalid columns in worksheet. Expecting {expected_cols}')
-        return False
-    log.info(f'Validated column list')
-    
-    # Passed all the tests
-    log.info('Passed all file validation checks')
-    return True
-
-
 def validate_observation_date(selected_month, selected_year, raw_df):    
     log.info(f'Selected date:  {selected_year}-{selected_month}')
 
@@ -218,10 +145,6 @@ def add_months(date, num_months):
     return datetime.date(year, month, day)
 
 
-def get_lookback_date(date):
-    return add_months(date, lookback_months)
-
-
 def get_lookforward_date(date):
     return date + datetime.timedelta(days=lookforward_days)
 
@@ -296,89 +219,43 @@ def set_observation_period(month, year):
         sys.exit()
 
 
-def get_lookback_count(row, raw):
-    patient = row['EDIPI']
-    category = row['DX Category']
-    index_date = row['Date of DX']
-    lookback_date = pandas.Timestamp(row['Lookback Date']) # conversion for futureproofing
-    filter = (raw['EDIPI'] == patient) & \
-        (raw['DX Category'] == category) & \
-        (raw['Date of DX'] < index_date) & \
-        (raw['Date of DX'] >= lookback_date)
-    return len(raw[filter])
-
-
-def get_lookforward_count(row, raw):
-    patient = row['EDIPI']
-    category = row['DX Category']
-    index_date = row['Date of DX']
-    lookforward_date = index_date + datetime.timedelta(days=90)
-    filter = (raw['EDIPI'] == patient) & \
-        (raw['DX Category'] == category) & \
-        (raw['Date of DX'] > index_date) & \
-        (raw['Date of DX'] <= lookforward_date)
-    return len(raw[filter])
-
-
-def categorize_dx(dx):
-    if dx in depression_ICD10_codes:
-        return 'depression'
-    elif dx in PTSD_ICD10_codes:
-        return 'PTSD'
-    elif dx in anxiety_ICD10_codes:
-        return 'anxiety'
-    else:
-        return 'error'
-
-
-def get_clinic(location):
-    return location.split('-', 1)[1]
-
-
-def get_dmis(location):
-    return location.split('-', 1)[0]
-
+# ======================================================================
+# FUNCTIONS FOR REPORTING
+# ======================================================================
+def get_month_runs(months):
+    # Consecutive months grouped as (first, last), e.g. [1, 2, 3, 7] -> [(1, 3), (7, 7)]
+    runs = []
+    for month in sorted(months):
+        if runs and month == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], month)
+        else:
+            runs.append((month, month))
+    return runs
 
-def is_active_duty(patcat):
-    if any(x in patcat for x in active_duty):
-        return True
-    else:
-        return False
 
+def get_period_text(months, year):
+    # e.g. '3/2019', '1-3/2019' or '1-3, 7/2019'; only consecutive months are shown as a range
+    runs = get_month_runs(months)
+    return ', '.join(f'{first}' if first == last else f'{first}-{last}' for first, last in runs) + f'/{year}'
 
-def met_therapy_dosage(num_visits):
-    if num_visits >= required_follow_up:
-        return 1
-    else:
-        return 0
 
-
-# ======================================================================
-# FUNCTIONS FOR REPORTING
-# ======================================================================
 def get_report_date():
     return cohort_start + ' - ' + cohort_end
 
 
-def get_report_by_site(cohort):
-    df = cohort.groupby(['DMIS', 'Clinic', 'DX Category']).agg({'Met Therapy Dosage':['sum', 'count']})
-    df.columns = ['Met Therapy Goal','Cases']
-    df['Met Therapy Goal'] = df['Met Therapy Goal'].astype(int)
-    df['Percent'] = df['Met Therapy Goal']/df['Cases']
-    return df
-
+def get_final_report(sub_report):
+    # Add totals columns 
+    sub_report['Cases', 'all'] = sub_report['Cases', 'PTSD'] + sub_report['Cases', 'anxiety'] + sub_report['Cases', 'depression']
+    sub_report['Met Therapy Goal', 'all'] = sub_report['Met Therapy Goal', 'PTSD'] + sub_report['Met Therapy Goal', 'anxiety'] + sub_report['Met Therapy Goal', 'depression']
+    sub_report['Metric', 'all'] = sub_report['Met Therapy Goal', 'all'] / sub_report['Cases', 'all']
 
-def get_pivot_by_site(cohort):
-    df = get_report_by_site(cohort)
-    
-    table = pandas.pivot_table(df, values=['Cases', 'Met Therapy Goal'], index=['DMIS', 'Clinic'], columns=['DX Category'], aggfunc=sum, fill_value=0)
-
-    table[('Metric', 'PTSD')] = table[('Met Therapy Goal', 'PTSD')] / table[('Cases', 'PTSD')]
-    table[('Metric', 'anxiety')] = table[('Met Therapy Goal', 'anxiety')] / table[('Cases', 'anxiety')]
-    table[('Metric', 'depression')] = table[('Met Therapy Goal', 'depression')] / table[('Cases', 'depression')]
-    table = table.fillna(0)
-    return table
+    # Reorder the columns
+    col_order = [('Met Therapy Goal', 'anxiety'), ('Met Therapy Goal', 'depression'), ('Met Therapy Goal', 'PTSD'), ('Met Therapy Goal', 'all'),
+                ('Cases', 'anxiety'), ('Cases', 'depression'), ('Cases', 'PTSD'), ('Cases', 'all'),
+                ('Metric', 'anxiety'), ('Metric', 'depression'), ('Metric', 'PTSD'), ('Metric', 'all')]
 
+    # Generate the final report
+    return pandas.DataFrame(sub_report, columns=col_order)
 
 
 # ======================================================================
@@ -412,6 +289,7 @@ class BHTDApp():
         self.cohort_end = None
         self.cohort = None
         self.report = None
+        self.reports = None
         log.info('Variables cleared')
 
         # reset GUI elements
@@ -458,7 +336,7 @@ class BHTDApp():
         select_frame_inner = tk.Frame(select_frame_outer)
         select_frame_inner.pack(fill=tk.X)
         
-        self.month_list = tk.Listbox(select_frame_inner, height=12, width=12)
+        self.month_list = tk.Listbox(select_frame_inner, height=12, width=12, selectmode=tk.EXTENDED) # shift-click for a range of months
         self.month_list.configure(exportselection=False) # prevents listbox from losing selection
         self.month_list.pack(side=tk.LEFT)
         for i in range(1, 13):
@@ -504,10 +382,11 @@ class BHTDApp():
             self.data_status.configure(text='Status:  Loading data ...')
             self.data_status.update()
 
-            if validate_data_format(result):
-                # Create a dataframe from the raw data
-                self.raw = pandas.read_excel(result, sheet_name=raw_data_worksheet)
-                                
+            # Create a dataframe from the raw data (validated, parsed once and cached;
+            # parsing and the cache are shared with the PySide2 app)
+            self.raw, problems = bh.ingest_raw_data(result)
+            if self.raw is not None:
+
                 # Determine maximum date range
                 dates = get_date_range(self.raw, 'Date of DX')
                 log.info(f'Total data range:  {dates[0]} to {dates[1]}')
@@ -533,11 +412,13 @@ class BHTDApp():
                 self.data_status.configure(text=status)
                 self.data_status.update()
             
-            else: # invalid data format
-                error_msg = ('Unable to process the loaded file. Possible reasons include wrong file type'
-                            ', incorrect worksheet name (should be \'Diagnoses\'), or mislabeled columns.')
-                tk.messagebox.showerror('Invalid file', error_msg)
-                log.error(f'Invalid file. {error_msg}')
+            else: # invalid data format; all problems are reported at once
+                tk.messagebox.showerror(
+                    'Invalid data file',
+                    f'Raw data must be on the \'{raw_data_worksheet}\' worksheet and contain the following columns:\n'
+                    f' {expected_cols}\n\n' + '\n'.join(problems)
+                )
+                log.error(f'Invalid data file ({len(problems)} problems)')
                 self.reset_all()
 
 
@@ -553,119 +434,30 @@ class BHTDApp():
             log.error('Nothing selected in one or both listboxes')
 
         else: # something selected in both listboxes
-            month = self.month_list.curselection()[0] + 1 # +1 to offset 0-based index
+            months = [index + 1 for index in self.month_list.curselection()] # +1 to offset 0-based index
             year = str(self.year_list.get(self.year_list.curselection()[0]))
+            period_text = get_period_text(months, year)
             
-            if validate_observation_date(month, year, self.raw):
-                self.processed_status.configure(text=f'Status:  processing data for {month}/{year} ...')
+            if all(validate_observation_date(month, year, self.raw) for month in months):
+                self.processed_status.configure(text=f'Status:  processing data for {period_text} ...')
                 self.processed_status.update()
 
                 log.info(f'Total encounters:  {len(self.raw)}')
 
-                # Set the start and end dates for the observation period
-                self.cohort_start, self.cohort_end = set_observation_period(month, year)
-                
-                # Add the diagnosis category column to the raw data
-                self.raw['DX Category'] = self.raw['DX Code'].apply(categorize_dx)
-
-                # Add the Active Duty column to the raw data
-                self.raw['Active Duty'] = self.raw['Codified Value'].apply(is_active_duty)
-
-                # Add the DMIS (facility) column to the raw data
-                self.raw['DMIS'] = self.raw['Person Location- Nurse Unit / Ambulatory (Admit) Display'].apply(get_dmis)
-
-                # Add the clinic column to the raw data
-                self.raw['Clinic'] = self.raw['Person Location- Nurse Unit / Ambulatory (Admit) Display'].apply(get_clinic)
-
-                # Make a new dataframe with just active duty
-                active_duty = self.raw[self.raw['Active Duty'] == True]
-                log.info(f'Active duty encounters:  {len(active_duty)}')
-
-                # Extract possible candidates (i.e., patients in observation window)
-                possible_candidates = active_duty[(active_duty['Date of DX'] > self.cohort_start) & 
-                    (active_duty['Date of DX'] < self.cohort_end)]
-                log.info(f'Possible candidates in observation period:  {len(possible_candidates)}')
-
-                # Group by patient and diagnosis category
-                grp_by_pt = possible_candidates.groupby(['EDIPI', 'DX Category'])
-
-                # Create a list of the first encounter for each patient-diagnosis group
-                first_visits = []
-
-                for key, group in grp_by_pt:
-                    earliest = group['Date of DX'].min()
-                    
-                    for idx, row in group.iterrows():
-                        if row['Date of DX'] == earliest:
-                            name = row['Patient Name, Full']
-                            EDIPI = row['EDIPI']
-                            date = row['Date of DX']
-                            FIN = row['Formatted Financial Nbr']
-                            enc_type = row['Encounter Type']
-                            facility = row['Person Location- Nurse Unit / Ambulatory (Admit) Display']
-                            dx_code = row['DX Code']
-                            dx = row['Diagnosis Code Description']
-                            dx_category = row['DX Category']
-                            active_duty = row['Active Duty']
-                            dmis = row['DMIS']
-                            clinic = row['Clinic']
-                        
-                            first_visits.append([name, EDIPI, date, FIN, enc_type, facility, dx_code, dx, dx_category, active_duty, dmis, clinic])
-                            
-                # Create a new dataframe with the refined candidate list
-                cols = ['Patient Name, Full',
-                        'EDIPI',
-                        'Date of DX',
-                        'FIN',
-                        'Encounter Type',
-                        'Person Location- Nurse Unit / Ambulatory (Admit) Display',
-                        'DX Code',
-                        'Diagnosis Code Description',
-                        'DX Category',
-                        'Active Duty',
-                        'DMIS',
-                        'Clinic']
-
-                # candidates lists the first encounter for each diagnostic category in the observation period.
-                candidates = pandas.DataFrame(columns=cols, data=first_visits)
-
-                # Add a column showing lookback date to candidates
-                candidates['Lookback Date'] = candidates['Date of DX'].apply(get_lookback_date)
-
-                # Add a column with number of visits in the lookback period
-                candidates['Lookback Count'] = candidates.apply(lambda row: get_lookback_count(row, self.raw), axis=1)
-
-                # Add a column for whether the case counts as a new episode
-                candidates['New Episode'] = candidates['Lookback Count'].apply(lambda x: x == 0)
-
-                # Create the final cohort of index visits by keeping only new episodes of care
-                self.cohort = candidates[candidates['New Episode'] == True]
-                log.info(f'Cohort cases:  {len(self.cohort)}')
-                
-                # Add a column with number of visits in the 90 days after the index visit
-                self.cohort['Lookforward Count'] = self.cohort.apply(lambda row: get_lookforward_count(row, self.raw), axis=1)
+                # Every selected month in one pass: the DX Category, Active Duty, DMIS and Clinic
+                # columns and the sorted encounter index are built once (see bh.prepare_reports)
+                periods = [pandas.Timestamp(int(year), month, 1) for month in months]
+                self.reports = {}
+                for period, (cohort, sub_report) in bh.prepare_reports(self.raw, periods).items():
+                    log.info(f'Cohort cases ({period.month}/{year}):  {len(cohort)}')
+                    self.reports[period] = (cohort, get_final_report(sub_report))
 
-                # Add a column if met therapy dosage (>= 3); success is 1 (for True), failure is 0 (for False)
-                self.cohort['Met Therapy Dosage'] = self.cohort['Lookforward Count'].apply(met_therapy_dosage)
-
-                # Get the initial report
-                sub_report = get_pivot_by_site(self.cohort)
-
-                # Add totals columns 
-                sub_report['Cases', 'all'] = sub_report['Cases', 'PTSD'] + sub_report['Cases', 'anxiety'] + sub_report['Cases', 'depression']
-                sub_report['Met Therapy Goal', 'all'] = sub_report['Met Therapy Goal', 'PTSD'] + sub_report['Met Therapy Goal', 'anxiety'] + sub_report['Met Therapy Goal', 'depression']
-                sub_report['Metric', 'all'] = sub_report['Met Therapy Goal', 'all'] / sub_report['Cases', 'all']
-
-                # Reorder the columns
-                col_order = [('Met Therapy Goal', 'anxiety'), ('Met Therapy Goal', 'depression'), ('Met Therapy Goal', 'PTSD'), ('Met Therapy Goal', 'all'),
-                            ('Cases', 'anxiety'), ('Cases', 'depression'), ('Cases', 'PTSD'), ('Cases', 'all'),
-                            ('Metric', 'anxiety'), ('Metric', 'depression'), ('Metric', 'PTSD'), ('Metric', 'all')]
-
-                # Generate the final report
-                self.report = pandas.DataFrame(sub_report, columns=col_order)
+                # The first selected month is the one exported with patient lists
+                self.cohort_start, self.cohort_end = set_observation_period(months[0], year)
+                self.cohort, self.report = self.reports[periods[0]]
 
                 # Update the process data status label and enable the export report button
-                self.processed_status.configure(text=f'Status:  data for {month}/{year} ready for export')
+                self.processed_status.configure(text=f'Status:  data for {period_text} ready for export')
                 self.processed_status.update()
                 self.export_report_btn.config(state=tk.NORMAL)
             
@@ -678,6 +470,12 @@ class BHTDApp():
         # Setup the output filename
         tokens = self.cohort_start.split('/')
         default_report_name = 'BH Therapy Dosage (' + tokens[2] + '-' + tokens[0] + ').xlsx'
+        periods = list(self.reports)
+        if len(periods) > 1:
+            year = periods[0].year
+            runs = get_month_runs([period.month for period in periods])
+            default_report_name = 'BH Therapy Dosage (' + ', '.join(f'{year}-{first:02d}' if first == last else
+                f'{year}-{first:02d} to {year}-{last:02d}' for first, last in runs) + ').xlsx'
         report_name = filedialog.asksaveasfilename(
             title='Export report ...',
             defaultextension='.xlsx',
@@ -693,6 +491,13 @@ class BHTDApp():
             worksheet.write(0,1, self.cohort_start)
             worksheet.write(1,0,'End: ')
             worksheet.write(1,1, self.cohort_end)
+
+            # Several months processed: the trend by site and every month's report
+            if len(periods) > 1:
+                cohorts = {period: cohort for period, (cohort, report) in self.reports.items()}
+                bh.get_trend_by_site(cohorts).to_excel(writer, sheet_name='Trend')
+                for period, (cohort, report) in self.reports.items():
+                    report.to_excel(writer, sheet_name=f'Report {period:%Y-%m}')
             
             clinics = list(self.report.index.values)  # get a list of all the clinics in the report
             for clinic in clinics:
@@ -1,7 +1,7 @@
 import sys
 from PySide2.QtCore import QDate, Signal, Slot, QObject
 from PySide2.QtUiTools import QUiLoader
-from PySide2.QtWidgets import QApplication, QMainWindow, QPlainTextEdit, QFileDialog, QErrorMessage, QMessageBox, QLabel
+from PySide2.QtWidgets import QApplication, QMainWindow, QPlainTextEdit, QFileDialog, QErrorMessage, QMessageBox, QLabel, QDateEdit
 import calendar
 import logging
 import pandas as pd
@@ -10,6 +10,7 @@ import bhtd as bh
 # Python environment requires: python3, pandas, xlrd
 
 # UI components: dateEdit, load_file_btn, save_report_btn, menubar, statusbar
+#   (end_date_edit, the last month of a multi-month report, is added in code)
 
 logging.basicConfig(
     level=logging.DEBUG, 
@@ -68,6 +69,14 @@ class Window(QMainWindow):
         now = QDate.currentDate()
         default_report_date = now.addMonths(-8) # should be 4
         self.ui.dateEdit.setDate(default_report_date)
+
+        # add the end of the report range; one workbook covers every month from dateEdit through it
+        self.ui.verticalLayout_2.addWidget(QLabel('through'))
+        self.end_date_edit = QDateEdit()
+        self.end_date_edit.setDisplayFormat(self.ui.dateEdit.displayFormat())
+        self.end_date_edit.setDate(default_report_date)
+        self.ui.verticalLayout_2.addWidget(self.end_date_edit)
+        self.ui.dateEdit.dateChanged.connect(self.on_start_date_changed)
         
         # add the range display label
         self.range_label = QLabel()
@@ -89,13 +98,19 @@ class Window(QMainWindow):
     def on_file_loaded_changed(self):
         self.ui.save_report_btn.setEnabled(self.file_loaded.value)
 
+    def on_start_date_changed(self, date):
+        # keep the range at least one month long
+        if self.end_date_edit.date() < date:
+            self.end_date_edit.setDate(date)
+
     def on_load_file_btn_click(self):
         self.ui.statusbar.showMessage('Loading file ...')
         
         file_name = QFileDialog.getOpenFileName(self)[0]
-        if file_name and bh.validate_raw_data(file_name):
+        raw, problems = bh.ingest_raw_data(file_name) if file_name else (None, [])
+        if raw is not None:
             self.file_loaded.value = True
-            self.raw = bh.load_raw_data(file_name)
+            self.raw = raw
             self.dates = bh.get_date_range(self.raw, 'Date of DX')
             self.valid_dates = bh.validate_observation_dates(self.dates[0], self.dates[1])
             valid_start = self.valid_dates[0].strftime('%B %Y')
@@ -107,14 +122,14 @@ class Window(QMainWindow):
             log.info(f'PI-EDW file contains encounters from:  {self.dates[0].date()} to {self.dates[1].date()}')
             log.info(f'Valid observation range:  {valid_start} through {valid_end}\n')
             
-        elif file_name and not bh.validate_raw_data(file_name):
+        elif file_name: # invalid data file
             self.file_loaded.value = False
             self.raw = None
             self.dates = None
             self.valid_dates = None
             self.range_label.setText('')
             
-            QMessageBox.about(self, 'Error', 'Invalid data file. Program reset.')
+            QMessageBox.about(self, 'Error', 'Invalid data file. Program reset.\n\n' + '\n'.join(problems))
         
         else: # user cancelled; do nothing
             pass
@@ -127,17 +142,31 @@ class Window(QMainWindow):
             return
 
         else:
-            date = self.ui.dateEdit.date() # needs to be converted to pd.Timestamp
-            observation_period = pd.Timestamp(f'{date.year()}-{date.month()}-{date.day()}')
-            if bh.date_in_range(
-                observation_period, self.valid_dates[0], self.dates[1] # allows reports w/incomplete F/U
-            ):
-                log.info('Requested report falls within the valid observation range.')
-                cohort = bh.prepare_cohort(self.raw, observation_period)
-                
-                #log.info(f'Cohort for {display_date}:  {len(cohort)}')
-            else:
+            start = self.ui.dateEdit.date() # needs to be converted to pd.Timestamp
+            end = self.end_date_edit.date()
+            months = bh.get_observation_months(
+                pd.Timestamp(start.year(), start.month(), 1), pd.Timestamp(end.year(), end.month(), 1))
+            outside = [
+                month for month in months
+                if not bh.date_in_range(month, self.valid_dates[0], self.dates[1]) # allows reports w/incomplete F/U
+            ]
+            if not months or outside:
                 log.error('Requested report falls outside the valid observation range.')
+                return
+
+            log.info('Requested report falls within the valid observation range.')
+            default_name = f'BH Therapy Dosage ({months[0]:%Y-%m} to {months[-1]:%Y-%m}).xlsx'
+            file_name = QFileDialog.getSaveFileName(self, 'Save report', default_name, 'Excel files (*.xlsx)')[0]
+            if not file_name: # user cancelled; do nothing
+                return
+
+            # every month in one pass (shared derived columns and encounter index)
+            self.ui.statusbar.showMessage(f'Preparing {len(months)} monthly reports ...')
+            reports = bh.prepare_reports(self.raw, months)
+            for month, (cohort, report) in reports.items():
+                log.info(f'Cohort for {month:%B %Y}:  {len(cohort)}')
+            bh.write_reports(reports, file_name)
+            self.ui.statusbar.showMessage(f'Report saved:  {file_name}')
         
 
 if __name__ == "__main__":
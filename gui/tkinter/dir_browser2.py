@@ -126,25 +126,16 @@ class DirBrowser():
         #self.update_dir_tree_counts()
 
     def process_directory(self, parent, path):
-        for p in os.listdir(path):
-            abspath = os.path.join(path, p)
-            isdir = os.path.isdir(abspath)
-
-            if abspath.endswith('.pdf'):
-                node = self.dir_tree.insert(parent, 'end', text=p, open=False)
-                #print(f'{abspath}')
-
-            # it's a file; insert it
-            #node = self.dir_tree.insert(parent, 'end', text=p, open=False)
-            
-            # if not a PDF, remove it
-            #if not abspath.endswith('.pdf'):
-            #    print(f'{p} is not a pdf')
-            #    self.dir_tree.detach(node)
-            
-            # it's a directory; call recursively
-            if isdir:
-                self.process_directory(node, abspath)
+        # os.scandir returns the entry type with the listing, so there's no isdir() call per entry
+        with os.scandir(path) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.is_dir(follow_symlinks=False):
+                    # it's a directory; call recursively
+                    node = self.dir_tree.insert(parent, 'end', text=entry.name, open=False)
+                    self.process_directory(node, entry.path)
+
+                elif entry.name.endswith('.pdf'):
+                    node = self.dir_tree.insert(parent, 'end', text=entry.name, open=False)
 
 
     def update_dir_tree_counts(self):
@@ -0,0 +1,330 @@
+# Extraction benchmark for medlib
+#   generate: writes a reproducible synthetic corpus (same seed, same bytes) with a
+#     manifest of what each file contains: page counts, where the DOI is, compressed
+#     or plain content streams, encrypted files (openable and password-locked) and
+#     scanned-only files with no text layer
+#   run: extracts the corpus with each mode and worker count and reports files/s,
+#     pages/s, p50/p95 per-file latency, peak worker RSS and DOI recall
+#   python benchmark.py generate /tmp/corpus --files 300 --seed 1
+#   python benchmark.py run /tmp/corpus --modes default,full --workers 1,4 --json bench.json
+import argparse, hashlib, json, os, random, resource, struct, zlib
+import multiprocessing as mp
+
+# For logging
+import logging
+logging.basicConfig(level=logging.CRITICAL, format='%(levelname)-9s: %(name)s : %(funcName)s() : %(message)s')
+log = logging.getLogger('benchmark')
+log.setLevel(logging.DEBUG)
+
+# For timing operations
+from timeit import default_timer as timer
+
+import doi_engine
+from doi_match import find_dois
+from telemetry import percentile
+
+
+manifest_filename = 'manifest.json'
+locked_password = 'benchmark'  # user password of the 'locked' files
+
+# corpus mix: (kind, weight); kinds other than 'text' are the awkward cases
+kinds = [('text', 70), ('encrypted', 10), ('locked', 5), ('scanned', 15)]
+placements = [('first', 30), ('footer', 20), ('last', 15), ('info', 10), ('annotation', 10), ('none', 10),
+    ('info_literal', 5), ('inline', 5)]  # literal: /doi(...)/Subject(...); inline: (... doi:10.x/y.)Tj
+page_counts = [1, 2, 4, 8, 12, 20, 40, 120]
+
+words = ('patient study clinical outcome cohort risk analysis treatment trial results methods '
+    'children hospital data care control group effect baseline follow-up significant model').split()
+
+
+###### PDF WRITER ######
+pad = bytes.fromhex('28BF4E5E4E758A4164004E56FFFA01082E2E00B6D0683E802F0CA9FE6453697A')
+
+def rc4(key, data):
+    s = list(range(256))
+    j = 0
+    for i in range(256):
+        j = (j + s[i] + key[i % len(key)]) & 0xFF
+        s[i], s[j] = s[j], s[i]
+    out = bytearray(len(data))
+    i = j = 0
+    for n, byte in enumerate(data):
+        i = (i + 1) & 0xFF
+        j = (j + s[i]) & 0xFF
+        s[i], s[j] = s[j], s[i]
+        out[n] = byte ^ s[(s[i] + s[j]) & 0xFF]
+    return bytes(out)
+
+def padded(password):
+    return (password.encode('latin-1') + pad)[:32]
+
+def pdf_text(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+class PDFBuilder():
+    # Minimal PDF 1.4 writer; with a user/owner password the file uses the standard
+    # security handler (RC4, 40-bit, revision 2), which pdfminer can open
+    def __init__(self, file_id, compress=False, user_password=None, owner_password='owner'):
+        self.bodies = [None]  # object 0 is the free-list head
+        self.file_id = file_id
+        self.compress = compress
+        self.key = None
+        if user_password is not None:
+            self.permissions = -44
+            self.owner_entry = rc4(hashlib.md5(padded(owner_password)).digest()[:5], padded(user_password))
+            self.key = hashlib.md5(padded(user_password) + self.owner_entry + struct.pack('<i', self.permissions) + file_id).digest()[:5]
+
+    def reserve(self):
+        self.bodies.append(None)
+        return len(self.bodies) - 1
+
+    def add(self, body):
+        num = self.reserve()
+        self.bodies[num] = body
+        return num
+
+    def encrypt(self, num, data):
+        if self.key is None:
+            return data
+        object_key = hashlib.md5(self.key + struct.pack('<i', num)[:3] + b'\0\0').digest()[:10]
+        return rc4(object_key, data)
+
+    def string(self, num, text):
+        return b'<' + self.encrypt(num, text.encode('latin-1')).hex().encode() + b'>'
+
+    def literal(self, num, text):
+        # (...) string as most producers write it; hex when encrypted
+        if self.key is not None:
+            return self.string(num, text)
+        return b'(' + pdf_text(text).encode('latin-1') + b')'
+
+    def stream(self, num, data, entries=b''):
+        if self.compress:
+            data = zlib.compress(data)
+            entries += b' /Filter /FlateDecode'
+        data = self.encrypt(num, data)
+        return b'<< /Length %d%s >>\nstream\n' % (len(data), entries) + data + b'\nendstream'
+
+    def write(self, path, root, info=None):
+        trailer = b'/Size %d /Root %d 0 R' % (len(self.bodies) + (self.key is not None), root)
+        if info is not None:
+            trailer += b' /Info %d 0 R' % info
+        if self.key is not None:
+            user_entry = rc4(self.key, pad)
+            encrypt = self.add(b'<< /Filter /Standard /V 1 /R 2 /O <%s> /U <%s> /P %d >>' % (
+                self.owner_entry.hex().encode(), user_entry.hex().encode(), self.permissions))
+            trailer += b' /Encrypt %d 0 R' % encrypt
+        file_id = self.file_id.hex().encode()
+        trailer += b' /ID [<%s> <%s>]' % (file_id, file_id)
+
+        out = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for num, body in enumerate(self.bodies[1:], start=1):
+            offsets.append(len(out))
+            out += b'%d 0 obj\n' % num + body + b'\nendobj\n'
+        xref = len(out)
+        out += b'xref\n0 %d\n0000000000 65535 f \n' % len(self.bodies)
+        out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+        out += b'trailer\n<< %s >>\nstartxref\n%d\n%%%%EOF\n' % (trailer, xref)
+        with open(path, 'wb') as f:
+            f.write(out)
+
+
+###### CORPUS ######
+def choose(rng, weighted):
+    return rng.choices([item for item, weight in weighted], [weight for item, weight in weighted])[0]
+
+def random_doi(rng):
+    return f'10.{rng.randint(1000, 9999)}/{rng.choice(["j", "s", "art"])}.{rng.randint(2000, 2024)}.{rng.randint(1, 99999)}'
+
+def page_lines(rng, count=40):
+    return [' '.join(rng.choice(words) for _ in range(rng.randint(8, 14))) for _ in range(count)]
+
+def make_document(path, rng, spec):
+    # Writes one corpus file described by spec (see generate_corpus)
+    kind, placement, doi, pages = spec['kind'], spec['placement'], spec['doi'], spec['pages']
+    password = {'encrypted': '', 'locked': locked_password}.get(kind)
+    pdf = PDFBuilder(hashlib.md5(spec['file'].encode()).digest(), spec['compressed'], password)
+
+    catalog = pdf.reserve()
+    page_tree = pdf.reserve()
+    font = pdf.add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+    references = [random_doi(rng) for _ in range(rng.randint(0, 6))]
+
+    page_nums = []
+    for page_index in range(pages):
+        last = page_index == pages - 1
+        content = pdf.reserve()
+        if kind == 'scanned':
+            # one full-page image and no text operators, like an unOCRed scan
+            pixels = bytes((x * 7 + y * 3 + page_index) & 0xFF for y in range(150) for x in range(120))
+            image = pdf.reserve()
+            pdf.bodies[image] = pdf.stream(image, pixels,
+                b' /Type /XObject /Subtype /Image /Width 120 /Height 150 /ColorSpace /DeviceGray /BitsPerComponent 8')
+            pdf.bodies[content] = pdf.stream(content, b'q 612 0 0 792 0 0 cm /Im1 Do Q')
+            resources = b'<< /XObject << /Im1 %d 0 R >> >>' % image
+        else:
+            lines = page_lines(rng)
+            if placement == 'first' and page_index == 0:
+                lines.insert(0, f'Original article  doi: {doi}')
+            if placement == 'footer':
+                lines.append(f'https://doi.org/{doi}  page {page_index + 1}')
+            if placement == 'inline' and page_index == 0:
+                lines.insert(1, f'Received 2 May 2019; accepted 9 July 2019. doi:{doi}.')
+            if last:
+                if placement == 'last':
+                    lines.append(f'Cite this article as doi:{doi}')
+                lines += ['References'] + [f'{n}. Author A. Some title. J Med. doi:{ref}' for n, ref in enumerate(references, 1)]
+            # inline: no space between the string and its operator, so the raw bytes read ...doi.)Tj
+            show = b'(%s)Tj T* ' if placement == 'inline' else b'(%s) Tj T* '
+            text = b''.join(show % pdf_text(line).encode('latin-1') for line in lines)
+            pdf.bodies[content] = pdf.stream(content, b'BT /F1 9 Tf 12 TL 40 760 Td ' + text + b'ET')
+            resources = b'<< /Font << /F1 %d 0 R >> >>' % font
+
+        annots = b''
+        if placement == 'annotation' and page_index == 0:
+            annot = pdf.reserve()
+            pdf.bodies[annot] = (b'<< /Type /Annot /Subtype /Link /Rect [40 770 300 785] /Border [0 0 0] '
+                b'/A << /S /URI /URI %s >> >>' % pdf.string(annot, f'https://doi.org/{doi}'))
+            annots = b' /Annots [%d 0 R]' % annot
+        page_nums.append(pdf.add(b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] /Resources %s /Contents %d 0 R%s >>'
+            % (page_tree, resources, content, annots)))
+
+    pdf.bodies[catalog] = b'<< /Type /Catalog /Pages %d 0 R >>' % page_tree
+    pdf.bodies[page_tree] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(b'%d 0 R' % num for num in page_nums), pages)
+
+    info = pdf.reserve()
+    entries = b'/Title %s /Producer %s' % (pdf.string(info, 'Synthetic article'), pdf.string(info, 'medlib benchmark'))
+    if placement == 'info':
+        entries += b' /doi %s' % pdf.string(info, doi)
+    if placement == 'info_literal':
+        entries += b' /doi%s/Subject%s' % (pdf.literal(info, doi), pdf.literal(info, 'Original article'))
+    pdf.bodies[info] = b'<< %s >>' % entries
+    pdf.write(path, catalog, info)
+
+def generate_corpus(directory, files=200, seed=1):
+    # Same seed, same corpus (byte for byte); returns the manifest
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    manifest = []
+    for n in range(files):
+        kind = choose(rng, kinds)
+        placement = choose(rng, placements)
+        if kind == 'scanned' and placement not in ('info', 'info_literal', 'none'):
+            placement = 'none'  # a scan has no text layer to carry the DOI
+        spec = {'file': f'doc{n:05d}.pdf', 'kind': kind, 'placement': placement,
+            'doi': random_doi(rng) if placement != 'none' else None,
+            'pages': rng.choice(page_counts), 'compressed': rng.random() < 0.7}
+        make_document(os.path.join(directory, spec['file']), rng, spec)
+        manifest.append(spec)
+
+    with open(os.path.join(directory, manifest_filename), 'w') as f:
+        json.dump({'seed': seed, 'files': manifest}, f, indent=1)
+    log.info(f'Generated {files} files in {directory}')
+    return manifest
+
+
+###### EXTRACTION MODES ######
+# Each mode takes a path and returns the ranked DOIs (or False); nothing is cached
+def mode_legacy(path):
+    # the original whole-document conversion followed by a regex over the text
+    text = doi_engine.convert_pdf_to_text(path)
+    return find_dois(text) if text else False
+
+def mode_default(path):
+    return doi_engine.scan_pdf_for_doi(path)
+
+def mode_full(path):
+    return doi_engine.scan_pdf_for_doi(path, full_scan=True)
+
+def mode_no_metadata(path):
+    return doi_engine.scan_pdf_for_doi(path, use_metadata=False)
+
+def mode_raw(path):
+    return doi_engine.scan_pdf_for_doi(path, text_mode='raw')
+
+def mode_layout(path):
+    return doi_engine.scan_pdf_for_doi(path, text_mode='layout')
+
+modes = {'legacy': mode_legacy, 'default': mode_default, 'full': mode_full, 'no-metadata': mode_no_metadata,
+    'raw': mode_raw, 'layout': mode_layout}
+
+
+###### HARNESS ######
+def bench_file(task):
+    # Runs in a pool worker: (mode, path) -> (path, seconds, primary DOI or None, error, peak RSS in KB)
+    mode, path = task
+    t1 = timer()
+    error = ''
+    try:
+        dois = modes[mode](path)
+    except Exception as ex:
+        dois = False
+        error = type(ex).__name__
+    t2 = timer()
+    primary = dois[0] if dois else None
+    return path, t2 - t1, primary, error, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_benchmark(directory, mode, workers):
+    with open(os.path.join(directory, manifest_filename)) as f:
+        manifest = {os.path.join(directory, spec['file']): spec for spec in json.load(f)['files']}
+
+    tasks = [(mode, path) for path in manifest]
+    t1 = timer()
+    with mp.Pool(workers) as pool:  # fresh processes, so peak RSS belongs to this run
+        results = list(pool.imap_unordered(bench_file, tasks, chunksize=1))
+    wall = timer() - t1
+
+    latencies = [seconds for path, seconds, primary, error, rss in results]
+    pages = sum(spec['pages'] for spec in manifest.values())
+    expected = [path for path, spec in manifest.items() if spec['doi']]
+    found = {path: primary for path, seconds, primary, error, rss in results}
+    correct = sum(1 for path in expected if found[path] == manifest[path]['doi'])
+    errors = {}
+    for path, seconds, primary, error, rss in results:
+        if error:
+            errors[error] = errors.get(error, 0) + 1
+
+    return {'mode': mode, 'workers': workers, 'files': len(results), 'pages': pages,
+        'seconds': round(wall, 3), 'files_per_s': round(len(results) / wall, 2), 'pages_per_s': round(pages / wall, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1), 'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'peak_rss_mb': round(max(rss for path, seconds, primary, error, rss in results) / 1024, 1),
+        'recall': round(correct / len(expected), 3) if expected else None, 'errors': errors}
+
+def print_table(rows):
+    columns = ['mode', 'workers', 'files_per_s', 'pages_per_s', 'p50_ms', 'p95_ms', 'peak_rss_mb', 'recall']
+    print(''.join(f'{column:>13}' for column in columns))
+    for row in rows:
+        print(''.join(f'{str(row[column]):>13}' for column in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark medlib DOI extraction on a synthetic corpus')
+    commands = parser.add_subparsers(dest='command', required=True)
+    generate = commands.add_parser('generate', help='write a synthetic corpus')
+    generate.add_argument('directory')
+    generate.add_argument('--files', type=int, default=200)
+    generate.add_argument('--seed', type=int, default=1)
+    run = commands.add_parser('run', help='benchmark extraction on a corpus')
+    run.add_argument('directory')
+    run.add_argument('--modes', default='default', help=f"comma-separated, from: {', '.join(modes)}")
+    run.add_argument('--workers', default=str(os.cpu_count() or 1), help='comma-separated worker counts, e.g. 1,4,8')
+    run.add_argument('--json', help='also write the results here')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate_corpus(args.directory, args.files, args.seed)
+    else:
+        # extraction logs every file; keep the output to the results table
+        logging.getLogger('doi_engine').setLevel(logging.CRITICAL)
+        rows = []
+        for mode in args.modes.split(','):
+            for workers in [int(n) for n in args.workers.split(',')]:
+                rows.append(run_benchmark(args.directory, mode, workers))
+                log.info(f"{mode} x{workers}: {rows[-1]['files_per_s']} files/s, errors {rows[-1]['errors']}")
+        print_table(rows)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(rows, f, indent=1)
@@ -0,0 +1,160 @@
+# Citation export for medlib
+#   Streams records from the library index (or any iterable of results) to RIS,
+#   BibTeX or CSL-JSON. Each record is formatted and written as it is read,
+#   through a large write buffer, so exporting 100k files never holds more than
+#   one record in memory.
+#   python citation_export.py /library -o library.ris
+#   python citation_export.py /library -o library.bib --include-multiple
+import argparse, json, os, re
+
+# For logging
+import logging
+logging.basicConfig(level=logging.CRITICAL, format='%(levelname)-9s: %(name)s : %(funcName)s() : %(message)s')
+log = logging.getLogger('citation_export')
+log.setLevel(logging.DEBUG)
+
+# For timing operations
+from timeit import default_timer as timer
+
+from library_index import LibraryIndex, default_index_path
+from metadata_index import MetadataIndex
+
+
+write_buffer = 1024 * 1024
+formats = {'.ris': 'ris', '.bib': 'bibtex', '.json': 'csl-json'}
+
+
+def export_format(output, requested=None):
+    if requested:
+        return requested
+    return formats.get(os.path.splitext(output)[1].lower(), 'ris')
+
+
+###### CITATION FIELDS ######
+def citation(record, metadata=None):
+    # Flattens a result record ({'path', 'dois', ...}) plus optional metadata
+    # ({'title', 'journal', 'year', 'authors': [{'family', 'given'}]}) into one citation
+    metadata = metadata or {}
+    dois = record['dois']
+    return {
+        'doi': dois[0],
+        'other_dois': dois[1:],
+        'path': record['path'],
+        'title': metadata.get('title') or os.path.splitext(os.path.basename(record['path']))[0],
+        'journal': metadata.get('journal'),
+        'year': metadata.get('year'),
+        'authors': metadata.get('authors') or [],
+    }
+
+def author_name(author):
+    return ', '.join(part for part in (author.get('family'), author.get('given')) if part)
+
+def single_line(text):
+    return ' '.join(str(text).split())
+
+
+###### FORMATS ######
+def format_ris(c):
+    lines = ['TY  - JOUR', f"TI  - {single_line(c['title'])}"]
+    lines += [f'AU  - {single_line(author_name(author))}' for author in c['authors']]
+    if c['journal']:
+        lines.append(f"JO  - {single_line(c['journal'])}")
+    if c['year']:
+        lines.append(f"PY  - {c['year']}")
+    lines += [f"DO  - {c['doi']}", f"UR  - https://doi.org/{c['doi']}", f"L1  - {c['path']}"]
+    if c['other_dois']:
+        lines.append(f"N1  - Other DOIs in file: {'; '.join(c['other_dois'])}")
+    lines.append('ER  - ')
+    return '\n'.join(lines) + '\n\n'
+
+bibtex_special = re.compile(r'([{}\\&%$#_])')
+
+def bibtex_escape(text):
+    return bibtex_special.sub(r'\\\1', single_line(text))
+
+def bibtex_key(c, used):
+    # doi_10_1000_abc_123, with a suffix if two records share a DOI
+    key = 'doi_' + re.sub(r'[^a-z0-9]+', '_', c['doi']).strip('_')
+    count = used.get(key, 0)
+    used[key] = count + 1
+    return key if count == 0 else f'{key}_{count + 1}'
+
+def format_bibtex(c, used):
+    fields = [('title', '{' + bibtex_escape(c['title']) + '}')]
+    if c['authors']:
+        fields.append(('author', ' and '.join(bibtex_escape(author_name(author)) for author in c['authors'])))
+    if c['journal']:
+        fields.append(('journal', bibtex_escape(c['journal'])))
+    if c['year']:
+        fields.append(('year', str(c['year'])))
+    fields += [('doi', c['doi']), ('file', bibtex_escape(c['path']))]
+    if c['other_dois']:
+        fields.append(('note', 'Other DOIs in file: ' + bibtex_escape('; '.join(c['other_dois']))))
+    body = ',\n'.join(f'  {name} = {{{value}}}' for name, value in fields)
+    return f'@article{{{bibtex_key(c, used)},\n{body}\n}}\n\n'
+
+def format_csl(c):
+    item = {'id': c['doi'], 'type': 'article-journal', 'title': c['title'], 'DOI': c['doi'],
+        'URL': f"https://doi.org/{c['doi']}"}
+    if c['authors']:
+        item['author'] = [{key: author[key] for key in ('family', 'given') if author.get(key)} for author in c['authors']]
+    if c['journal']:
+        item['container-title'] = c['journal']
+    if c['year']:
+        item['issued'] = {'date-parts': [[int(c['year'])]]}
+    if c['other_dois']:
+        item['note'] = 'Other DOIs in file: ' + '; '.join(c['other_dois'])
+    return json.dumps(item, ensure_ascii=False)
+
+
+###### EXPORT ######
+def export_records(records, f, fmt, lookup=None):
+    # Writes each record with at least one DOI to the open text file f; returns the number written.
+    # lookup(doi) may return metadata for the citation (or None)
+    count = 0
+    used_keys = {}
+    if fmt == 'csl-json':
+        f.write('[\n')
+    for record in records:
+        if not record['dois']:
+            continue
+        c = citation(record, lookup(record['dois'][0]) if lookup else None)
+        if fmt == 'ris':
+            f.write(format_ris(c))
+        elif fmt == 'bibtex':
+            f.write(format_bibtex(c, used_keys))
+        else:
+            f.write((',\n' if count else '') + format_csl(c))
+        count += 1
+    if fmt == 'csl-json':
+        f.write('\n]\n')
+    return count
+
+def export_index(index, output, fmt=None, statuses=('unique',), lookup=None):
+    # Streams the library index straight to output
+    fmt = export_format(output, fmt)
+    t1 = timer()
+    with open(output, 'w', encoding='utf-8', newline='\n', buffering=write_buffer) as f:
+        count = export_records(index.entries(statuses), f, fmt, lookup)
+    t2 = timer()
+    log.info(f'Exported {count} {fmt} records to {output} in {t2-t1:.1f}s')
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export citations from the medlib library index')
+    parser.add_argument('location', help='library directory or index database file')
+    parser.add_argument('-o', '--output', required=True, help='output file (.ris, .bib or .json)')
+    parser.add_argument('--format', choices=['ris', 'bibtex', 'csl-json'], help='output format (default: from the extension)')
+    parser.add_argument('--metadata', help='metadata index (metadata_index.py) to fill in title, journal, year and authors')
+    parser.add_argument('--include-multiple', action='store_true', help='also export files with several DOIs, using the best candidate')
+    args = parser.parse_args()
+
+    db_path = default_index_path(args.location) if os.path.isdir(args.location) else args.location
+    index = LibraryIndex(db_path)
+    statuses = ('unique', 'multiple') if args.include_multiple else ('unique',)
+    metadata = MetadataIndex(args.metadata) if args.metadata else None
+    export_index(index, args.output, args.format, statuses, metadata.get if metadata else None)
+    index.close()
+    if metadata is not None:
+        metadata.close()
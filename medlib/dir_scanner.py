@@ -0,0 +1,123 @@
+# Incremental directory scanner for medlib
+#   Walks the library with os.scandir (the directory listing already carries
+#   the file type, so there is no isdir() call per entry) and keeps a snapshot
+#   of every PDF's size and mtime. Rescans report only what changed, and a
+#   background poller can feed new downloads straight into the extraction queue.
+import json, os, threading
+
+# For logging
+import logging
+logging.basicConfig(level=logging.CRITICAL, format='%(levelname)-9s: %(name)s : %(funcName)s() : %(message)s')
+log = logging.getLogger('dir_scanner')
+log.setLevel(logging.DEBUG)
+
+
+snapshot_filename = '.medlib_snapshot.json'  # saved next to the library so startup can skip the walk
+
+
+def default_snapshot_path(library_dir):
+    return os.path.join(library_dir, snapshot_filename)
+
+
+class DirScanner():
+    def __init__(self, root, extensions=('.pdf',)):
+        self.root = os.path.abspath(root)
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.snapshot = {}  # path -> (size, mtime_ns)
+        self.lock = threading.Lock()  # the GUI and the watcher thread may rescan at the same time
+
+    def walk(self):
+        # Returns a fresh {path: (size, mtime_ns)} for every matching file under root
+        files = {}
+        pending = [self.root]
+        while pending:
+            directory = pending.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                pending.append(entry.path)
+                            elif entry.name.lower().endswith(self.extensions):
+                                st = entry.stat()
+                                files[entry.path] = (st.st_size, st.st_mtime_ns)
+                        except OSError: # file vanished or is unreadable mid-scan
+                            continue
+            except OSError as ex:
+                log.error(f'Unable to scan {directory} ({type(ex).__name__})')
+        return files
+
+    def scan(self):
+        # Full scan; replaces the snapshot and returns it
+        with self.lock:
+            self.snapshot = self.walk()
+            return self.snapshot
+
+    def rescan(self):
+        # Returns {'added': [...], 'removed': [...], 'changed': [...]} since the last scan
+        with self.lock:
+            current = self.walk()
+            previous = self.snapshot
+            changes = {
+                'added': sorted(path for path in current if path not in previous),
+                'removed': sorted(path for path in previous if path not in current),
+                'changed': sorted(path for path in current if path in previous and current[path] != previous[path]),
+            }
+            self.snapshot = current
+            return changes
+
+    def has_changes(self, changes):
+        return any(changes.values())
+
+
+    ###### SNAPSHOT PERSISTENCE ######
+    def save(self, path):
+        with self.lock:
+            data = {'root': self.root, 'files': dict(self.snapshot)}
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+    def load(self, path):
+        # Returns True if a snapshot for this root was loaded
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if data.get('root') != self.root:
+            return False
+        self.snapshot = {path: tuple(info) for path, info in data['files'].items()}
+        return True
+
+
+class DirWatcher():
+    # Polls a DirScanner on a background thread and hands each non-empty change set to callback
+    def __init__(self, scanner, callback, interval=30):
+        self.scanner = scanner
+        self.callback = callback  # called from the watcher thread; use a queue to reach the GUI
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def is_running(self):
+        return self.thread is not None
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            changes = self.scanner.rescan()
+            if self.scanner.has_changes(changes):
+                log.info(f"{len(changes['added'])} added, {len(changes['removed'])} removed, {len(changes['changed'])} changed")
+                self.callback(changes)
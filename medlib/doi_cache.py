@@ -0,0 +1,274 @@
+# Persistent DOI cache for medlib
+#   Results are keyed by a content hash of the PDF, and each path remembers its
+#   size/mtime so unchanged files are recognized without re-reading them.
+#   Moved or copied files hash to the same key and are also cache hits.
+#   Each result records the extractor that produced it (engine version and text
+#   mode); a lookup by a different extractor is a miss, and its result replaces it.
+#   The database lives on local disk (SQLite locking is unreliable on network shares)
+#   and only one process writes it: extraction workers open it read-only and hand
+#   their writes back to the parent, which applies them in batched transactions.
+import argparse, hashlib, json, os, sqlite3, time
+from urllib.request import pathname2url
+from timeit import default_timer as timer
+
+# For logging
+import logging
+logging.basicConfig(level=logging.CRITICAL, format='%(levelname)-9s: %(name)s : %(funcName)s() : %(message)s')
+log = logging.getLogger('doi_cache')
+log.setLevel(logging.DEBUG)
+
+
+cache_filename = 'doi_cache.sqlite'  # default name inside the library's local data directory
+hash_block_size = 1024 * 1024
+commit_every = 500     # writes per transaction
+commit_interval = 5.0  # seconds a transaction stays open at most (checked on each write)
+
+schema = '''
+CREATE TABLE IF NOT EXISTS files (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+CREATE TABLE IF NOT EXISTS results (
+    hash      TEXT PRIMARY KEY,
+    dois      TEXT NOT NULL,
+    status    TEXT NOT NULL,
+    extractor TEXT NOT NULL DEFAULT '',
+    created   REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS unlocks (
+    hash    TEXT PRIMARY KEY,
+    slot    INTEGER,
+    keyring TEXT NOT NULL
+);
+'''
+
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(hash_block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+write_statements = {
+    'file': 'INSERT OR REPLACE INTO files (path, size, mtime_ns, hash) VALUES (?, ?, ?, ?)',
+    'result': 'INSERT OR REPLACE INTO results (hash, dois, status, extractor, created, last_used) VALUES (?, ?, ?, ?, ?, ?)',
+    'unlock': 'INSERT OR REPLACE INTO unlocks (hash, slot, keyring) VALUES (?, ?, ?)',
+}
+
+
+def user_data_dir():
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'medlib')
+
+def library_data_dir(library_dir):
+    # Per-user directory on local disk for a library's databases, keyed by the library path
+    library_dir = os.path.abspath(library_dir)
+    key = hashlib.sha1(os.path.normcase(library_dir).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(user_data_dir(), f'{os.path.basename(library_dir) or "library"}-{key}')
+
+def default_cache_path(library_dir):
+    return os.path.join(library_data_dir(library_dir), cache_filename)
+
+
+class DOICache():
+    def __init__(self, db_path, readonly=False):
+        # readonly is for extraction workers: writes are queued (take_writes) for the
+        # parent process to apply, and the database must already exist
+        self.db_path = db_path
+        self.readonly = readonly
+        if readonly:
+            self.db = sqlite3.connect(f'file:{pathname2url(os.path.abspath(db_path))}?mode=ro', uri=True, timeout=30)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            # WAL lets the workers read while the parent writes
+            self.db = sqlite3.connect(db_path, timeout=30)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(schema)
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(results)')]
+            if 'extractor' not in columns: # cache written before results recorded their extractor
+                with self.db:
+                    self.db.execute("ALTER TABLE results ADD COLUMN extractor TEXT NOT NULL DEFAULT ''")
+            with self.db: # older caches kept password digests; nothing derived from a password is stored now
+                self.db.execute('DROP TABLE IF EXISTS passwords')
+        self.hashes = {}  # path -> (size, mtime_ns, hash) computed by this connection
+        self.queued = []  # writes waiting for the parent (read-only connections)
+        self.used = {}    # hash -> last_used time, written with the next commit
+        self.pending = 0  # writes since the last commit
+        self.committed = timer()
+
+    def close(self):
+        if not self.readonly:
+            self.commit()
+        self.db.close()
+
+
+    ###### WRITES ######
+    def write(self, kind, *values):
+        if self.readonly:
+            self.queued.append((kind, *values))
+        else:
+            self.apply([(kind, *values)])
+
+    def take_writes(self):
+        # Returns and forgets the writes queued by a read-only connection
+        writes, self.queued = self.queued, []
+        return writes
+
+    def apply(self, writes):
+        # Applies (kind, *values) writes; they are committed every commit_every writes or
+        # commit_interval seconds, and last_used times only once per commit
+        for kind, *values in writes:
+            if kind == 'used':
+                self.used[values[0]] = values[1]
+            else:
+                self.db.execute(write_statements[kind], values)
+                self.pending += 1
+        if self.pending + len(self.used) >= commit_every or timer() - self.committed >= commit_interval:
+            self.commit()
+
+    def commit(self):
+        if self.used:
+            self.db.executemany('UPDATE results SET last_used = ? WHERE hash = ?',
+                [(last_used, file_hash) for file_hash, last_used in self.used.items()])
+            self.used.clear()
+        self.db.commit()
+        self.pending = 0
+        self.committed = timer()
+
+    def file_key(self, path):
+        # Returns the content hash, re-reading the file only if size/mtime changed
+        st = os.stat(path)
+        known = self.hashes.get(path)
+        if known and known[:2] == (st.st_size, st.st_mtime_ns):
+            return known[2]
+
+        row = self.db.execute('SELECT size, mtime_ns, hash FROM files WHERE path = ?', (path,)).fetchone()
+        if row and row[:2] == (st.st_size, st.st_mtime_ns):
+            file_hash = row[2]
+        else:
+            file_hash = hash_file(path)
+            self.write('file', path, st.st_size, st.st_mtime_ns, file_hash)
+
+        self.hashes[path] = (st.st_size, st.st_mtime_ns, file_hash)
+        return file_hash
+
+    def get(self, path, extractor=''):
+        # Returns {'dois': [ranked DOIs], 'status': str} or None on a cache miss
+        #   (including a result from a different extractor)
+        file_hash = self.file_key(path)
+        row = self.db.execute('SELECT dois, status, extractor FROM results WHERE hash = ?', (file_hash,)).fetchone()
+        if row is None or row[2] != extractor:
+            return None
+
+        self.write('used', file_hash, time.time())
+        return {'dois': json.loads(row[0]), 'status': row[1]}
+
+    def put(self, path, dois, status=None, extractor=''):
+        # dois is a ranked list (order is kept) or a set
+        if isinstance(dois, (set, frozenset)):
+            dois = sorted(dois)
+        if status is None:
+            status = 'ok' if dois else 'no_doi'
+        file_hash = self.file_key(path)
+        now = time.time()
+        self.write('result', file_hash, json.dumps(list(dois or [])), status, extractor, now, now)
+
+
+    ###### ENCRYPTED FILES ######
+    def get_unlock(self, path):
+        # Returns (keyring slot, keyring fingerprint) for an encrypted file, or None if never tried.
+        #   The slot is the index of the keyring password that opened the file, or None if none did
+        row = self.db.execute('SELECT slot, keyring FROM unlocks WHERE hash = ?', (self.file_key(path),)).fetchone()
+        return tuple(row) if row else None
+
+    def put_unlock(self, path, slot, keyring):
+        self.write('unlock', self.file_key(path), slot, keyring)
+
+
+    ###### INVALIDATION / EVICTION ######
+    def invalidate(self, path):
+        # Forget the result for a file (and any copies of it) so it is extracted again
+        row = self.db.execute('SELECT hash FROM files WHERE path = ?', (path,)).fetchone()
+        self.hashes.pop(path, None)
+        with self.db:
+            self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+            if row:
+                self.db.execute('DELETE FROM results WHERE hash = ?', (row[0],))
+                self.db.execute('DELETE FROM unlocks WHERE hash = ?', (row[0],))
+
+    def invalidate_status(self, status):
+        # e.g. re-run every file that previously had no DOI after improving the extractor
+        with self.db:
+            return self.db.execute('DELETE FROM results WHERE status = ?', (status,)).rowcount
+
+    def evict(self, older_than_days=None, max_entries=None):
+        # Drop results not used recently, then trim to the most recently used max_entries
+        removed = 0
+        self.commit() # last_used times still held in memory
+        with self.db:
+            if older_than_days is not None:
+                cutoff = time.time() - older_than_days * 86400
+                removed += self.db.execute('DELETE FROM results WHERE last_used < ?', (cutoff,)).rowcount
+            if max_entries is not None:
+                removed += self.db.execute('''DELETE FROM results WHERE hash NOT IN
+                    (SELECT hash FROM results ORDER BY last_used DESC LIMIT ?)''', (max_entries,)).rowcount
+        log.info(f'Evicted {removed} cached results')
+        return removed
+
+    def prune_missing(self):
+        # Remove paths that no longer exist, and results no remaining path refers to
+        missing = [path for (path,) in self.db.execute('SELECT path FROM files') if not os.path.exists(path)]
+        with self.db:
+            self.db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in missing])
+            self.db.execute('DELETE FROM results WHERE hash NOT IN (SELECT hash FROM files)')
+            self.db.execute('DELETE FROM unlocks WHERE hash NOT IN (SELECT hash FROM files)')
+        for path in missing:
+            self.hashes.pop(path, None)
+        log.info(f'Pruned {len(missing)} missing files')
+        return len(missing)
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM files')
+            self.db.execute('DELETE FROM results')
+            self.db.execute('DELETE FROM unlocks')
+        self.hashes.clear()
+
+    def stats(self):
+        files = self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        by_status = dict(self.db.execute('SELECT status, COUNT(*) FROM results GROUP BY status').fetchall())
+        locked = self.db.execute('SELECT COUNT(*) FROM unlocks WHERE slot IS NULL').fetchone()[0]
+        return {'files': files, 'results': sum(by_status.values()), 'by_status': by_status, 'locked': locked}
+
+
+if __name__ == '__main__':
+    # Cache maintenance, e.g. from cron:  python doi_cache.py /library --prune --evict-days 180
+    #   (a library directory stands for its cache in the local data directory)
+    parser = argparse.ArgumentParser(description='Maintain the medlib DOI cache')
+    parser.add_argument('location', help='library directory or cache database file')
+    parser.add_argument('--prune', action='store_true', help='remove entries for files that no longer exist')
+    parser.add_argument('--evict-days', type=float, help='remove results unused for this many days')
+    parser.add_argument('--max-entries', type=int, help='keep at most this many results')
+    parser.add_argument('--invalidate-status', help='remove results with this status (e.g. no_doi)')
+    parser.add_argument('--clear', action='store_true', help='remove everything')
+    args = parser.parse_args()
+
+    db_path = default_cache_path(args.location) if os.path.isdir(args.location) else args.location
+    cache = DOICache(db_path)
+    if args.clear:
+        cache.clear()
+    if args.prune:
+        cache.prune_missing()
+    if args.invalidate_status:
+        cache.invalidate_status(args.invalidate_status)
+    if args.evict_days is not None or args.max_entries is not None:
+        cache.evict(args.evict_days, args.max_entries)
+    print(cache.stats())
+    cache.close()
@@ -0,0 +1,821 @@
+# Process-based DOI extraction engine for medlib
+#   pdfminer is pure python, so threads just fight over the GIL; this runs
+#   the conversions in worker processes (one per core) and streams each
+#   result back to the caller's queue as soon as the file is finished.
+#   SupervisedEngine enforces a per-file timeout: a stuck or crashed worker is
+#   killed and replaced, and the file goes to the failed bucket with the reason.
+import multiprocessing as mp
+from multiprocessing.connection import wait
+
+# For logging
+import logging
+logging.basicConfig(level=logging.CRITICAL, format='%(levelname)-9s: %(name)s : %(funcName)s() : %(message)s')
+log = logging.getLogger('doi_engine')
+log.setLevel(logging.DEBUG)
+
+import os, mmap, heapq, itertools, threading, sqlite3
+from timeit import default_timer as timer
+from doi_cache import DOICache, hash_file
+from pdf_passwords import PDFLocked, load_keyring, keyring_fingerprint, is_encrypted, unlock
+
+# For PDF operations and DOI extraction
+from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfminer.converter import TextConverter
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfdevice import PDFTextDevice
+from pdfminer.pdffont import PDFUnicodeNotDefined
+from pdfminer.layout import LAParams
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdfdocument import PDFDocument, PDFPasswordIncorrect
+from pdfminer.pdftypes import resolve1, PDFStream
+from pdfminer.psparser import PSLiteral
+from pdfminer.utils import decode_text
+from io import StringIO
+from doi_match import DOIMatcher, DOIStreamScanner
+from telemetry import StageTimer
+import re
+
+
+# DOI scanning rule: check the leading pages first and stop as soon as the
+# rule is met; only files with no DOI in those pages get a full scan
+scan_pages = 2  # number of leading pages checked before falling back to a full scan
+min_dois = 1    # stop once this many distinct DOIs are found within scan_pages
+
+file_timeout = 120  # seconds a supervised worker may spend on one file before it is killed
+
+# SupervisedEngine queue priorities; lower runs first, ties in submission order
+selection_priority = 0   # files the user asked for
+background_priority = 1  # whole-library runs and files picked up by the watcher
+
+# Text extraction for the page scan:
+#   layout - pdfminer's full layout analysis (LAParams): lines, boxes, reading order
+#   raw    - characters in content-stream order with spaces/newlines from their positions
+#   auto   - raw for the normal scan, layout for full scans
+text_modes = ('auto', 'raw', 'layout')
+scan_text_mode = 'auto'
+
+# Stored with every cached result; bump it whenever a change to the extraction can
+# change a file's DOIs, so results from the old code are extracted again
+extractor_version = 2
+
+# Raw-byte prescan, run on the memory-mapped file before pdfminer parses anything.
+#   Only DOIs stored as plain bytes are visible (uncompressed streams, link URIs,
+#   metadata), so a result is accepted only when the context leaves no doubt:
+#   metadata  - /doi-style Info keys and XMP DOI tags: any match is taken
+#   link      - /URI https://doi.org/... annotations: only a single distinct DOI
+#               (a linked reference list gives several)
+#   text      - anywhere else: a single distinct DOI, or one that repeats at least
+#               prescan_repeats times and more than twice as often as any other
+# Everything else goes on to the fast tiers and the page scan.
+prescan_repeats = 3
+prescan_context = 64  # bytes before a match that are checked for its context
+#   a match stops at an unescaped bracket, so it ends with the PDF string it is in, e.g.
+#   /doi(10.1016/j.x.2020.01.001)/Subject(...) or (... doi:10.1542/peds.2019-1234.)Tj;
+#   '/' can't end it, as DOI suffixes contain slashes (10.1093/ajcn/nqz123)
+raw_doi_pattern = re.compile(rb'\b10[.][0-9]{4,}(?:[.][0-9]+)*/(?:\\[()]|(?![\\"&\'<>()\[\]])[!-~])+')
+raw_escape = re.compile(rb'\\([()])')
+metadata_context = re.compile(rb'(?:/(?:doi|DOI|WPS-ARTICLEDOI)\s*\(|<(?:prism:doi|pdfx:doi|crossmark:DOI)\b[^>]*>)\s*(?:doi:\s*)?$')
+link_context = re.compile(rb'/URI\s*\(\s*https?://(?:dx\.)?doi\.org/$', re.IGNORECASE)
+hex_string_keys = re.compile(rb'/(URI|doi|DOI|WPS-ARTICLEDOI)\s*<([0-9A-Fa-f\s]{8,4096})>')  # values written as <hex>
+doi_url = re.compile(r'^https?://(?:dx\.)?doi\.org/', re.IGNORECASE)
+
+# Fast tiers, tried in order before any page is laid out:
+#   info - the document Info dictionary (/doi, /Subject, ...)
+#   xmp  - the XMP metadata stream (prism:doi, dc:identifier, ...)
+# (raw bytes are covered by the prescan, which knows where a PDF string ends)
+info_keys = ['doi', 'DOI', 'Subject', 'Keywords', 'Title', 'WPS-ARTICLEDOI']
+xmp_doi_tags = re.compile(rb'<(prism:doi|dc:identifier|pdfx:doi|crossmark:DOI|prism:url)\b[^>]*>(.*?)</\1>', re.DOTALL | re.IGNORECASE)
+
+
+###### WORKER FUNCTIONS ######
+# These run inside the worker processes, so they must stay at module level (picklable)
+def convert_pdf_to_text(path):
+    resource_manager = PDFResourceManager()
+    return_string = StringIO()
+    codec = 'utf-8'
+    laparams = LAParams()
+    device = TextConverter(resource_manager, return_string, codec=codec, laparams=laparams)
+    file_path = open(path, 'rb')
+    interpreter = PDFPageInterpreter(resource_manager, device)
+    password = ""
+    maxpages = 0
+    caching = True
+    pagenos=set()
+
+    filename = os.path.basename(path)
+
+    try:
+        log.info(f'Converting {filename}')
+        for page in PDFPage.get_pages(file_path, pagenos, maxpages=maxpages, password=password,caching=caching, check_extractable=False):
+            interpreter.process_page(page)
+
+        result = return_string.getvalue()
+
+        file_path.close()
+        device.close()
+        return_string.close()
+
+        return result
+    except Exception as ex:
+        log.error(f'Exception of type {type(ex).__name__} thrown on: {path}')
+        pass
+        # PDFPasswordIncorrect
+
+def open_document(file_path, password=''):
+    # Parses only the trailer/xref and catalog; pages are read later by process_pages.
+    #   caching=False keeps pdfminer from holding every parsed object of a large document
+    return PDFDocument(PDFParser(file_path), password=password, caching=False)
+
+class TimedTextConverter(TextConverter):
+    # end_page is where pdfminer runs layout analysis and writes the text out
+    def __init__(self, *args, stages, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stages = stages
+
+    def end_page(self, page):
+        with self.stages.stage('layout'):
+            super().end_page(page)
+
+class TimedStreamScanner(DOIStreamScanner):
+    def __init__(self, stages, **kwargs):
+        super().__init__(**kwargs)
+        self.stages = stages
+
+    def scan(self, final):
+        with self.stages.stage('regex'):
+            super().scan(final)
+
+class RawTextDevice(PDFTextDevice):
+    # Writes characters as the content stream draws them, without building layout objects.
+    #   A character that starts where the previous one ended continues the word; a gap
+    #   along the baseline becomes a space and anything else a newline, which is all the
+    #   DOI regex needs (a DOI is never split across lines by this, nor glued to the next line)
+    def __init__(self, rsrcmgr, outfp):
+        super().__init__(rsrcmgr)
+        self.outfp = outfp
+        self.next_origin = None  # where the next character would start if it continued the word
+        self.direction = (1, 0)
+        self.size = 0
+
+    def begin_page(self, page, ctm):
+        super().begin_page(page, ctm)
+        self.next_origin = None
+
+    def end_page(self, page):
+        self.outfp.write('\n')
+
+    def render_char(self, matrix, font, fontsize, scaling, rise, cid, ncs, graphicstate):
+        (a, b, c, d, e, f) = matrix
+        if self.next_origin is not None:
+            dx, dy = e - self.next_origin[0], f - self.next_origin[1]
+            across = abs(dx * self.direction[1] - dy * self.direction[0])  # distance off the baseline
+            if across > self.size * 0.5:
+                self.outfp.write('\n')
+            elif abs(dx) + abs(dy) > self.size * 0.25:
+                self.outfp.write(' ')
+
+        try:
+            text = font.to_unichr(cid)
+        except PDFUnicodeNotDefined:
+            text = ''
+        advance = font.char_width(cid) * fontsize * scaling
+        self.next_origin = (e + advance * a, f + advance * b)
+        length = (a * a + b * b) ** 0.5 or 1
+        self.direction = (a / length, b / length)
+        self.size = fontsize * ((c * c + d * d) ** 0.5)
+        self.outfp.write(text)
+        return advance
+
+def process_pages(doc, outfp, stages=None, text_mode='layout'):
+    # Runs pdfminer page by page into outfp, yielding after each page so callers can stop early
+    #   page time is split into parse (content stream interpretation) and layout; text_mode='raw'
+    #   skips layout analysis and writes characters as they are drawn (RawTextDevice)
+    stages = stages or StageTimer()
+    resource_manager = PDFResourceManager()
+    if text_mode == 'raw':
+        device = RawTextDevice(resource_manager, outfp)
+    else:
+        device = TimedTextConverter(resource_manager, outfp, codec='utf-8', laparams=LAParams(), stages=stages)
+    interpreter = PDFPageInterpreter(resource_manager, device)
+
+    try:
+        pages = PDFPage.create_pages(doc)
+        page_num = 0
+        while True:
+            with stages.stage('parse'):
+                page = next(pages, None)
+                if page is None:
+                    return
+                interpreter.process_page(page)
+            page_num += 1
+            yield page_num
+    finally:
+        device.close()
+
+
+###### FAST TIERS ######
+def info_dois(doc):
+    matcher = DOIMatcher()
+    for info in doc.info:
+        for key in info_keys:
+            value = resolve1(info.get(key))
+            if isinstance(value, bytes):
+                matcher.feed(decode_text(value))
+            elif isinstance(value, str):
+                matcher.feed(value)
+            elif isinstance(value, PSLiteral):
+                matcher.feed(str(value.name))
+        if matcher:
+            break
+    return matcher.ranked()
+
+def xmp_dois(doc):
+    metadata = resolve1(doc.catalog.get('Metadata'))
+    if not isinstance(metadata, PDFStream):
+        return []
+
+    matcher = DOIMatcher()
+    for tag, value in xmp_doi_tags.findall(metadata.get_data()):
+        matcher.feed(value.decode('utf-8', 'ignore'))
+    return matcher.ranked()
+
+def prescan_dois(path):
+    # Returns (dois, context) from the raw bytes of the file, or ([], None) if undecided.
+    #   The file is memory-mapped and searched in place; only the matches are copied.
+    matchers = {'metadata': DOIMatcher(), 'link': DOIMatcher(), 'text': DOIMatcher()}
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return [], None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for match in raw_doi_pattern.finditer(data):
+                before = data[max(0, match.start() - prescan_context):match.start()]
+                if metadata_context.search(before):
+                    context = 'metadata'
+                elif link_context.search(before):
+                    context = 'link'
+                else:
+                    context = 'text'
+                matchers[context].add(raw_escape.sub(rb'\1', match.group()).decode('ascii'))
+            for match in hex_string_keys.finditer(data):
+                hex_digits = b''.join(match.group(2).split())
+                value = decode_text(bytes.fromhex((hex_digits + b'0' * (len(hex_digits) % 2)).decode('ascii')))
+                if match.group(1) != b'URI':
+                    matchers['metadata'].feed(value)
+                elif doi_url.match(value):
+                    matchers['link'].feed(value)
+
+    if matchers['metadata']:
+        return matchers['metadata'].ranked(), 'metadata'
+    if len(matchers['link']) == 1:
+        return matchers['link'].ranked(), 'link'
+    text = matchers['text']
+    ranked = text.ranked()
+    if len(ranked) == 1:
+        return ranked, 'text'
+    if ranked:
+        top, runner_up = text.counts[ranked[0]], text.counts[ranked[1]]
+        if top >= prescan_repeats and top > 2 * runner_up:
+            return ranked, 'text'
+    return [], None
+
+def fast_tier_dois(doc):
+    # Returns (dois, tier) from the first tier that finds something, or ([], None)
+    for tier, lookup in (('info', lambda: info_dois(doc)), ('xmp', lambda: xmp_dois(doc))):
+        try:
+            dois = lookup()
+        except Exception as ex: # damaged metadata shouldn't stop the text scan
+            log.debug(f'{tier} tier skipped ({type(ex).__name__})')
+            continue
+        if dois:
+            return dois, tier
+    return [], None
+
+
+def resolve_text_mode(text_mode=None, full_scan=False):
+    text_mode = text_mode or scan_text_mode
+    if text_mode == 'auto':
+        text_mode = 'layout' if full_scan else 'raw'
+    return text_mode
+
+def extractor_name(text_mode=None):
+    # Cache key for results of get_dois (a normal scan) with this text mode
+    return f'engine-{extractor_version}/{resolve_text_mode(text_mode)}'
+
+def scan_pdf_for_doi(path, scan_pages=scan_pages, min_dois=min_dois, full_scan=False, use_metadata=True, stages=None,
+        text_mode=None, password=''):
+    # Returns the DOIs found, ranked with the most likely article DOI first, or False if there were none
+    #   the raw bytes and then the metadata are checked first (use_metadata); otherwise text is scanned as pdfminer emits it
+    #   (DOIStreamScanner), so no page or document text is kept. Time per stage goes to stages.
+    filename = os.path.basename(path)
+    stages = stages or StageTimer()
+    text_mode = resolve_text_mode(text_mode, full_scan)
+    sink = TimedStreamScanner(stages)
+    found = sink.matcher
+
+    if use_metadata and not full_scan:
+        with stages.stage('prescan'):
+            dois, context = prescan_dois(path)
+        if dois:
+            log.info(f'Found in raw bytes ({context}): {filename}')
+            return dois
+
+    try:
+        with open(path, 'rb') as file_path:
+            with stages.stage('open'):
+                doc = open_document(file_path, password)
+
+            if use_metadata and not full_scan:
+                with stages.stage('metadata'):
+                    dois, tier = fast_tier_dois(doc)
+                if dois:
+                    log.info(f'Found in {tier}: {filename}')
+                    return dois
+                file_path.seek(0)
+
+            log.info(f'Scanning {filename}')
+            for page_num in process_pages(doc, sink, stages, text_mode):
+                sink.end_page()
+                if full_scan:
+                    continue
+
+                if page_num <= scan_pages:
+                    # rule met within the leading pages; the rest of the file isn't needed
+                    if len(found) >= min_dois:
+                        break
+                elif found:
+                    # full-scan fallback; stop at the first page that yields a DOI
+                    break
+    except Exception as ex:
+        log.error(f'Exception of type {type(ex).__name__} thrown on: {path}')
+        if not found: # nothing usable; let the caller file it as failed
+            raise
+
+    if not found:
+        return False
+    else:
+        return found.ranked()
+
+def extract_doi(path, full_scan=False, stages=None, text_mode=None, password=''):
+    # full_scan=True reads every page instead of stopping at the first page(s) with a DOI
+    return scan_pdf_for_doi(path, full_scan=full_scan, stages=stages, text_mode=text_mode, password=password)
+
+caches = {}  # one DOICache connection per database, opened lazily in each worker process
+readonly_caches = False  # set in supervised workers; their cache writes go back to the parent
+
+def get_cached_doi(path, cache_path, extractor=''):
+    # Returns (cache, dois); dois is None on a miss or if the cache is unusable
+    try:
+        if cache_path not in caches:
+            caches[cache_path] = DOICache(cache_path, readonly=readonly_caches)
+        cache = caches[cache_path]
+        entry = cache.get(path, extractor)
+    except (sqlite3.Error, OSError) as ex:
+        log.error(f'Cache unavailable ({type(ex).__name__}) for: {path}')
+        return None, None
+
+    if entry is None:
+        return cache, None
+    return cache, (entry['dois'] or False)
+
+def remember_password(cache, path, slot, keyring):
+    if cache is None:
+        return
+    try:
+        cache.put_unlock(path, slot, keyring)
+    except (sqlite3.Error, OSError) as ex:
+        log.error(f'Unable to cache password outcome ({type(ex).__name__}) for: {path}')
+
+def known_password(path, cache, keyring_path=None):
+    # Password an encrypted file opened with before ('' if unknown or not encrypted);
+    #   raises PDFLocked straight away if the keyring failed on this file and hasn't changed since
+    if cache is None or not is_encrypted(path):
+        return ''
+    try:
+        known = cache.get_unlock(path)
+    except (sqlite3.Error, OSError):
+        return ''
+    if known is None:
+        return ''
+
+    slot, tried = known
+    if tried != keyring_fingerprint(keyring_path):
+        return '' # keyring edited since; the slot may point at another password
+    if slot is None:
+        raise PDFLocked('No keyring password opens the file')
+    passwords = load_keyring(keyring_path)
+    return passwords[slot] if slot < len(passwords) else ''
+
+def keyring_password(path, cache, keyring_path=None):
+    # After the empty password failed: the first keyring password that opens the file.
+    #   The outcome is remembered per file hash, so locked files aren't parsed again on rescans
+    keyring = keyring_fingerprint(keyring_path)
+    passwords = load_keyring(keyring_path)
+    try:
+        password = unlock(path, passwords)
+    except PDFLocked:
+        remember_password(cache, path, None, keyring)
+        raise
+    remember_password(cache, path, passwords.index(password), keyring)
+    return password
+
+def get_dois(path, cache_path=None, stages=None, text_mode=None, keyring_path=None):
+    # Cache lookup first; extracted results are written back to the cache.
+    #   Encrypted files get the password that worked before, or else the empty password and then the keyring
+    stages = stages or StageTimer()
+    extractor = extractor_name(text_mode)
+    with stages.stage('cache'):
+        cache, dois = get_cached_doi(path, cache_path, extractor) if cache_path else (None, None)
+    if dois is None:
+        with stages.stage('open'):
+            password = known_password(path, cache, keyring_path)
+        try:
+            dois = extract_doi(path, stages=stages, text_mode=text_mode, password=password)
+        except PDFPasswordIncorrect:
+            with stages.stage('open'):
+                password = keyring_password(path, cache, keyring_path)
+            dois = extract_doi(path, stages=stages, text_mode=text_mode, password=password)
+        if cache is not None:
+            try:
+                with stages.stage('cache'):
+                    cache.put(path, dois, extractor=extractor)
+            except (sqlite3.Error, OSError) as ex:
+                log.error(f'Unable to cache result ({type(ex).__name__}) for: {path}')
+    return dois
+
+def content_hash(path, cache_path=None):
+    # Content hash for the library index; the cache connection already hashed the file
+    try:
+        if cache_path in caches:
+            return caches[cache_path].file_key(path)
+        return hash_file(path)
+    except (sqlite3.Error, OSError) as ex:
+        log.error(f'Unable to hash ({type(ex).__name__}): {path}')
+        return None
+
+def describe_error(ex):
+    return f'{type(ex).__name__}: {ex}'[:200]
+
+def is_failed(result):
+    # works for both result shapes (process_file records and process_node GUI results)
+    return result.get('status') == 'failed' or result.get('target') == 'failed_tree'
+
+def failed_file_result(path, reason, seconds=None):
+    return {'path': path, 'dois': [], 'status': 'failed', 'seconds': seconds, 'reason': reason}
+
+def failed_node_result(node, reason, seconds=None):
+    return {'origin_id': node[0], 'target': 'failed_tree', 'text': os.path.basename(node[2]), 'path': node[2], 'info': reason}
+
+def locked_file_result(path, reason, seconds=None):
+    return {'path': path, 'dois': [], 'status': 'locked', 'seconds': seconds, 'reason': reason}
+
+def locked_node_result(node, reason):
+    return {'origin_id': node[0], 'target': 'locked_tree', 'text': os.path.basename(node[2]), 'path': node[2], 'info': reason}
+
+def process_file(path, cache_path=None, text_mode=None, keyring_path=None, hash_content=True):
+    # Headless counterpart of process_node; returns one flat record per PDF.
+    #   hash_content=False leaves out the content hash, which only the library index uses
+    t1 = timer()
+    stages = StageTimer()
+    try:
+        dois = get_dois(path, cache_path, stages, text_mode, keyring_path)
+    except PDFLocked as ex:
+        result = locked_file_result(path, str(ex), round(timer()-t1, 3))
+    except Exception as ex:
+        result = failed_file_result(path, describe_error(ex), round(timer()-t1, 3))
+    else:
+        if dois:
+            status = 'unique' if len(dois) == 1 else 'multiple'
+        else:
+            status = 'none'
+        result = {'path': path, 'dois': list(dois or []), 'status': status, 'seconds': round(timer()-t1, 3), 'reason': ''}
+
+    if hash_content:
+        with stages.stage('hash'):
+            result['hash'] = content_hash(path, cache_path)
+    result['timings'] = stages.timings()
+    return result
+
+def process_node(node, cache_path=None, text_mode=None, keyring_path=None, hash_content=True):
+    node_id = node[0]
+    node_name = node[1]
+    path = node[2]
+    filename = os.path.basename(path)
+
+    stages = StageTimer()
+    try:
+        dois = get_dois(path, cache_path, stages, text_mode, keyring_path)
+    except PDFLocked as ex:
+        result = locked_node_result(node, str(ex))
+    except Exception as ex:
+        result = failed_node_result(node, describe_error(ex))
+    else:
+        if dois:
+            if len(dois) == 1: # only 1 DOI
+                doi = dois[0]
+                result = {'origin_id': node_id, 'target': 'doi_tree', 'text': filename, 'path': path, 'info': doi}
+            else: # more than 1 DOI; the first is the best candidate
+                result = {'origin_id': node_id, 'target': 'more_doi_tree', 'text': filename, 'path': path, 'info': dois}
+        else: # no DOIs
+            result = {'origin_id': node_id, 'target': 'no_doi_tree', 'text': filename, 'path': path, 'info': ''}
+
+    if hash_content:
+        with stages.stage('hash'):
+            result['hash'] = content_hash(path, cache_path)
+    result['timings'] = stages.timings()
+    return result
+
+
+###### SUPERVISED ENGINE ######
+def supervised_worker(conn, task_function, cache_path):
+    # Worker process loop: one task in, one result out, until it receives None.
+    #   The cache is only read here; its writes travel with the result to the parent
+    global readonly_caches
+    readonly_caches = True
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        result = task_function(task, cache_path)
+        if cache_path in caches:
+            result['cache_writes'] = caches[cache_path].take_writes()
+        conn.send(result)
+
+
+class SupervisedWorker():
+    def __init__(self, task_function, cache_path):
+        # each worker has its own pipe, so killing it can't corrupt a queue shared with the others
+        self.conn, child_conn = mp.Pipe()
+        self.process = mp.Process(target=supervised_worker, args=(child_conn, task_function, cache_path), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.cache_path = cache_path
+        self.task = None
+        self.started = None
+
+    def assign(self, task):
+        self.task = task
+        self.started = timer()
+        self.conn.send(task)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.kill()
+
+
+class SupervisedEngine():
+    # Tasks are handed out one at a time by a supervisor thread that enforces the
+    # per-file timeout.
+    #   The queue is a priority heap: a selection submitted during a long background run
+    #   is handed out next. A file is never queued or run twice at once, and the queue
+    #   can be paused, resumed and cancelled without touching the files already running.
+    def __init__(self, result_queue, num_workers=None, cache_path=None, timeout=file_timeout,
+                 task_function=process_node, failure_function=failed_node_result, task_path=lambda node: node[2]):
+        self.result_queue = result_queue
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.cache_path = cache_path
+        self.timeout = timeout  # None or 0 disables the timeout (crashes are still isolated)
+        self.task_function = task_function        # process_node (GUI) or process_file (CLI)
+        self.failure_function = failure_function  # builds the result for a killed/crashed task
+        self.task_path = task_path
+        self.cache = None     # the parent's DOICache connection, the only one that writes
+        self.pending = []     # heap of [priority, sequence, task]; superseded entries have task None
+        self.queued = {}      # task path -> its live heap entry
+        self.running = set()  # task paths assigned to a worker
+        self.sequence = itertools.count()
+        self.paused = False
+        self.workers = []
+        self.in_flight = 0    # queued + running
+        self.done = 0     # finished in the current batch
+        self.failed = 0   # of which failed
+        self.batch_started = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            log.info(f'Starting {self.num_workers} supervised workers (timeout {self.timeout}s)')
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def submit(self, tasks, priority=selection_priority):
+        # Returns the number of tasks added; files already running are skipped and files
+        # already queued are only moved up if this priority is more urgent
+        added = 0
+        with self.lock:
+            if self.in_flight == 0: # a new batch; counters start over
+                self.done = self.failed = 0
+                self.batch_started = timer()
+            for task in tasks:
+                path = self.task_path(task)
+                if path in self.running:
+                    continue
+                entry = self.queued.get(path)
+                if entry is not None:
+                    if entry[0] <= priority:
+                        continue
+                    entry[2] = None # left in the heap and skipped when popped
+                else:
+                    self.in_flight += 1
+                    added += 1
+                entry = [priority, next(self.sequence), task]
+                heapq.heappush(self.pending, entry)
+                self.queued[path] = entry
+        self.start()
+        self.wakeup.set()
+        return added
+
+    def next_task(self):
+        # Pops the most urgent live task; the caller holds the lock
+        while self.pending:
+            task = heapq.heappop(self.pending)[2]
+            if task is not None:
+                path = self.task_path(task)
+                del self.queued[path]
+                self.running.add(path)
+                return task
+        return None
+
+    def cancel(self, paths=None):
+        # Drops queued tasks (all of them, or those whose path is in paths) and returns them;
+        # files already running are left to finish
+        with self.lock:
+            cancelled = []
+            for path, entry in list(self.queued.items()):
+                if paths is None or path in paths:
+                    cancelled.append(entry[2])
+                    entry[2] = None
+                    del self.queued[path]
+            if not self.queued:
+                self.pending = []
+            self.in_flight -= len(cancelled)
+        return cancelled
+
+    def pause(self):
+        # Stops handing out queued tasks; files already running still finish
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        with self.lock:
+            self.paused = False
+        self.wakeup.set()
+
+    def is_paused(self):
+        with self.lock:
+            return self.paused
+
+    def is_busy(self):
+        with self.lock:
+            return self.in_flight > 0
+
+    def progress(self):
+        # Live counters for the current batch: queued, in_flight, done, failed, paused, files_per_s, eta_s
+        with self.lock:
+            queued = len(self.queued)
+            running = len(self.running)
+            done, failed, paused = self.done, self.failed, self.paused
+            elapsed = timer() - self.batch_started if self.batch_started else 0
+        rate = (done + failed) / elapsed if elapsed > 0 and done + failed else None
+        return {'queued': queued, 'in_flight': running, 'done': done, 'failed': failed, 'paused': paused,
+            'files_per_s': rate, 'eta_s': (queued + running) / rate if rate and not paused else None}
+
+    def shutdown(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+        with self.lock:
+            self.pending = []
+            self.queued.clear()
+            self.running.clear()
+            self.in_flight = 0
+
+
+    ###### SUPERVISOR THREAD ######
+    def run(self):
+        try:
+            self.supervise()
+        finally:
+            self.close_cache()
+
+    def supervise(self):
+        while not self.stop_event.is_set():
+            self.assign_tasks()
+            busy = [worker for worker in self.workers if worker.task is not None]
+            if not busy:
+                self.wakeup.wait(0.5)
+                self.wakeup.clear()
+                continue
+
+            for conn in wait([worker.conn for worker in busy], timeout=0.1):
+                worker = next(worker for worker in busy if worker.conn is conn)
+                try:
+                    result = conn.recv()
+                except (EOFError, OSError): # died mid-task; handled by check_workers
+                    continue
+                self.finish(worker.task, result, worker)
+
+            self.check_workers()
+
+    def open_cache(self):
+        # Opened before the workers start, so the database exists when they open it read-only
+        cache_path = self.cache_path
+        if self.cache is not None and self.cache.db_path == cache_path:
+            return
+        self.close_cache()
+        if cache_path:
+            try:
+                self.cache = DOICache(cache_path)
+            except (sqlite3.Error, OSError) as ex:
+                log.error(f'Cache unavailable ({type(ex).__name__}): {cache_path}')
+
+    def close_cache(self):
+        if self.cache is not None:
+            try:
+                self.cache.close()
+            except sqlite3.Error as ex:
+                log.error(f'Unable to save cached results ({type(ex).__name__})')
+            self.cache = None
+
+    def assign_tasks(self):
+        # idle workers are restarted when the cache path changes (a new library was loaded)
+        self.open_cache()
+        for worker in list(self.workers):
+            if worker.task is None and worker.cache_path != self.cache_path:
+                worker.stop()
+                self.workers.remove(worker)
+
+        while len(self.workers) < self.num_workers:
+            self.workers.append(SupervisedWorker(self.task_function, self.cache_path))
+
+        for worker in self.workers:
+            if worker.task is None:
+                with self.lock:
+                    task = None if self.paused else self.next_task()
+                if task is None:
+                    return
+                worker.assign(task)
+
+    def check_workers(self):
+        now = timer()
+        for worker in list(self.workers):
+            if worker.task is None:
+                continue
+
+            elapsed = now - worker.started
+            if self.timeout and elapsed > self.timeout:
+                reason = f'Timed out after {self.timeout}s'
+            elif not worker.process.is_alive():
+                reason = f'Worker exited with code {worker.process.exitcode}'
+            else:
+                continue
+
+            log.error(f'{reason}: {self.task_path(worker.task)}')
+            task = worker.task
+            worker.kill()
+            self.workers.remove(worker) # replaced on the next assign_tasks
+            self.finish(task, self.failure_function(task, reason, round(elapsed, 3)))
+
+    def finish(self, task, result, worker=None):
+        if worker is not None:
+            worker.task = None
+        writes = result.pop('cache_writes', None)
+        if writes and self.cache is not None and worker.cache_path == self.cache.db_path:
+            try:
+                self.cache.apply(writes)
+            except sqlite3.Error as ex:
+                log.error(f'Unable to cache result ({type(ex).__name__}) for: {self.task_path(task)}')
+        self.result_queue.put(result)
+        with self.lock:
+            self.running.discard(self.task_path(task))
+            self.in_flight -= 1
+            if is_failed(result):
+                self.failed += 1
+            else:
+                self.done += 1
+            idle = self.in_flight == 0
+        if idle and self.cache is not None: # batch done; nothing is left uncommitted
+            try:
+                self.cache.commit()
+            except sqlite3.Error as ex:
+                log.error(f'Unable to save cached results ({type(ex).__name__})')
@@ -0,0 +1,151 @@
+# DOI matcher for medlib
+#   The pattern is compiled once at import. Matches are normalized (trailing
+#   punctuation stripped, casefolded; DOIs are case-insensitive) so that
+#   '10.1000/ABC.' and '10.1000/abc' count as one DOI, then ranked so the
+#   article's own DOI comes first and references follow as alternates.
+import io, re
+
+# regex pattern for DOI, see: https://stackoverflow.com/questions/27910/finding-a-doi-in-a-document-or-page
+#   no trailing \b, so DOIs ending in a bracket, e.g. 10.1016/0140-6736(93)x), can be balanced below
+doi_pattern = re.compile(r'\b10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?!["&\'<>])\S)+')
+
+trailing_punctuation = '.,;:'
+closing_brackets = {')': '(', ']': '['}
+
+
+def normalize_doi(doi):
+    # Strip trailing punctuation and unbalanced closing brackets, then casefold
+    while doi:
+        last = doi[-1]
+        if last in trailing_punctuation:
+            doi = doi[:-1]
+        elif last in closing_brackets and doi.count(last) > doi.count(closing_brackets[last]):
+            doi = doi[:-1]
+        else:
+            break
+    return doi.casefold()
+
+
+def find_dois(text):
+    # All normalized DOIs in text, in order of appearance (with repeats)
+    dois = []
+    for match in doi_pattern.finditer(text):
+        doi = normalize_doi(match.group())
+        if '/' in doi and not doi.endswith('/'):
+            dois.append(doi)
+    return dois
+
+
+class DOIMatcher():
+    # Accumulates matches over one or more chunks of text (e.g. one page at a time)
+    def __init__(self):
+        self.counts = {}      # doi -> number of occurrences
+        self.first_seen = {}  # doi -> position of the first occurrence across all chunks
+        self.position = 0
+
+    def feed(self, text):
+        # Returns the DOIs that were new in this chunk
+        new = []
+        for match in doi_pattern.finditer(text):
+            doi = self.add(match.group())
+            if doi:
+                new.append(doi)
+        return new
+
+    def add(self, raw):
+        # Counts one raw regex match; returns the normalized DOI if it hadn't been seen before
+        doi = normalize_doi(raw)
+        if '/' not in doi or doi.endswith('/'):
+            return None
+
+        is_new = doi not in self.counts
+        if is_new:
+            self.counts[doi] = 0
+            self.first_seen[doi] = self.position
+        self.counts[doi] += 1
+        self.position += 1
+        return doi if is_new else None
+
+    def __len__(self):
+        return len(self.counts)
+
+    def ranked(self):
+        # Most frequent first (the article DOI repeats in headers/footers), earliest first on ties
+        return sorted(self.counts, key=lambda doi: (-self.counts[doi], self.first_seen[doi]))
+
+    def primary(self):
+        ranked = self.ranked()
+        return ranked[0] if ranked else None
+
+    def alternates(self):
+        return self.ranked()[1:]
+
+
+class DOIStreamScanner(io.TextIOBase):
+    # Write-only text sink (e.g. the outfp of pdfminer's TextConverter) that scans
+    # for DOIs as text arrives instead of keeping the whole document. Text is held
+    # in a rolling window; a match is only counted once the text after it is known,
+    # and anything that might continue past the window is carried over, so DOIs split
+    # across chunk boundaries are still found exactly once. A match longer than the
+    # overlap isn't a DOI (e.g. a DOI prefix glued to a long run of text) and is
+    # dropped rather than carried, so memory stays at about window + 2 * overlap
+    # characters regardless of document size.
+    def __init__(self, matcher=None, window=64 * 1024, overlap=512):
+        super().__init__()
+        self.matcher = matcher if matcher is not None else DOIMatcher()
+        self.window = window
+        self.overlap = overlap  # longer than any real DOI
+        self.chunks = []  # text written since the last scan, joined only when scanning
+        self.size = 0     # total length of chunks
+        self.skip = 0  # leading characters of chunks that were already scanned
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        # pdfminer writes a character at a time; appending to a string here would be quadratic
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.window + self.overlap:
+            self.scan(final=False)
+        return len(text)
+
+    def end_page(self):
+        # DOIs don't run across pages, so the buffer can be scanned and emptied
+        self.scan(final=True)
+
+    def close(self):
+        self.scan(final=True)
+        super().close()
+
+    def scan(self, final):
+        text = ''.join(self.chunks)
+        limit = len(text) if final else len(text) - self.overlap
+        keep_from = limit
+        for match in doi_pattern.finditer(text, self.skip):
+            if match.end() - match.start() > self.overlap:
+                continue # longer than any real DOI
+            if not final and match.end() >= limit:
+                # might continue in the next chunk; rescan it from its start
+                keep_from = min(keep_from, match.start())
+                break
+            self.matcher.add(match.group())
+
+        if final:
+            self.chunks = []
+            self.size = 0
+            self.skip = 0
+        else:
+            if keep_from > 0:
+                # keep one already-scanned character so \b sees what came before the carried text
+                text = text[keep_from - 1:]
+                self.skip = 1
+            self.chunks = [text]
+            self.size = len(text)
+
+
+def match_dois(text):
+    # Returns (primary, alternates) for a block of text; primary is None if nothing matched
+    matcher = DOIMatcher()
+    matcher.feed(text)
+    return matcher.primary(), matcher.alternates()
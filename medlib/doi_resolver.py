@@ -0,0 +1,397 @@
+# Online DOI metadata resolver for medlib
+#   Resolves the DOIs found by extract_doi through an HTTP metadata service
+#   (Crossref or OpenAlex, or anything with the same API at another base URL).
+#   Requests run concurrently on asyncio with a bounded number of pooled
+#   keep-alive connections, an optional requests-per-second limit, retries with
+#   exponential backoff (honouring Retry-After), and a persistent SQLite response
+#   cache with a TTL. A MetadataIndex can be consulted first so the service is only
+#   asked about DOIs the offline snapshot doesn't have.
+#   python doi_resolver.py 10.1542/pir.31-1-3 10.1000/xyz
+#   python doi_resolver.py --results results.jsonl -o enriched.jsonl --rate 20
+#   python doi_resolver.py --demo    (runs against a local stub server)
+import argparse, asyncio, http.client, json, os, random, sqlite3, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlsplit
+
+# For logging
+import logging
+logging.basicConfig(level=logging.CRITICAL, format='%(levelname)-9s: %(name)s : %(funcName)s() : %(message)s')
+log = logging.getLogger('doi_resolver')
+log.setLevel(logging.DEBUG)
+
+# For timing operations
+from timeit import default_timer as timer
+
+from metadata_index import MetadataIndex, crossref_metadata, openalex_metadata, strip_doi
+
+
+concurrency = 8        # requests in flight (and pooled connections per host)
+max_retries = 4        # attempts after the first for 429/5xx/connection errors
+backoff = 0.5          # seconds before the first retry; doubles each time
+request_timeout = 20   # seconds
+cache_ttl_days = 30    # found DOIs
+missing_ttl_days = 1   # DOIs the service didn't know, in case they were just registered
+retry_statuses = {429, 500, 502, 503, 504}
+user_agent = 'medlib-doi-resolver/1.0'
+
+cache_schema = '''
+CREATE TABLE IF NOT EXISTS responses (
+    url     TEXT PRIMARY KEY,
+    status  INTEGER NOT NULL,
+    body    TEXT NOT NULL,
+    fetched REAL NOT NULL
+) WITHOUT ROWID;
+'''
+
+
+###### BACKENDS ######
+class CrossrefBackend():
+    def __init__(self, base_url='https://api.crossref.org', mailto=None):
+        self.base_url = base_url.rstrip('/')
+        self.mailto = mailto  # Crossref's "polite pool" for identified clients
+
+    def url(self, doi):
+        url = f'{self.base_url}/works/{quote(doi, safe="")}'
+        return url + f'?mailto={quote(self.mailto)}' if self.mailto else url
+
+    def parse(self, body):
+        return crossref_metadata(json.loads(body)['message'])
+
+
+class OpenAlexBackend():
+    def __init__(self, base_url='https://api.openalex.org', mailto=None):
+        self.base_url = base_url.rstrip('/')
+        self.mailto = mailto
+
+    def url(self, doi):
+        url = f'{self.base_url}/works/doi:{quote(doi, safe="/")}'
+        return url + f'?mailto={quote(self.mailto)}' if self.mailto else url
+
+    def parse(self, body):
+        return openalex_metadata(json.loads(body))
+
+
+backends = {'crossref': CrossrefBackend, 'openalex': OpenAlexBackend}
+
+
+###### HTTP ######
+class ConnectionPool():
+    # Keep-alive http.client connections, reused per host by the request threads
+    def __init__(self, size=concurrency, timeout=request_timeout):
+        self.size = size
+        self.timeout = timeout
+        self.idle = {}  # (scheme, netloc) -> [connection]
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        with self.lock:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def put(self, scheme, netloc, conn):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def fetch(self, url):
+        # Blocking GET; returns (status, headers, body text)
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        conn = self.get(parts.scheme, parts.netloc)
+        try:
+            conn.request('GET', path, headers={'User-Agent': user_agent, 'Accept': 'application/json'})
+            response = conn.getresponse()
+            body = response.read().decode('utf-8', errors='replace')
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        self.put(parts.scheme, parts.netloc, conn)
+        return response.status, dict(response.getheaders()), body
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+
+class RateLimiter():
+    # Spaces request starts at least 1/rate seconds apart; pause() holds everyone back after a 429
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        now = asyncio.get_running_loop().time()
+        self.next_time = max(self.next_time, now + seconds)
+
+
+###### CACHE ######
+class ResponseCache():
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(cache_schema)
+
+    def get(self, url):
+        # Returns (status, body) if a fresh response is cached
+        row = self.db.execute('SELECT status, body, fetched FROM responses WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        ttl = cache_ttl_days if row[0] == 200 else missing_ttl_days
+        if time.time() - row[2] > ttl * 86400:
+            return None
+        return row[0], row[1]
+
+    def put(self, url, status, body):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO responses (url, status, body, fetched) VALUES (?, ?, ?, ?)',
+                (url, status, body, time.time()))
+
+    def close(self):
+        self.db.close()
+
+
+###### RESOLVER ######
+def resolved(doi, status, metadata=None, reason=''):
+    # status is 'ok', 'not_found' or 'error'
+    return {'doi': doi, 'status': status, 'metadata': metadata, 'reason': reason}
+
+
+class DOIResolver():
+    def __init__(self, backend=None, cache_path=None, concurrency=concurrency, rate=None,
+            retries=max_retries, offline=None):
+        self.backend = backend or CrossrefBackend()
+        self.cache = ResponseCache(cache_path) if cache_path else None
+        self.concurrency = concurrency
+        self.rate = rate  # requests per second; None for no limit beyond concurrency
+        self.retries = retries
+        self.offline = offline  # MetadataIndex checked before the network
+        self.pool = ConnectionPool(concurrency)
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.stats = {'offline': 0, 'cached': 0, 'fetched': 0, 'retried': 0}
+
+    def close(self):
+        self.executor.shutdown()
+        self.pool.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    async def resolve_many(self, dois):
+        # {doi: result} for an iterable of DOIs (e.g. the sets extract_doi returns, chained)
+        dois = list(dict.fromkeys(strip_doi(doi) for doi in dois))
+        results = {}
+        if self.offline is not None:
+            for doi, metadata in self.offline.resolve_many(dois).items():
+                results[doi] = resolved(doi, 'ok', metadata)
+            self.stats['offline'] += len(results)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limiter = RateLimiter(self.rate)
+
+        async def resolve_one(doi):
+            async with semaphore:
+                results[doi] = await self.resolve(doi, limiter)
+
+        await asyncio.gather(*(resolve_one(doi) for doi in dois if doi not in results))
+        return results
+
+    async def resolve(self, doi, limiter):
+        url = self.backend.url(doi)
+        cached = self.cache.get(url) if self.cache is not None else None
+        if cached is not None:
+            self.stats['cached'] += 1
+            return self.result(doi, *cached)
+
+        loop = asyncio.get_running_loop()
+        delay = backoff
+        for attempt in range(self.retries + 1):
+            await limiter.wait()
+            try:
+                status, headers, body = await loop.run_in_executor(self.executor, self.pool.fetch, url)
+            except (OSError, http.client.HTTPException) as ex:
+                status, headers, body = None, {}, f'{type(ex).__name__}: {ex}'
+
+            if status not in retry_statuses and status is not None:
+                break
+            if attempt == self.retries:
+                return resolved(doi, 'error', reason=f'HTTP {status}' if status else body[:200])
+
+            # back off; a Retry-After from the service applies to every request, not just this one
+            retry_after = headers.get('Retry-After')
+            wait = float(retry_after) if retry_after and retry_after.isdigit() else delay * (1 + random.random())
+            if status == 429:
+                limiter.pause(wait)
+            self.stats['retried'] += 1
+            log.debug(f'Retrying {doi} in {wait:.1f}s ({status or body[:60]})')
+            await asyncio.sleep(wait)
+            delay *= 2
+
+        self.stats['fetched'] += 1
+        if self.cache is not None and status in (200, 404):
+            self.cache.put(url, status, body)
+        return self.result(doi, status, body)
+
+    def result(self, doi, status, body):
+        if status == 404:
+            return resolved(doi, 'not_found')
+        if status != 200:
+            return resolved(doi, 'error', reason=f'HTTP {status}')
+        try:
+            return resolved(doi, 'ok', self.backend.parse(body))
+        except (ValueError, KeyError, TypeError, AttributeError) as ex:
+            return resolved(doi, 'error', reason=f'Unreadable response ({type(ex).__name__})')
+
+
+def resolve_dois(dois, **kwargs):
+    # Synchronous entry point: {doi: result}
+    resolver = DOIResolver(**kwargs)
+    try:
+        t1 = timer()
+        results = asyncio.run(resolver.resolve_many(dois))
+        t2 = timer()
+        log.info(f'Resolved {len(results)} DOIs in {t2-t1:.1f}s {resolver.stats}')
+        return results
+    finally:
+        resolver.close()
+
+
+###### STUB SERVER ######
+def start_stub_server(works, flaky=(), broken=(), retry_after='0', latency=0):
+    # Local Crossref-style server for trying the resolver without network access:
+    # works maps DOI -> Crossref item; DOIs in flaky answer 503 (with retry_after) to their
+    # first request, DOIs in broken always answer 500, and every reply takes latency seconds.
+    #   server.requests lists (time, DOI) per request; server.max_in_flight is the most
+    #   requests it was handling at once
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import unquote
+    failed_once = set()
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, like the real services
+
+        def do_GET(self):
+            doi = unquote(urlsplit(self.path).path[len('/works/'):]).casefold()
+            with lock:
+                server.requests.append((time.monotonic(), doi))
+                server.in_flight += 1
+                server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            if latency:
+                time.sleep(latency)
+            with lock: # counted until the reply is sent, so never longer than the client waits
+                server.in_flight -= 1
+                first_failure = doi in flaky and doi not in failed_once
+                failed_once.add(doi)
+            if first_failure:
+                self.reply(503, {'status': 'error'})
+            elif doi in broken:
+                self.reply(500, {'status': 'error'})
+            elif doi in works:
+                self.reply(200, {'status': 'ok', 'message': works[doi]})
+            else:
+                self.reply(404, {'status': 'error', 'message': 'Resource not found.'})
+
+        def reply(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if status == 503:
+                self.send_header('Retry-After', retry_after)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = []
+    server.in_flight = 0
+    server.max_in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def demo(count=2000):
+    works = {f'10.5555/demo.{i}': {'DOI': f'10.5555/demo.{i}', 'title': [f'Demo article {i}'],
+        'container-title': ['Journal of Demos'], 'issued': {'date-parts': [[2000 + i % 25]]},
+        'author': [{'family': 'Doe', 'given': 'Jane'}]} for i in range(count)}
+    flaky = {'10.5555/demo.7', '10.5555/demo.42'}
+    server = start_stub_server(works, flaky)
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+    dois = list(works) + [f'10.5555/missing.{i}' for i in range(count // 10)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, 'responses.sqlite')
+        for label in ('cold', 'cached'):
+            results = resolve_dois(dois, backend=CrossrefBackend(base_url), cache_path=cache_path, concurrency=16)
+            counts = {}
+            for result in results.values():
+                counts[result['status']] = counts.get(result['status'], 0) + 1
+            print(label, counts)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resolve DOIs through an HTTP metadata service')
+    parser.add_argument('dois', nargs='*', help='DOIs to resolve')
+    parser.add_argument('--results', help='medlib_cli JSONL whose DOIs should be resolved')
+    parser.add_argument('-o', '--output', help='write the results (with metadata) as JSONL here')
+    parser.add_argument('--backend', choices=sorted(backends), default='crossref')
+    parser.add_argument('--base-url', help="service base URL (default: the backend's public API)")
+    parser.add_argument('--mailto', help='contact address sent to the service')
+    parser.add_argument('--cache', default='.medlib_resolver.sqlite', help='response cache database')
+    parser.add_argument('--offline', help='metadata index to check before the service')
+    parser.add_argument('-c', '--concurrency', type=int, default=concurrency)
+    parser.add_argument('--rate', type=float, help='maximum requests per second')
+    parser.add_argument('--demo', action='store_true', help='resolve generated DOIs against a local stub server')
+    args = parser.parse_args()
+
+    if args.demo:
+        demo()
+        raise SystemExit
+
+    records = []
+    dois = list(args.dois)
+    if args.results:
+        with open(args.results) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        dois += [doi for record in records for doi in record['dois']]
+
+    backend_args = {'base_url': args.base_url} if args.base_url else {}
+    offline = MetadataIndex(args.offline) if args.offline else None
+    results = resolve_dois(dois, backend=backends[args.backend](mailto=args.mailto, **backend_args),
+        cache_path=args.cache, concurrency=args.concurrency, rate=args.rate, offline=offline)
+
+    out = open(args.output, 'w') if args.output else None
+    if records:
+        for record in records:
+            record['resolved'] = [doi for doi in record['dois'] if results[doi]['status'] == 'ok']
+            first = results[record['dois'][0]] if record['dois'] else None
+            record['metadata'] = first['metadata'] if first else None
+            print(json.dumps(record, ensure_ascii=False), file=out)
+    else:
+        for result in results.values():
+            print(json.dumps(result, ensure_ascii=False), file=out)
+    if out is not None:
+        out.close()
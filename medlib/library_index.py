@@ -0,0 +1,235 @@
+# Library index for medlib
+#   Every extraction run records each file's path, content hash, status and ranked
+#   DOIs here, so questions about the whole library are single indexed queries:
+#   which files share a DOI, which files are byte-identical copies, and what was
+#   added, changed or removed in the last run.
+import argparse, json, os, sqlite3, time
+
+# For logging
+import logging
+logging.basicConfig(level=logging.CRITICAL, format='%(levelname)-9s: %(name)s : %(funcName)s() : %(message)s')
+log = logging.getLogger('library_index')
+log.setLevel(logging.DEBUG)
+
+from doi_match import normalize_doi
+from doi_cache import library_data_dir
+
+
+index_filename = 'library.sqlite'  # default name inside the library's local data directory
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    root     TEXT,
+    started  REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    path        TEXT PRIMARY KEY,
+    hash        TEXT,
+    status      TEXT NOT NULL,
+    dois        TEXT NOT NULL,
+    first_run   INTEGER NOT NULL,
+    changed_run INTEGER NOT NULL,
+    seen_run    INTEGER NOT NULL,
+    removed_run INTEGER
+);
+CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash);
+CREATE INDEX IF NOT EXISTS entries_first ON entries (first_run);
+CREATE INDEX IF NOT EXISTS entries_changed ON entries (changed_run);
+CREATE INDEX IF NOT EXISTS entries_removed ON entries (removed_run);
+CREATE TABLE IF NOT EXISTS entry_dois (
+    path TEXT NOT NULL,
+    doi  TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    PRIMARY KEY (path, doi)
+);
+CREATE INDEX IF NOT EXISTS entry_dois_doi ON entry_dois (doi, rank);
+'''
+
+
+def default_index_path(library_dir):
+    # on local disk like the DOI cache; SQLite locking is unreliable on network shares
+    return os.path.join(library_data_dir(library_dir), index_filename)
+
+
+class LibraryIndex():
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(schema)
+        self.run_id = None
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def commit(self):
+        # record() and remove() don't commit; callers commit once per batch
+        self.db.commit()
+
+
+    ###### RUNS ######
+    def begin_run(self, root=None):
+        with self.db:
+            self.run_id = self.db.execute('INSERT INTO runs (root, started) VALUES (?, ?)', (root, time.time())).lastrowid
+        return self.run_id
+
+    def end_run(self):
+        if self.run_id is None:
+            return
+        with self.db:
+            self.db.execute('UPDATE runs SET finished = ? WHERE id = ?', (time.time(), self.run_id))
+        self.run_id = None
+
+    def last_run(self):
+        row = self.db.execute('SELECT MAX(id) FROM runs').fetchone()
+        return row[0]
+
+
+    ###### RECORDING ######
+    def record(self, path, file_hash, status, dois):
+        # dois is the ranked list for the file; the entry is marked changed only if
+        # its content, status or DOIs differ from what the index already holds
+        if self.run_id is None:
+            self.begin_run()
+        run_id = self.run_id
+        dois = list(dois or [])
+        encoded = json.dumps(dois)
+
+        row = self.db.execute('SELECT hash, status, dois, removed_run FROM entries WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            self.db.execute('''INSERT INTO entries (path, hash, status, dois, first_run, changed_run, seen_run)
+                VALUES (?, ?, ?, ?, ?, ?, ?)''', (path, file_hash, status, encoded, run_id, run_id, run_id))
+        elif row[:3] != (file_hash, status, encoded) or row[3] is not None:
+            self.db.execute('''UPDATE entries SET hash = ?, status = ?, dois = ?, changed_run = ?, seen_run = ?,
+                removed_run = NULL WHERE path = ?''', (file_hash, status, encoded, run_id, run_id, path))
+        else:
+            self.db.execute('UPDATE entries SET seen_run = ? WHERE path = ?', (run_id, path))
+            return
+
+        self.db.execute('DELETE FROM entry_dois WHERE path = ?', (path,))
+        self.db.executemany('INSERT OR IGNORE INTO entry_dois (path, doi, rank) VALUES (?, ?, ?)',
+            [(path, doi, rank) for rank, doi in enumerate(dois)])
+
+    def remove(self, paths):
+        # Files deleted from the library stay in the index, marked with the run that noticed
+        if self.run_id is None:
+            self.begin_run()
+        self.db.executemany('UPDATE entries SET removed_run = ? WHERE path = ? AND removed_run IS NULL',
+            [(self.run_id, path) for path in paths])
+        self.db.executemany('DELETE FROM entry_dois WHERE path = ?', [(path,) for path in paths])
+
+    def prune_missing(self):
+        # Marks indexed files that no longer exist on disk as removed
+        missing = [path for (path,) in self.db.execute('SELECT path FROM entries WHERE removed_run IS NULL')
+            if not os.path.exists(path)]
+        self.remove(missing)
+        self.commit()
+        log.info(f'Marked {len(missing)} missing files as removed')
+        return len(missing)
+
+
+    ###### QUERIES ######
+    def get(self, path):
+        row = self.db.execute('SELECT hash, status, dois FROM entries WHERE path = ? AND removed_run IS NULL', (path,)).fetchone()
+        if row is None:
+            return None
+        return {'path': path, 'hash': row[0], 'status': row[1], 'dois': json.loads(row[2])}
+
+    def entries(self, statuses=None):
+        # Streams {'path', 'hash', 'status', 'dois'} for every file in the library, ordered by path
+        query = 'SELECT path, hash, status, dois FROM entries WHERE removed_run IS NULL'
+        params = ()
+        if statuses:
+            query += f" AND status IN ({', '.join('?' * len(statuses))})"
+            params = tuple(statuses)
+        for path, file_hash, status, dois in self.db.execute(query + ' ORDER BY path', params):
+            yield {'path': path, 'hash': file_hash, 'status': status, 'dois': json.loads(dois)}
+
+    def files_with_doi(self, doi, primary_only=False):
+        # Paths whose DOIs include doi; with primary_only, only files where it is the best candidate
+        query = 'SELECT path FROM entry_dois WHERE doi = ?' + (' AND rank = 0' if primary_only else '') + ' ORDER BY path'
+        return [path for (path,) in self.db.execute(query, (normalize_doi(doi),))]
+
+    def identical_files(self, path):
+        # Other paths with the same content as path
+        return [other for (other,) in self.db.execute('''SELECT path FROM entries WHERE hash =
+            (SELECT hash FROM entries WHERE path = ?) AND path != ? AND removed_run IS NULL ORDER BY path''', (path, path))]
+
+    def duplicate_files(self):
+        # {hash: [paths]} for content that exists more than once in the library
+        duplicates = {}
+        for file_hash, path in self.db.execute('''SELECT hash, path FROM entries WHERE removed_run IS NULL AND hash IN
+                (SELECT hash FROM entries WHERE removed_run IS NULL AND hash IS NOT NULL GROUP BY hash HAVING COUNT(*) > 1)
+                ORDER BY hash, path'''):
+            duplicates.setdefault(file_hash, []).append(path)
+        return duplicates
+
+    def duplicate_dois(self):
+        # {doi: [paths]} for DOIs that are the primary DOI of more than one distinct file;
+        # byte-identical copies are already reported by duplicate_files
+        duplicates = {}
+        for doi, path in self.db.execute('''SELECT d.doi, d.path FROM entry_dois d WHERE d.rank = 0 AND d.doi IN
+                (SELECT d2.doi FROM entry_dois d2 JOIN entries e ON e.path = d2.path
+                 WHERE d2.rank = 0 GROUP BY d2.doi HAVING COUNT(DISTINCT COALESCE(e.hash, e.path)) > 1)
+                ORDER BY d.doi, d.path'''):
+            duplicates.setdefault(doi, []).append(path)
+        return duplicates
+
+    def changes(self, run_id=None):
+        # {'added': [...], 'changed': [...], 'removed': [...]} recorded by run_id (default: the last run)
+        if run_id is None:
+            run_id = self.last_run()
+        added = [path for (path,) in self.db.execute('''SELECT path FROM entries WHERE first_run = ?
+            AND removed_run IS NULL ORDER BY path''', (run_id,))]
+        changed = [path for (path,) in self.db.execute('''SELECT path FROM entries WHERE changed_run = ?
+            AND first_run != ? AND removed_run IS NULL ORDER BY path''', (run_id, run_id))]
+        removed = [path for (path,) in self.db.execute('SELECT path FROM entries WHERE removed_run = ? ORDER BY path', (run_id,))]
+        return {'added': added, 'changed': changed, 'removed': removed}
+
+    def stats(self):
+        files = self.db.execute('SELECT COUNT(*) FROM entries WHERE removed_run IS NULL').fetchone()[0]
+        by_status = dict(self.db.execute('SELECT status, COUNT(*) FROM entries WHERE removed_run IS NULL GROUP BY status').fetchall())
+        runs = self.db.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+        return {'files': files, 'by_status': by_status, 'runs': runs}
+
+
+if __name__ == '__main__':
+    # Library queries, e.g.:  python library_index.py /library --duplicates
+    parser = argparse.ArgumentParser(description='Query the medlib library index')
+    parser.add_argument('location', help='library directory or index database file')
+    parser.add_argument('--doi', help='list files containing this DOI')
+    parser.add_argument('--duplicates', action='store_true', help='list byte-identical files and files sharing a primary DOI')
+    parser.add_argument('--changes', nargs='?', const=0, type=int, metavar='RUN', help='list what changed in a run (default: the last)')
+    parser.add_argument('--prune', action='store_true', help='mark files that no longer exist as removed')
+    args = parser.parse_args()
+
+    db_path = default_index_path(args.location) if os.path.isdir(args.location) else args.location
+    index = LibraryIndex(db_path)
+    if args.prune:
+        index.prune_missing()
+    if args.doi:
+        for path in index.files_with_doi(args.doi):
+            print(path)
+    if args.duplicates:
+        print('# Identical files')
+        for file_hash, paths in index.duplicate_files().items():
+            print(file_hash)
+            for path in paths:
+                print(f'  {path}')
+        print('# Files sharing a primary DOI')
+        for doi, paths in index.duplicate_dois().items():
+            print(doi)
+            for path in paths:
+                print(f'  {path}')
+    if args.changes is not None:
+        for kind, paths in index.changes(args.changes or None).items():
+            for path in paths:
+                print(f'{kind}\t{path}')
+    if not (args.doi or args.duplicates or args.changes is not None):
+        print(index.stats())
+    index.close()
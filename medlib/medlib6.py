@@ -1,5 +1,4 @@
-# This version uses map and pool for multithreading
-from multiprocessing.dummy import Pool as ThreadPool
+# This version uses supervised worker processes (doi_engine) and streams results to the UI
 
 # For logging
 import logging
@@ -8,7 +7,8 @@ log = logging.getLogger('medlib')
 log.setLevel(logging.DEBUG)
 
 # For user interface
-import os, threading, queue, time
+import os, threading, queue, time, sqlite3
+from collections import deque
 import tkinter as tk
 from tkinter import ttk, filedialog
 
@@ -17,89 +17,29 @@ from timeit import default_timer as timer
 from functools import reduce
 
 # For PDF operations and DOI extraction
-from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
-from pdfminer.converter import TextConverter
-from pdfminer.pdfpage import PDFPage
-from pdfminer.layout import LAParams
-from io import StringIO
-import re
+from doi_engine import SupervisedEngine, extract_doi, file_timeout, selection_priority, background_priority
+from doi_cache import DOICache, default_cache_path
+from dir_scanner import DirScanner, DirWatcher, default_snapshot_path
+from library_index import LibraryIndex, default_index_path
+from citation_export import export_index, export_records, export_format, write_buffer
+from telemetry import RunStats, format_progress
+
+watch_interval = 30  # seconds between polls when watching the library for new files
+update_interval = 100  # milliseconds between UI updates from the result queue
+update_budget = 0.05   # seconds of each update spent applying results, so the UI stays responsive
+min_rows_per_update = 200  # rows inserted per update even when the budget is spent
+result_trees = ('doi_tree', 'more_doi_tree', 'no_doi_tree', 'failed_tree', 'locked_tree')
+summary_filename = '.medlib_last_run.json'  # machine-readable summary of the last batch, next to the library
+tree_status = {'doi_tree': 'unique', 'more_doi_tree': 'multiple', 'no_doi_tree': 'none', 'failed_tree': 'failed',
+    'locked_tree': 'locked'}
 
 
 ###### HELPER FUNCTIONS ######
-def convert_pdf_to_text(path):
-    resource_manager = PDFResourceManager()
-    return_string = StringIO()
-    codec = 'utf-8'
-    laparams = LAParams()
-    device = TextConverter(resource_manager, return_string, codec=codec, laparams=laparams)
-    file_path = open(path, 'rb')
-    interpreter = PDFPageInterpreter(resource_manager, device)
-    password = ""
-    maxpages = 0
-    caching = True
-    pagenos=set()
-
-    filename = os.path.basename(path)
-
-    #for page in PDFPage.get_pages(file_path, pagenos, maxpages=maxpages, password=password,caching=caching, check_extractable=True):
-    try:
-        log.info(f'Converting {filename}')
-        for page in PDFPage.get_pages(file_path, pagenos, maxpages=maxpages, password=password,caching=caching, check_extractable=False):
-            interpreter.process_page(page)
-
-        result = return_string.getvalue()
-
-        file_path.close()
-        device.close()
-        return_string.close()
-
-        return result
-    except Exception as ex:
-        log.error(f'Exception of type {type(ex).__name__} thrown on: {path}')
-        pass
-        # PDFPasswordIncorrect
-
-def extract_doi(path):
-    # Look into limiting what goes in the try block
-    pdf = convert_pdf_to_text(path)
-    regx = r'\b(10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?!["&\'<>])\S)+)\b'
-    try:
-        all_doi = re.findall(regx, pdf)
-        unique = set(all_doi)
-        if not unique:
-            return False
-        else:
-            return unique
-    except Exception as ex:
-        log.error(f'Exception of type {type(ex).__name__} thrown on: {path}')
-        pass
-
-
-
 def format_elapsed_time(t):
         return "%d:%02d:%02d.%03d" % \
             reduce(lambda ll,b : divmod(ll[0],b) + ll[1:],
                 [(t*1000,),1000,60,60])
 
-def process_node(node):
-    node_id = node[0]
-    node_name = node[1]
-    path = node[2]
-    filename = os.path.basename(path)
-    
-    dois = extract_doi(path)
-
-    if dois: 
-        if len(dois) == 1: # only 1 DOI
-            doi = min(dois)
-            result = {'origin_id': node_id, 'target': 'doi_tree', 'text': filename, 'path': path, 'info': doi}
-        else: # more than 1 DOI
-            result = {'origin_id': node_id, 'target': 'more_doi_tree', 'text': filename, 'path': path, 'info': dois}
-    else: # no DOIs
-        result = {'origin_id': node_id, 'target': 'no_doi_tree', 'text': filename, 'path': path, 'info': ''}
-
-    return result
-
 
 class ScrollTree(tk.Frame):
     def __init__(self, parent, item_label, info_label):
@@ -196,7 +136,26 @@ class MedLib():
         # setup queues and start listening
         self.q = queue.Queue()
         self.tree_update_queue = queue.Queue()
-        self.master.after(100, self.update_trees)
+        self.pending_rows = {name: deque() for name in result_trees}  # results waiting to be inserted
+        self.master.after(update_interval, self.update_trees)
+
+        # setup the extraction engine (one process per core); stuck files are killed after file_timeout
+        self.engine = SupervisedEngine(self.tree_update_queue, timeout=file_timeout)
+        self.t1 = None
+        self.stats = RunStats()  # per-stage timings and counts for the current batch
+        self.index = None  # LibraryIndex of the loaded library; every result is recorded there
+        self.master.protocol('WM_DELETE_WINDOW', self.on_close)
+
+        # setup the directory scanner; changes found on rescan/watch come back through watch_queue
+        self.scanner = None
+        self.watcher = None
+        self.dir_nodes = {}   # directory path -> dir_tree node
+        self.file_nodes = {}  # PDF path -> dir_tree node
+        self.remaining = {}   # directory path -> number of unprocessed PDFs under it
+        self.processed = set()  # PDF paths detached from dir_tree after extraction
+        self.dirty_dirs = set()  # directories whose count label is out of date
+        self.watch_queue = queue.Queue()
+        self.master.after(500, self.check_watch_queue)
         
         # start the UI loop
         self.master.mainloop()
@@ -208,13 +167,21 @@ class MedLib():
         toolbar.pack(fill=tk.X, expand=False, anchor=tk.N)
         tk.Button(toolbar, text='Load directory', command=self.on_load).pack(side=tk.LEFT, padx=3, pady=3)
         tk.Button(toolbar, text='Process selection', command=self.on_process).pack(side=tk.LEFT, padx=3, pady=3)
+        tk.Button(toolbar, text='Process all', command=self.on_process_all).pack(side=tk.LEFT, padx=3, pady=3)
+        self.pause_button = tk.Button(toolbar, text='Pause', command=self.on_pause)
+        self.pause_button.pack(side=tk.LEFT, padx=3, pady=3)
+        tk.Button(toolbar, text='Cancel', command=self.on_cancel).pack(side=tk.LEFT, padx=3, pady=3)
         tk.Button(toolbar, text='Reset', command=self.on_reset).pack(side=tk.LEFT, padx=3, pady=3)
+        tk.Button(toolbar, text='Clear cache', command=self.on_clear_cache).pack(side=tk.LEFT, padx=3, pady=3)
+        self.watch_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(toolbar, text='Watch for new files', variable=self.watch_var, command=self.on_toggle_watch).pack(side=tk.LEFT, padx=3, pady=3)
         tk.Button(toolbar, text='Build report', command=self.on_build_report).pack(side=tk.RIGHT, padx=3, pady=3)
         tk.Button(toolbar, text='Export citations', command=self.on_export).pack(side=tk.RIGHT, padx=3, pady=3)
 
     def setup_workspace(self, master):
         workspace = ttk.Notebook(master)
         workspace.pack(fill=tk.BOTH, expand=True, padx=3, pady=1)
+        self.workspace = workspace
 
         self.dir_tree_frame = ScrollTree(workspace, 'Directory', 'Status')
         self.dir_tree_frame.pack(fill=tk.BOTH, expand=True)
@@ -235,10 +202,22 @@ class MedLib():
         self.no_doi_tree_frame.pack(fill=tk.BOTH, expand=True)
         self.no_doi_tree = self.no_doi_tree_frame.tree
 
+        self.failed_tree_frame = ScrollTree(workspace, 'File', 'Reason')
+        self.failed_tree_frame.pack(fill=tk.BOTH, expand=True)
+        self.failed_tree = self.failed_tree_frame.tree
+
+        self.locked_tree_frame = ScrollTree(workspace, 'File', 'Reason')
+        self.locked_tree_frame.pack(fill=tk.BOTH, expand=True)
+        self.locked_tree = self.locked_tree_frame.tree
+
         workspace.add(self.dir_tree_frame, text='  Unprocessed  ')
         workspace.add(self.doi_tree_frame, text='  Unique DOIs  ')
         workspace.add(self.more_doi_tree_frame, text='  Multiple DOIs  ')
         workspace.add(self.no_doi_tree_frame, text='  No DOIs  ')
+        workspace.add(self.failed_tree_frame, text='  Failed  ')
+        workspace.add(self.locked_tree_frame, text='  Locked  ')
+        self.tree_frames = {'doi_tree': self.doi_tree_frame, 'more_doi_tree': self.more_doi_tree_frame,
+            'no_doi_tree': self.no_doi_tree_frame, 'failed_tree': self.failed_tree_frame, 'locked_tree': self.locked_tree_frame}
 
     def setup_statusbar(self, master):
         status_bar = ttk.Frame(master, relief=tk.SUNKEN)
@@ -252,37 +231,140 @@ class MedLib():
 
         self.elapsed = tk.Label(status_bar, text='')
         self.elapsed.pack(side=tk.RIGHT, padx=3)
+
+        self.progress = tk.Label(status_bar, text='')
+        self.progress.pack(side=tk.LEFT, padx=3)
         
     def populate_dir_tree(self):
         # clear the existing tree
         self.dir_tree.delete(*self.dir_tree.get_children())
-
-        # populate tree with directories and PDF files
-        for directory, subdir_list, file_list in os.walk(self.work_dir):
-            node = self.dir_tree.insert('', 'end', text=directory)
-            self.dir_tree.set(node, 'fullpath', directory)
-
-            for file in file_list:
-                if file.endswith('.pdf'):
-                    pdf_path = os.path.join(directory, file)
-                    pdf_node = self.dir_tree.insert(node, 'end', text=file)
-                    self.dir_tree.set(pdf_node, 'fullpath', pdf_path)
-
-        # remove directories without PDFs (i.e., those without children)
-        for child in self.dir_tree.get_children():
-            if not self.dir_tree.get_children(child):
-                self.dir_tree.detach(child)
+        self.dir_nodes = {}
+        self.file_nodes = {}
+        self.remaining = {}
+        self.processed = set()
+        self.dirty_dirs = set()
+
+        # show the saved snapshot right away and reconcile it with the disk in the background;
+        # without a snapshot the first scan has to finish before anything is shown
+        self.scanner = DirScanner(self.work_dir)
+        if self.scanner.load(default_snapshot_path(self.work_dir)):
+            self.add_pdf_nodes(sorted(self.scanner.snapshot))
+            threading.Thread(target=self.background_rescan, daemon=True).start()
+        else:
+            self.add_pdf_nodes(sorted(self.scanner.scan()))
+            self.save_snapshot()
 
         # update the info column with files remaining for each directory
         self.update_dir_tree_counts()
 
+    def add_pdf_nodes(self, paths):
+        # directories only get a node once they contain a PDF
+        for pdf_path in paths:
+            directory = os.path.dirname(pdf_path)
+            node = self.dir_nodes.get(directory)
+            if node is None:
+                node = self.dir_tree.insert('', 'end', text=directory)
+                self.dir_tree.set(node, 'fullpath', directory)
+                self.dir_nodes[directory] = node
+
+            pdf_node = self.dir_tree.insert(node, 'end', text=os.path.basename(pdf_path))
+            self.dir_tree.set(pdf_node, 'fullpath', pdf_path)
+            self.file_nodes[pdf_path] = pdf_node
+            self.remaining[directory] = self.remaining.get(directory, 0) + 1
+            self.dirty_dirs.add(directory)
+
+    def remove_pdf_nodes(self, paths):
+        for pdf_path in paths:
+            directory = os.path.dirname(pdf_path)
+            pdf_node = self.file_nodes.pop(pdf_path, None)
+            if pdf_node is not None:
+                self.dir_tree.delete(pdf_node)
+                if pdf_path in self.processed:
+                    self.processed.discard(pdf_path)
+                else:
+                    self.remaining[directory] -= 1
+                    self.dirty_dirs.add(directory)
+
+            node = self.dir_nodes.get(directory)
+            if node is not None and not self.dir_tree.get_children(node):
+                self.dir_tree.delete(node)
+                del self.dir_nodes[directory]
+                self.remaining.pop(directory, None)
+                self.dirty_dirs.discard(directory)
+
+    def mark_unprocessed(self, pdf_path):
+        # a processed file goes back to the unprocessed list
+        pdf_node = self.file_nodes.get(pdf_path)
+        directory = os.path.dirname(pdf_path)
+        parent = self.dir_nodes.get(directory)
+        if pdf_node is None or parent is None:
+            return
+        self.dir_tree.move(pdf_node, parent, 'end')
+        if pdf_path in self.processed:
+            self.processed.discard(pdf_path)
+            self.remaining[directory] += 1
+            self.dirty_dirs.add(directory)
+
+    def mark_processed(self, pdf_path, pdf_node):
+        # results can arrive for a file that was removed from the library meanwhile
+        if self.file_nodes.get(pdf_path) != pdf_node or pdf_path in self.processed:
+            return
+        directory = os.path.dirname(pdf_path)
+        self.dir_tree.detach(pdf_node)
+        self.processed.add(pdf_path)
+        self.remaining[directory] -= 1
+        self.dirty_dirs.add(directory)
+
+    def save_snapshot(self):
+        try:
+            self.scanner.save(default_snapshot_path(self.work_dir))
+        except OSError as ex: # read-only share; the next load just does a full scan
+            log.error(f'Unable to save directory snapshot ({type(ex).__name__})')
+
+    def background_rescan(self):
+        # runs off the UI thread; results are applied by check_watch_queue
+        scanner = self.scanner
+        changes = scanner.rescan()
+        if scanner.has_changes(changes):
+            self.watch_queue.put((scanner, changes))
+
+    def check_watch_queue(self):
+        # This loop applies directory changes every 500 milliseconds
+        try:
+            while True:
+                scanner, changes = self.watch_queue.get(0)
+                if scanner is not self.scanner: # left over from a library that is no longer loaded
+                    continue
+
+                self.remove_pdf_nodes(changes['removed'])
+                if self.index is not None:
+                    self.index.remove(changes['removed'])
+                    self.index.commit()
+                self.add_pdf_nodes(changes['added'])
+
+                # a modified file goes back to the unprocessed list (re-attach if already processed)
+                for pdf_path in changes['changed']:
+                    self.mark_unprocessed(pdf_path)
+
+                # new downloads go straight to the extraction engine while watching
+                if self.watch_var.get():
+                    new_nodes = [(self.file_nodes[pdf_path], os.path.basename(pdf_path), pdf_path)
+                        for pdf_path in changes['added'] + changes['changed'] if pdf_path in self.file_nodes]
+                    self.submit_nodes(new_nodes, background_priority)
+
+                self.save_snapshot()
+                self.update_dir_tree_counts()
+
+        except queue.Empty:
+            self.master.after(500, self.check_watch_queue)
+
     def update_dir_tree_counts(self):
-        for child in self.dir_tree.get_children():
-            path = self.dir_tree.set(child, 'fullpath')
-            if os.path.isdir(path):
-                num_children = len(self.dir_tree.get_children(child))
-                msg = f'{num_children} remaining'
-                self.dir_tree.set(child, 'info', msg)
+        # only the directories whose count changed since the last update are touched
+        for directory in self.dirty_dirs:
+            node = self.dir_nodes.get(directory)
+            if node is not None:
+                self.dir_tree.set(node, 'info', f'{self.remaining[directory]} remaining')
+        self.dirty_dirs.clear()
 
 
     ###### BUTTON FUNCTIONS ######
@@ -290,22 +372,23 @@ class MedLib():
         result = tk.filedialog.askdirectory(initialdir = os.getcwd(), 
             title = 'Select directory')
         
-        if result is None: 
+        if not result: # cancelled (askdirectory returns an empty string)
             return
         else:
+            if self.watcher is not None: # the old library is no longer watched
+                self.watcher.stop()
+                self.watcher = None
+                self.watch_var.set(False)
+            self.clear_results() # old jobs would otherwise run against the new cache and index
             self.work_dir = result  # update the working directory
+            self.engine.cache_path = default_cache_path(self.work_dir)  # DOI cache is kept on local disk, per library
+            self.open_index()
             self.populate_dir_tree()
         
     def on_process(self):
         # setup the data
         node_queue = []
 
-        # Start the timer
-        t1 = timer()
-        self.status.config(text='  Status:  WORKING ...')
-        self.elapsed.config(text=f'Elapsed:  WORKING ...')
-        self.master.update()
-
         # Populate the queue from the selected items
         if self.dir_tree.selection():
             for node in self.dir_tree.selection():
@@ -314,82 +397,174 @@ class MedLib():
                         node_id = child
                         node_name = self.dir_tree.item(child)['text']
                         node_path = self.dir_tree.set(child, 'fullpath')
-                        #self.q.put((node_id, node_name, node_path))
                         node_queue.append((node_id, node_name, node_path))
                 else: 
                     node_id = node
                     node_name = self.dir_tree.item(node)['text']
                     node_path = self.dir_tree.set(node, 'fullpath')
-                    #self.q.put((node_id, node_name, node_path))
                     node_queue.append((node_id, node_name, node_path))
 
-        num_workers = 100
-        pool = ThreadPool(num_workers)
-
-        results = pool.map(process_node, node_queue)
-        pool.close()
-        pool.join() # waits until ALL tasks are completed
-        # omitting .join() lets each process/thread run independently, 
-        # but will mess up the total time elapsed since it's no longer considering it as one process
-        
-        t2 = timer()
-        log.info(f'Total elapsed: {format_elapsed_time(t2-t1)}')
-        
-        # Do something with the results
-        
-        for result in results:
-            print(result)
-        
-        
-        # Start the worker threads
-        '''items_in_queue = len(list(self.q.queue))
-        if items_in_queue <= 200:
-            num_workers = items_in_queue
+        # the selection goes ahead of any background run still queued
+        self.submit_nodes(node_queue, selection_priority)
+
+    def on_process_all(self):
+        # every unprocessed file in the library, behind anything the user selects meanwhile
+        node_queue = [(pdf_node, os.path.basename(pdf_path), pdf_path)
+            for pdf_path, pdf_node in self.file_nodes.items() if pdf_path not in self.processed]
+        self.submit_nodes(node_queue, background_priority)
+
+    def on_pause(self):
+        if self.engine.is_paused():
+            self.engine.resume()
+            self.pause_button.config(text='Pause')
+            if self.t1 is not None:
+                self.status.config(text='  Status:  WORKING ...')
         else:
-            num_workers = 200 # hard cap
-        log.info(f'Number of threads for current batch: {num_workers}')
-
-        # start the workers
-        for i in range(num_workers):
-            NodeWorker(self.q, self.tree_update_queue).start()'''
+            self.engine.pause()
+            self.pause_button.config(text='Resume')
+            if self.t1 is not None:
+                self.status.config(text='  Status:  PAUSED')
+
+    def on_cancel(self):
+        # queued files stay in the unprocessed list; files already running finish normally,
+        #   and update_trees ends the batch (and its index run) once their results are in
+        cancelled = self.engine.cancel()
+        log.info(f'Cancelled {len(cancelled)} queued files')
+        if self.engine.is_paused():
+            self.on_pause()
+
+    def submit_nodes(self, node_queue, priority=selection_priority):
+        if not node_queue:
+            return
 
-        # Block until the queue is empty/work done; this freezes the GUI
-        # Omitting it lets you interact with the GUI, but messes up timer
-        #self.q.join() 
+        # Start the timer; files left running by a reset don't belong to this batch
+        if self.t1 is None:
+            self.t1 = timer()
+            self.stats.reset()
+            if self.index is not None:
+                self.index.begin_run(self.work_dir)
+        self.status.config(text='  Status:  PAUSED' if self.engine.is_paused() else '  Status:  WORKING ...')
+        self.elapsed.config(text=f'Elapsed:  WORKING ...')
 
+        # Hand the batch to the process pool; results stream back through
+        # tree_update_queue and update_trees, so the GUI never blocks here.
+        #   files already queued or running are not submitted twice
+        added = self.engine.submit(node_queue, priority)
+        log.info(f'Submitted {added} of {len(node_queue)} files to {self.engine.num_workers} processes (priority {priority})')
+
+    def open_index(self):
+        self.close_index()
+        try:
+            self.index = LibraryIndex(default_index_path(self.work_dir))
+        except (sqlite3.Error, OSError) as ex: # read-only share; results just aren't indexed
+            log.error(f'Unable to open library index ({type(ex).__name__})')
+
+    def close_index(self):
+        if self.index is not None:
+            self.index.end_run()
+            self.index.close()
+            self.index = None
+
+    def on_batch_finished(self):
         # Finish the timer
+        t2 = timer()
+        elapsed = format_elapsed_time(t2-self.t1)
+        log.info(f'Total elapsed: {elapsed}')
+        self.t1 = None
+        if self.index is not None:
+            self.index.end_run()
+        summary = self.stats.summary()
+        log.info(f"Time by stage (s): {summary['stage_seconds']}, waiting on disk: {summary['io_wait_s']}s")
+        try:
+            self.stats.write_summary(os.path.join(self.work_dir, summary_filename))
+        except OSError as ex: # read-only share
+            log.error(f'Unable to save run summary ({type(ex).__name__})')
+        self.progress.config(text=format_progress(self.engine.progress()))
         self.status.config(text='  Status:  IDLE')
-        self.master.update()
-        #end = timer()
-        elapsed = format_elapsed_time(t2-t1)
         self.elapsed.config(text=f'Elapsed:  {elapsed}  ')
 
+    def on_toggle_watch(self):
+        if self.watch_var.get():
+            if self.scanner is None: # nothing loaded yet
+                self.watch_var.set(False)
+                return
+            scanner = self.scanner
+            self.watcher = DirWatcher(scanner, lambda changes: self.watch_queue.put((scanner, changes)), interval=watch_interval)
+            self.watcher.start()
+            log.info(f'Watching {self.work_dir} every {watch_interval}s')
+        elif self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def on_close(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+        self.engine.shutdown()
+        self.close_index()
+        self.master.destroy()
+
     def on_reset(self):
         self.dir_tree.delete(*self.dir_tree.get_children())
-        self.doi_tree.delete(*self.doi_tree.get_children())
-        self.more_doi_tree.delete(*self.more_doi_tree.get_children())
-        self.no_doi_tree.delete(*self.no_doi_tree.get_children())
+        self.clear_results()
         self.work_dir = os.getcwd()
+        self.engine.cache_path = None
+        self.close_index()
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+            self.watch_var.set(False)
+        self.scanner = None
+        self.dir_nodes = {}
+        self.file_nodes = {}
+        self.remaining = {}
+        self.processed = set()
+        self.dirty_dirs = set()
+
+    def clear_results(self):
+        # drops the queued files and every result of the current library, shown or not yet shown;
+        #   the batch ends here, and its index run when the index is closed
+        self.engine.cancel()
+        self.t1 = None
+        self.progress.config(text='')
+        self.status.config(text='  Status:  IDLE')
+        self.elapsed.config(text='')
+        try:
+            while True:
+                self.tree_update_queue.get(0)
+        except queue.Empty:
+            pass
+        for name in result_trees:
+            tree = getattr(self, name)
+            tree.delete(*tree.get_children())
+            self.pending_rows[name].clear()
+
+    def on_clear_cache(self):
+        # forces every file in the current library to be extracted again
+        if self.engine.cache_path and os.path.exists(self.engine.cache_path):
+            cache = DOICache(self.engine.cache_path)
+            cache.clear()
+            cache.close()
+            log.info(f'Cleared DOI cache: {self.engine.cache_path}')
 
     def on_export(self):
-        f = tk.filedialog.asksaveasfile(mode='w', initialdir = os.getcwd(), 
-            title = 'Export list of PDFs with a single DOI', 
-            filetypes = (('Text files','*.txt'),('All files','*.*')),
-            defaultextension='*.*')
-        
-        if f is None: # user cancels
+        output = tk.filedialog.asksaveasfilename(initialdir = os.getcwd(),
+            title = 'Export citations for PDFs with a single DOI',
+            filetypes = (('RIS', '*.ris'), ('BibTeX', '*.bib'), ('CSL-JSON', '*.json'), ('All files', '*.*')),
+            defaultextension='.ris')
+
+        if not output: # user cancels
             return
-        
-        for child in self.doi_tree.get_children():
-            path = self.doi_tree.set(child, 'fullpath')
-            name = self.doi_tree.item(child)['text']
-            doi = self.doi_tree.set(child, 'info')
-            f.write('TY  - JOUR\n')
-            f.write(f'TI  - {name}\n')
-            f.write(f'DO  - {doi}\n')
-            f.write('ER  -\n')
-            
-        f.close()
+
+        # records stream from the library index; the result tabs are only a fallback
+        if self.index is not None:
+            self.index.commit()
+            export_index(self.index, output)
+        else:
+            self.insert_rows() # include results not shown yet
+            records = ({'path': self.doi_tree.set(child, 'fullpath'), 'dois': [self.doi_tree.set(child, 'info')]}
+                for child in self.doi_tree.get_children())
+            with open(output, 'w', encoding='utf-8', newline='\n', buffering=write_buffer) as f:
+                export_records(records, f, export_format(output))
 
     def on_build_report(self):
         # create a text file with the contents of each tree
@@ -401,10 +576,15 @@ class MedLib():
         if f is None: 
             return
 
-        # TODO: general statistics about the operation
-        #   num files processed
-        #   time to process
-        #   num unique/more/no DOIs
+        self.insert_rows() # include results not shown yet
+
+        # general statistics about the last batch
+        summary = self.stats.summary()
+        f.write('# Last run\n')
+        f.write(f"  Files processed: {summary['files']}  {summary['by_status']}\n")
+        f.write(f"  {summary['files_per_s']} files/s, p50 {summary['p50_s']}s, p95 {summary['p95_s']}s per file\n")
+        f.write(f"  Time by stage (s): {summary['stage_seconds']}, waiting on disk: {summary['io_wait_s']}s\n")
+        f.write('\n\n')
 
         # loop through doi_tree
         f.write('# Files with a single unique DOI\n')
@@ -433,34 +613,97 @@ class MedLib():
             name = self.no_doi_tree.item(child)['text']
             basedir = os.path.dirname(path)
             f.write(f'  {name}\t{basedir}\n'.expandtabs(40))
+        f.write('\n\n')
+
+        # loop through failed_tree and write file, path, reason
+        f.write('# Files that failed or timed out\n')
+        for child in self.failed_tree.get_children():
+            path = self.failed_tree.set(child, 'fullpath')
+            name = self.failed_tree.item(child)['text']
+            basedir = os.path.dirname(path)
+            reason = self.failed_tree.set(child, 'info')
+            f.write(f'  {name}\t{basedir}\t{reason}\n'.expandtabs(40))
+        f.write('\n\n')
+
+        # loop through locked_tree and write file, path; no keyring password opens these
+        f.write('# Encrypted files that no keyring password opens\n')
+        for child in self.locked_tree.get_children():
+            path = self.locked_tree.set(child, 'fullpath')
+            name = self.locked_tree.item(child)['text']
+            basedir = os.path.dirname(path)
+            f.write(f'  {name}\t{basedir}\n'.expandtabs(40))
         f.write('\n')
 
+        # duplicates across the whole library, from the library index
+        if self.index is not None:
+            self.index.commit()
+            f.write('\n# Identical files\n')
+            for paths in self.index.duplicate_files().values():
+                f.write(''.join(f'  {path}\n' for path in paths) + '\n')
+            f.write('\n# Different files sharing a DOI\n')
+            for doi, paths in self.index.duplicate_dois().items():
+                f.write(f'  {doi}\n' + ''.join(f'    {path}\n' for path in paths))
+            f.write('\n')
+
     def update_trees(self):
-        # This loop checks the queue for messages every 100 milliseconds
-        try: 
-            # update UI based on results
-            result = self.tree_update_queue.get(0)
-            origin_id = result['origin_id']
-            target_tree = result['target']
-            target_text = result['text']
-            target_path = result['path']
-            target_info = result['info']
-            #log.info(f'updating tree: {origin_id}, {target_tree}, {target_text}, {target_path}, {target_info}')
-
-            if target_tree == 'doi_tree':
-                self.doi_tree.insert(text=target_text, parent='', index='end', values=(target_path, target_info))
-            elif target_tree == 'more_doi_tree':
-                self.more_doi_tree.insert(text=target_text, parent='', index='end', values=(target_path, target_info))
-            elif target_tree == 'no_doi_tree':
-                self.no_doi_tree.insert(text=target_text, parent='', index='end', values=(target_path, target_path))
-
-            self.dir_tree.detach(origin_id)
-            self.update_dir_tree_counts()
-
-            self.master.after(100, self.update_trees)
+        # This loop applies every queued result each update, up to update_budget seconds
+        #   results are queued per tab and inserted in bulk, visible tab first, so a large
+        #   batch no longer drains one row per tick
+        deadline = timer() + update_budget
+        try:
+            while timer() < deadline:
+                result = self.tree_update_queue.get(0)
+                #log.info(f'updating tree: {result}')
+                if self.file_nodes.get(result['path']) != result['origin_id']:
+                    continue # still running when the library was reset or replaced
+
+                target_path = result['path']
+                info = target_path if result['target'] == 'no_doi_tree' else result['info']
+                self.pending_rows[result['target']].append((result['text'], target_path, info))
+                self.mark_processed(target_path, result['origin_id'])
+                if self.index is not None:
+                    self.record_result(result)
+                self.stats.add(target_path, tree_status[result['target']], result.get('timings'))
 
         except queue.Empty:
-            self.master.after(100, self.update_trees)
+            # queue drained and nothing left in the pool; the batch is done
+            if self.t1 is not None and not self.engine.is_busy():
+                self.on_batch_finished()
+
+        if self.index is not None:
+            self.index.commit()
+        t1 = timer()
+        self.insert_rows(deadline)
+        self.update_dir_tree_counts()
+        self.stats.add_stage('ui_insert', timer() - t1)
+        if self.t1 is not None:
+            self.progress.config(text=format_progress(self.engine.progress()))
+        self.master.after(update_interval, self.update_trees)
+
+    def record_result(self, result):
+        target = result['target']
+        if target == 'doi_tree':
+            dois = [result['info']]
+        elif target == 'more_doi_tree':
+            dois = result['info']
+        else:
+            dois = []
+        self.index.record(result['path'], result.get('hash'), tree_status[target], dois)
+
+    def insert_rows(self, deadline=None):
+        # Inserts pending result rows; without a deadline everything is inserted
+        visible = self.workspace.select()
+        names = sorted(result_trees, key=lambda name: str(self.tree_frames[name]) != visible)
+        inserted = 0
+        for name in names:
+            tree = getattr(self, name)
+            rows = self.pending_rows[name]
+            while rows:
+                if deadline is not None and inserted >= min_rows_per_update and timer() >= deadline:
+                    return
+                text, path, info = rows.popleft()
+                tree.insert('', 'end', text=text, values=(path, info))
+                inserted += 1
 
 
 
@@ -0,0 +1,201 @@
+# Headless batch DOI extraction for medlib (no display required, e.g. under cron)
+#   python medlib_cli.py /library -o results.jsonl
+#   python medlib_cli.py --file-list todo.txt -o results.csv --workers 8
+# Records are written as each file finishes, so an interrupted run can be
+# continued with --resume against the same output file.
+import argparse, csv, functools, json, os, queue, sys
+
+# For logging
+import logging
+logging.basicConfig(level=logging.CRITICAL, format='%(levelname)-9s: %(name)s : %(funcName)s() : %(message)s')
+log = logging.getLogger('medlib_cli')
+log.setLevel(logging.DEBUG)
+
+# For timing operations
+from timeit import default_timer as timer
+
+from doi_engine import SupervisedEngine, process_file, failed_file_result, file_timeout, scan_text_mode, text_modes
+from doi_cache import default_cache_path
+from dir_scanner import DirScanner
+from library_index import LibraryIndex, default_index_path
+from pdf_passwords import default_keyring_path
+from telemetry import RunStats, format_progress
+
+
+fields = ['path', 'dois', 'status', 'seconds', 'reason']
+index_commit_every = 100  # records written to the library index per transaction
+progress_interval = 10    # seconds between progress lines in the log
+
+
+###### INPUT ######
+def collect_paths(inputs, file_list=None):
+    # Directories are scanned recursively for PDFs; files are taken as given
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(sorted(DirScanner(item).scan()))
+        else:
+            paths.append(os.path.abspath(item))
+
+    if file_list:
+        with open(file_list) as f:
+            paths.extend(os.path.abspath(line.strip()) for line in f if line.strip())
+
+    # drop duplicates but keep the order
+    return list(dict.fromkeys(paths))
+
+
+###### OUTPUT ######
+def output_format(output, requested=None):
+    if requested:
+        return requested
+    return 'csv' if output.lower().endswith('.csv') else 'jsonl'
+
+def trim_partial_line(output):
+    # A killed run can leave half a record at the end; cut back to the last newline
+    with open(output, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+def read_done_paths(output, fmt):
+    # Paths already recorded in a previous (possibly interrupted) run
+    if not os.path.exists(output):
+        return set()
+
+    trim_partial_line(output)
+    done = set()
+    with open(output, newline='') as f:
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                done.add(row['path'])
+        else:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['path'])
+                except (ValueError, KeyError):
+                    continue
+    return done
+
+class RecordWriter():
+    def __init__(self, output, fmt, append=False):
+        new_file = not (append and os.path.exists(output) and os.path.getsize(output) > 0)
+        self.fmt = fmt
+        self.f = open(output, 'a' if append else 'w', newline='')
+        if fmt == 'csv':
+            self.writer = csv.DictWriter(self.f, fieldnames=fields, extrasaction='ignore')
+            if new_file:
+                self.writer.writeheader()
+
+    def write(self, record):
+        if self.fmt == 'csv':
+            self.writer.writerow(dict(record, dois=';'.join(record['dois'])))
+        else:
+            self.f.write(json.dumps(record) + '\n')
+        self.f.flush() # every finished file survives an interruption
+
+    def close(self):
+        self.f.close()
+
+
+###### MAIN ######
+def run(paths, output, fmt, workers=None, cache_path=None, resume=False, timeout=file_timeout, index_path=None, root=None,
+        summary_path=None, text_mode=None, keyring_path=None):
+    done = read_done_paths(output, fmt) if resume else set()
+    todo = [path for path in paths if path not in done]
+    log.info(f'{len(todo)} files to process ({len(paths) - len(todo)} already done), {workers or os.cpu_count()} workers')
+
+    counts = {'unique': 0, 'multiple': 0, 'none': 0, 'failed': 0, 'locked': 0}
+    writer = RecordWriter(output, fmt, append=resume)
+    index = LibraryIndex(index_path) if index_path else None
+    if index is not None:
+        index.begin_run(root)
+    results = queue.Queue()
+    engine = SupervisedEngine(results, workers, cache_path, timeout,
+        task_function=functools.partial(process_file, text_mode=text_mode, keyring_path=keyring_path, hash_content=index is not None),
+        failure_function=failed_file_result, task_path=lambda path: path)
+    stats = RunStats()
+    t1 = timer()
+    last_progress = t1
+    try:
+        engine.submit(todo)
+        remaining = len(todo)
+        while remaining:
+            try:
+                record = results.get(timeout=progress_interval)
+            except queue.Empty:
+                record = None
+            if timer() - last_progress >= progress_interval:
+                log.info(format_progress(engine.progress()))
+                last_progress = timer()
+            if record is None:
+                continue
+
+            stats.add(record['path'], record['status'], record.get('timings'), record['seconds'])
+            writer.write(record)
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+            remaining -= 1
+            if index is not None:
+                index.record(record['path'], record.get('hash'), record['status'], record['dois'])
+                if remaining % index_commit_every == 0:
+                    index.commit()
+    except KeyboardInterrupt:
+        log.error('Interrupted; rerun with --resume to continue')
+        raise
+    finally:
+        engine.shutdown()
+        writer.close()
+        if index is not None:
+            index.end_run()
+            index.close()
+        if summary_path:
+            stats.write_summary(summary_path)
+
+    t2 = timer()
+    log.info(f'Finished {len(todo)} files in {t2-t1:.1f}s: {counts}')
+    log.info(f"Time by stage (s): {stats.summary()['stage_seconds']}")
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract DOIs from PDFs without the GUI')
+    parser.add_argument('inputs', nargs='*', help='PDF files and/or directories (scanned recursively)')
+    parser.add_argument('--file-list', help='text file with one PDF path per line')
+    parser.add_argument('-o', '--output', required=True, help='output file (.jsonl or .csv)')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help='output format (default: from the extension)')
+    parser.add_argument('-w', '--workers', type=int, help='worker processes (default: one per core)')
+    parser.add_argument('--resume', action='store_true', help='skip files already in the output and append')
+    parser.add_argument('--timeout', type=float, default=file_timeout, help=f'seconds allowed per file before its worker is killed (default: {file_timeout}, 0 for none)')
+    parser.add_argument('--cache', help='DOI cache database (default: local data directory of the first directory given)')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the DOI cache')
+    parser.add_argument('--index', help='library index database (default: local data directory of the first directory given)')
+    parser.add_argument('--no-index', action='store_true', help='do not record results in the library index')
+    parser.add_argument('--summary', help='write a JSON run summary (throughput, latency, time per stage) here')
+    parser.add_argument('--text-mode', choices=text_modes, default=scan_text_mode,
+        help=f'page text extraction: raw skips layout analysis, layout is pdfminer\'s full analysis (default: {scan_text_mode})')
+    parser.add_argument('--keyring', help=f'passwords to try on encrypted PDFs, one per line (default: {default_keyring_path})')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only log errors')
+    args = parser.parse_args()
+
+    if not args.inputs and not args.file_list:
+        parser.error('give at least one file/directory or --file-list')
+    if args.quiet:
+        logging.getLogger().setLevel(logging.ERROR)
+        for name in ('medlib_cli', 'doi_engine', 'doi_cache', 'dir_scanner', 'library_index', 'pdf_passwords'):
+            logging.getLogger(name).setLevel(logging.ERROR)
+
+    directories = [item for item in args.inputs if os.path.isdir(item)]
+    cache_path = None
+    if not args.no_cache:
+        cache_path = args.cache or (default_cache_path(directories[0]) if directories else None)
+    index_path = None
+    if not args.no_index:
+        index_path = args.index or (default_index_path(directories[0]) if directories else None)
+
+    paths = collect_paths(args.inputs, args.file_list)
+    fmt = output_format(args.output, args.format)
+    try:
+        run(paths, args.output, fmt, args.workers, cache_path, args.resume, args.timeout,
+            index_path, os.path.abspath(directories[0]) if directories else None, args.summary, args.text_mode, args.keyring)
+    except KeyboardInterrupt:
+        sys.exit(130)
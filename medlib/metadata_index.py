@@ -0,0 +1,209 @@
+# Offline DOI metadata for medlib
+#   Loads a Crossref or OpenAlex snapshot (.json, .jsonl, optionally .gz) into an
+#   on-disk key/value table keyed by normalized DOI, so DOIs can be validated and
+#   enriched (title, journal, year, authors) without network access. A DOI that
+#   isn't in the snapshot is reported as unresolved.
+#   python metadata_index.py load crossref.sqlite /data/crossref/*.json.gz
+#   python metadata_index.py enrich crossref.sqlite results.jsonl -o enriched.jsonl
+import argparse, gzip, json, sqlite3
+
+# For logging
+import logging
+logging.basicConfig(level=logging.CRITICAL, format='%(levelname)-9s: %(name)s : %(funcName)s() : %(message)s')
+log = logging.getLogger('metadata_index')
+log.setLevel(logging.DEBUG)
+
+# For timing operations
+from timeit import default_timer as timer
+
+from doi_match import normalize_doi
+
+
+load_batch = 10000   # records per transaction while loading a snapshot
+lookup_batch = 500   # DOIs per query in resolve_many (below SQLite's parameter limit)
+doi_prefixes = ('https://doi.org/', 'http://doi.org/', 'https://dx.doi.org/', 'http://dx.doi.org/', 'doi:')
+
+schema = '''
+CREATE TABLE IF NOT EXISTS works (
+    doi  TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+) WITHOUT ROWID;
+'''
+
+
+###### SNAPSHOT RECORDS ######
+def strip_doi(doi):
+    # OpenAlex stores DOIs as URLs; Crossref as bare DOIs
+    doi = doi.strip()
+    for prefix in doi_prefixes:
+        if doi.lower().startswith(prefix):
+            return normalize_doi(doi[len(prefix):])
+    return normalize_doi(doi)
+
+def first(value):
+    # Crossref wraps most strings in single-item lists
+    if isinstance(value, list):
+        return value[0] if value else None
+    return value
+
+def crossref_metadata(item):
+    authors = [{'family': author.get('family') or author.get('name'), 'given': author.get('given')}
+        for author in item.get('author', [])]
+    year = None
+    for key in ('published-print', 'published-online', 'issued', 'created'):
+        parts = (item.get(key) or {}).get('date-parts') or [[None]]
+        if parts[0] and parts[0][0]:
+            year = parts[0][0]
+            break
+    return {'title': first(item.get('title')), 'journal': first(item.get('container-title')),
+        'year': year, 'authors': authors}
+
+def openalex_metadata(work):
+    authors = []
+    for authorship in work.get('authorships', []):
+        name = (authorship.get('author') or {}).get('display_name') or ''
+        given, _, family = name.rpartition(' ')
+        authors.append({'family': family, 'given': given or None})
+    source = ((work.get('primary_location') or {}).get('source') or {})
+    return {'title': work.get('title') or work.get('display_name'), 'journal': source.get('display_name'),
+        'year': work.get('publication_year'), 'authors': authors}
+
+def snapshot_record(item):
+    # Returns (doi, metadata) for one Crossref item or OpenAlex work, or None without a DOI
+    if 'DOI' in item:
+        return strip_doi(item['DOI']), crossref_metadata(item)
+    if item.get('doi'):
+        return strip_doi(item['doi']), openalex_metadata(item)
+    return None
+
+def snapshot_items(data):
+    # A Crossref data file or API page ({"items": [...]}), a JSON list, or a single work
+    if isinstance(data, list):
+        return data
+    if 'message' in data:
+        data = data['message']
+    return data['items'] if 'items' in data else [data]
+
+def read_snapshot(path):
+    # Yields Crossref items / OpenAlex works from one snapshot file; JSON lines files
+    # (e.g. OpenAlex part_000.gz) are streamed, one document per line
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        first_line = f.readline()
+        try:
+            data = json.loads(first_line)
+        except ValueError: # one JSON document spread over several lines
+            data = json.loads(first_line + f.read())
+        yield from snapshot_items(data)
+        for line in f:
+            if line.strip():
+                yield from snapshot_items(json.loads(line))
+
+
+class MetadataIndex():
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def load(self, paths):
+        # Adds every record in the snapshot files; later records replace earlier ones for the same DOI
+        t1 = timer()
+        count = 0
+        self.db.execute('PRAGMA synchronous=OFF')  # a failed load is simply rerun
+        for path in paths:
+            batch = []
+            for item in read_snapshot(path):
+                record = snapshot_record(item)
+                if record is None:
+                    continue
+                batch.append((record[0], json.dumps(record[1], ensure_ascii=False)))
+                if len(batch) >= load_batch:
+                    count += self.insert(batch)
+                    batch = []
+            count += self.insert(batch)
+            log.info(f'Loaded {path} ({count} records so far)')
+        self.db.execute('PRAGMA synchronous=FULL')
+        t2 = timer()
+        log.info(f'Loaded {count} records in {t2-t1:.1f}s')
+        return count
+
+    def insert(self, batch):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO works (doi, data) VALUES (?, ?)', batch)
+        return len(batch)
+
+    def get(self, doi):
+        # Metadata for doi, or None if the snapshot doesn't know it
+        row = self.db.execute('SELECT data FROM works WHERE doi = ?', (strip_doi(doi),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def resolve_many(self, dois):
+        # {doi: metadata} for the DOIs found in the snapshot; missing DOIs are left out
+        dois = list(dict.fromkeys(strip_doi(doi) for doi in dois))
+        found = {}
+        for i in range(0, len(dois), lookup_batch):
+            chunk = dois[i:i+lookup_batch]
+            query = f"SELECT doi, data FROM works WHERE doi IN ({', '.join('?' * len(chunk))})"
+            for doi, data in self.db.execute(query, chunk):
+                found[doi] = json.loads(data)
+        return found
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM works').fetchone()[0]
+
+
+###### ENRICHMENT ######
+def enrich_records(records, index):
+    # Adds 'metadata' (for the first DOI) and 'resolved' to each result record,
+    # looking DOIs up a batch at a time; yields the records in their original order
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= lookup_batch:
+            yield from enrich_batch(batch, index)
+            batch = []
+    yield from enrich_batch(batch, index)
+
+def enrich_batch(records, index):
+    found = index.resolve_many(doi for record in records for doi in record['dois'])
+    for record in records:
+        record['resolved'] = [doi for doi in record['dois'] if doi in found]
+        record['metadata'] = found.get(record['dois'][0]) if record['dois'] else None
+        yield record
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline DOI metadata from a Crossref/OpenAlex snapshot')
+    commands = parser.add_subparsers(dest='command', required=True)
+    load = commands.add_parser('load', help='load snapshot files into the index')
+    load.add_argument('index', help='metadata index database')
+    load.add_argument('snapshots', nargs='+', help='Crossref or OpenAlex files (.json, .jsonl, .gz)')
+    lookup = commands.add_parser('lookup', help='print metadata for DOIs')
+    lookup.add_argument('index', help='metadata index database')
+    lookup.add_argument('dois', nargs='+')
+    enrich = commands.add_parser('enrich', help='add metadata to a medlib_cli JSONL file')
+    enrich.add_argument('index', help='metadata index database')
+    enrich.add_argument('results', help='JSONL written by medlib_cli.py')
+    enrich.add_argument('-o', '--output', required=True, help='enriched JSONL')
+    args = parser.parse_args()
+
+    index = MetadataIndex(args.index)
+    if args.command == 'load':
+        index.load(args.snapshots)
+    elif args.command == 'lookup':
+        for doi in args.dois:
+            print(doi, json.dumps(index.get(doi), ensure_ascii=False))
+    else:
+        t1 = timer()
+        count = 0
+        with open(args.results) as f, open(args.output, 'w', buffering=1024 * 1024) as out:
+            for record in enrich_records((json.loads(line) for line in f if line.strip()), index):
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                count += 1
+        log.info(f'Enriched {count} records in {timer()-t1:.1f}s')
+    index.close()
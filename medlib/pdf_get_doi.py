@@ -1,5 +1,4 @@
 import os, sys, time, threading
-import re
 
 # pdfminer.six
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
@@ -8,6 +7,9 @@ from pdfminer.pdfpage import PDFPage
 from pdfminer.layout import LAParams
 from io import StringIO
 
+from doi_cache import DOICache
+from doi_match import find_dois
+
 import logging
 logging.basicConfig(level=logging.CRITICAL, format='%(levelname)s : %(name)s : %(funcName)s() : %(message)s')
 log = logging.getLogger('pdf_get_doi')
@@ -72,34 +74,41 @@ def convert_pdf_to_text(path):
 
 
 def find_all_doi(text):
-    # regex pattern for DOI: \b(10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?!["&\'<>])\S)+)\b
+    # regex pattern for DOI: see doi_match.doi_pattern (compiled once, matches are normalized)
     #  see: https://stackoverflow.com/questions/27910/finding-a-doi-in-a-document-or-page
-    #  fancy sanity checking: run the doi against https://doi.org/ and test that you get
-    #    a 200 OK http status and that the returned page is not the "DOI not found" page
-    rex = r'\b(10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?!["&\'<>])\S)+)\b'
-    
+    #  sanity checking without network access: metadata_index.MetadataIndex.resolve_many
+    #    reports which DOIs exist in a local Crossref/OpenAlex snapshot
     try:
-        doi = re.findall(rex, text)
-    except AttributeError: # might not need this; was thrown using re.search with no results
+        doi = find_dois(text)
+    except TypeError: # no text (conversion failed)
         return False
     else:
         return doi
     
 
-def get_doi(file_path):
+def get_doi(file_path, cache=None):
+    if cache is not None: # unchanged files are answered from the cache
+        entry = cache.get(file_path, extractor='legacy')
+        if entry is not None:
+            return entry['dois'] or False
+
     pdf = convert_pdf_to_text(file_path) # convert PDF to text
     all_doi = find_all_doi(pdf) # extract DOIs
     unique = set(all_doi) # only keep unique DOIs
 
+    if cache is not None:
+        cache.put(file_path, unique, extractor='legacy')
+
     if not unique: # empty set / no DOIs found
         return False
     else:
         return unique
 
 
-def get_doi_from_dir(folder_path, recursive=False):
+def get_doi_from_dir(folder_path, recursive=False, cache_path=None):
 
     results = {}
+    cache = DOICache(cache_path) if cache_path else None
 
     if recursive:
         for subdir, dirs, files in os.walk(folder_path):
@@ -109,7 +118,7 @@ def get_doi_from_dir(folder_path, recursive=False):
                 file_path = os.path.join(subdir, filename)
 
                 if filename.endswith('.pdf'): 
-                    doi = get_doi(file_path)
+                    doi = get_doi(file_path, cache)
 
                     if doi: # the set is not empty
                         if len(doi) == 1: 
@@ -130,7 +139,7 @@ def get_doi_from_dir(folder_path, recursive=False):
             file_path = os.path.join(folder_path, filename)
 
             if filename.endswith('.pdf'):
-                doi = get_doi(file_path)
+                doi = get_doi(file_path, cache)
 
                 if doi: # the set is not empty
                     if len(doi) == 1: 
@@ -145,12 +154,15 @@ def get_doi_from_dir(folder_path, recursive=False):
                     results[file_path] = ''
                     #continue                    
     
+    if cache is not None: # commits the cached results
+        cache.close()
     return results
 
 
-def get_doi_from_dir_console(folder_path, recursive=False):
+def get_doi_from_dir_console(folder_path, recursive=False, cache_path=None):
 
     results = {}
+    cache = DOICache(cache_path) if cache_path else None
 
     try:
         spinner = Spinner()
@@ -164,7 +176,7 @@ def get_doi_from_dir_console(folder_path, recursive=False):
 
                     if filename.endswith('.pdf'): 
                         spinner.start()
-                        doi = get_doi(file_path)
+                        doi = get_doi(file_path, cache)
                         spinner.stop()
 
                         if doi: # the set is not empty
@@ -185,7 +197,7 @@ def get_doi_from_dir_console(folder_path, recursive=False):
 
                 if filename.endswith('.pdf'):
                     spinner.start()
-                    doi = get_doi(file_path)
+                    doi = get_doi(file_path, cache)
                     spinner.stop()
 
                     if doi: # the set is not empty
@@ -204,12 +216,17 @@ def get_doi_from_dir_console(folder_path, recursive=False):
         spinner.stop()        
         log.error('Script terminated')
 
+    finally:
+        if cache is not None: # commits the cached results
+            cache.close()
+
 
 if __name__ == '__main__':
 
 
+    # directory from the command line, otherwise ./samples (see medlib_cli.py for batch runs)
     cur_dir = os.getcwd()
-    work_dir = cur_dir + '\samples'
+    work_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(cur_dir, 'samples')
     
     results = get_doi_from_dir(work_dir)
 
@@ -1,5 +1,3 @@
-import re
-
 import logging
 logging.basicConfig(level=logging.CRITICAL, format='%(levelname)s : %(name)s : %(funcName)s() : %(message)s')
 log = logging.getLogger('pdf_miner')
@@ -15,6 +13,7 @@ from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
 from pdfminer.converter import TextConverter
 from pdfminer.layout import LAParams
 from io import StringIO
+from doi_match import find_dois
 
 
 
@@ -45,13 +44,11 @@ def convert_pdf_to_txt(path):
 
 
 def find_doi(text):
-    # regex pattern for DOI: \b(10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?!["&\'<>])\S)+)\b
+    # regex pattern for DOI: see doi_match.doi_pattern (compiled once, matches are normalized)
     #  see: https://stackoverflow.com/questions/27910/finding-a-doi-in-a-document-or-page
-    rex = r'\b(10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?!["&\'<>])\S)+)\b'
-    
     try:
-        doi = re.findall(rex, text)
-    except AttributeError: # might not need this; was thrown using re.search with no results
+        doi = find_dois(text)
+    except TypeError: # no text
         return False
     else:
         return doi
@@ -0,0 +1,81 @@
+# Encrypted PDF handling for medlib
+#   Encryption is detected from the raw bytes (the /Encrypt entry of the trailer
+#   or xref stream) before pdfminer parses anything. Files that the empty user
+#   password doesn't open are tried against a keyring of known institutional
+#   passwords: a text file with one password per line (blank lines and lines
+#   starting with # are skipped), kept outside the library, e.g. ~/.medlib_keyring.
+#   The DOI cache (often on a shared drive) only stores which keyring line opened a
+#   file and when the keyring file was last changed, nothing derived from a password.
+import mmap, os
+
+# For logging
+import logging
+logging.basicConfig(level=logging.CRITICAL, format='%(levelname)-9s: %(name)s : %(funcName)s() : %(message)s')
+log = logging.getLogger('pdf_passwords')
+log.setLevel(logging.DEBUG)
+
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdfdocument import PDFDocument, PDFPasswordIncorrect
+
+
+default_keyring_path = os.environ.get('MEDLIB_KEYRING', os.path.join(os.path.expanduser('~'), '.medlib_keyring'))
+
+
+class PDFLocked(Exception):
+    # No password in the keyring opens the file
+    pass
+
+
+###### KEYRING ######
+keyrings = {}  # path -> (mtime_ns, passwords); reloaded when the file changes
+
+def load_keyring(path=None):
+    # Returns the keyring passwords in file order, or [] if there is no keyring
+    path = path or default_keyring_path
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return []
+
+    known = keyrings.get(path)
+    if known and known[0] == mtime_ns:
+        return known[1]
+
+    with open(path, encoding='utf-8') as f:
+        passwords = [line.rstrip('\r\n') for line in f]
+    passwords = [password for password in passwords if password and not password.startswith('#')]
+    keyrings[path] = (mtime_ns, passwords)
+    log.info(f'Loaded {len(passwords)} passwords from {path}')
+    return passwords
+
+def keyring_fingerprint(path=None):
+    # Changes whenever the keyring file is edited, so locked files are retried and
+    #   remembered keyring lines are looked up again ('' if there is no keyring)
+    path = path or default_keyring_path
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ''
+    return f'{st.st_size}-{st.st_mtime_ns}'
+
+
+###### DETECTION / UNLOCKING ######
+def is_encrypted(path):
+    # Looks for /Encrypt in the trailer or xref stream dictionary without parsing the file
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return data.rfind(b'/Encrypt') != -1
+
+def unlock(path, passwords):
+    # Returns the first of passwords that opens the file; raises PDFLocked if none does
+    with open(path, 'rb') as f:
+        for password in passwords:
+            f.seek(0)
+            try:
+                PDFDocument(PDFParser(f), password=password, caching=False)
+            except PDFPasswordIncorrect:
+                continue
+            return password
+    raise PDFLocked(f'None of {len(passwords)} keyring passwords opens the file')
@@ -0,0 +1,117 @@
+# Pipeline telemetry for medlib
+#   StageTimer runs inside the workers and splits each file's time into stages
+#   (open, metadata, parse, layout, regex); nested stages are exclusive, so the
+#   stages of a file add up to its total. RunStats collects the per-file timings
+#   on the consumer side (GUI/CLI), adds stages measured there (e.g. ui_insert),
+#   and produces a machine-readable run summary.
+import json, threading, time
+from contextlib import contextmanager
+
+# For timing operations
+from timeit import default_timer as timer
+
+
+class StageTimer():
+    def __init__(self):
+        self.seconds = {}  # stage -> exclusive seconds
+        self.stack = []    # [stage, start, seconds spent in nested stages]
+        self.wall_start = timer()
+        self.cpu_start = time.process_time()
+
+    @contextmanager
+    def stage(self, name):
+        frame = [name, timer(), 0.0]
+        self.stack.append(frame)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            elapsed = timer() - frame[1]
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - frame[2]
+            if self.stack:
+                self.stack[-1][2] += elapsed
+
+    def timings(self):
+        # Stage times plus wall/cpu; wall minus cpu is mostly time spent waiting on disk
+        result = {name: round(seconds, 4) for name, seconds in self.seconds.items()}
+        result['wall'] = round(timer() - self.wall_start, 4)
+        result['cpu'] = round(time.process_time() - self.cpu_start, 4)
+        return result
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class RunStats():
+    # Thread-safe; add() is called once per result, add_stage() for consumer-side stages
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.t1 = timer()
+            self.files = 0
+            self.by_status = {}
+            self.stage_totals = {}
+            self.latencies = []
+            self.slowest = []  # (seconds, path) of the slowest files
+
+    def add(self, path, status, timings=None, seconds=None):
+        timings = timings or {}
+        seconds = seconds if seconds is not None else timings.get('wall')
+        with self.lock:
+            self.files += 1
+            self.by_status[status] = self.by_status.get(status, 0) + 1
+            for stage, value in timings.items():
+                self.stage_totals[stage] = self.stage_totals.get(stage, 0.0) + value
+            if seconds is not None:
+                self.latencies.append(seconds)
+                self.slowest = sorted(self.slowest + [(seconds, path)], reverse=True)[:10]
+
+    def add_stage(self, stage, seconds):
+        with self.lock:
+            self.stage_totals[stage] = self.stage_totals.get(stage, 0.0) + seconds
+
+    def summary(self):
+        with self.lock:
+            elapsed = timer() - self.t1
+            totals = dict(self.stage_totals)
+            wall = totals.pop('wall', 0.0)
+            cpu = totals.pop('cpu', 0.0)
+            return {
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'elapsed_s': round(elapsed, 3),
+                'files': self.files,
+                'by_status': dict(self.by_status),
+                'files_per_s': round(self.files / elapsed, 2) if elapsed > 0 else None,
+                'p50_s': round(percentile(self.latencies, 0.50), 3),
+                'p95_s': round(percentile(self.latencies, 0.95), 3),
+                'stage_seconds': {stage: round(value, 3) for stage, value in sorted(totals.items())},
+                'worker_wall_s': round(wall, 3),
+                'worker_cpu_s': round(cpu, 3),
+                'io_wait_s': round(max(0.0, wall - cpu), 3),
+                'slowest': [{'path': path, 'seconds': round(seconds, 3)} for seconds, path in self.slowest],
+            }
+
+    def write_summary(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+
+def format_progress(progress):
+    # One status bar line from SupervisedEngine.progress()
+    text = 'Paused  |  ' if progress.get('paused') else ''
+    text += (f"Queued {progress['queued']}  |  In flight {progress['in_flight']}  |  "
+        f"Done {progress['done']}  |  Failed {progress['failed']}")
+    if progress['files_per_s']:
+        text += f"  |  {progress['files_per_s']:.1f} files/s"
+    if progress['eta_s'] is not None:
+        minutes, seconds = divmod(int(progress['eta_s']), 60)
+        text += f'  |  ETA {minutes // 60}:{minutes % 60:02d}:{seconds:02d}'
+    return text
@@ -0,0 +1,113 @@
+# Tests for doi_resolver against the local stub server (no network access needed)
+#   cd medlib && python -m pytest test_doi_resolver.py
+import sqlite3
+
+import pytest
+
+import doi_resolver
+from doi_resolver import CrossrefBackend, resolve_dois, start_stub_server
+
+
+def work(doi):
+    return {'DOI': doi, 'title': [f'Article {doi}'], 'container-title': ['Journal of Tests'],
+        'issued': {'date-parts': [[2020]]}, 'author': [{'family': 'Doe', 'given': 'Jane'}]}
+
+found = [f'10.5555/found.{i}' for i in range(40)]
+missing = [f'10.5555/missing.{i}' for i in range(10)]
+flaky = '10.5555/found.7'
+broken = '10.5555/broken.1'
+
+
+@pytest.fixture
+def server():
+    server = start_stub_server({doi: work(doi) for doi in found}, flaky={flaky}, broken={broken},
+        retry_after='1', latency=0.02)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def backend(server):
+    return CrossrefBackend(f'http://127.0.0.1:{server.server_address[1]}')
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    # only the waits chosen by the resolver itself; Retry-After is still honoured
+    monkeypatch.setattr(doi_resolver, 'backoff', 0.01)
+
+def requested(server, doi=None):
+    return [t for t, requested_doi in server.requests if doi is None or requested_doi == doi]
+
+
+###### STATUSES ######
+def test_statuses(server, backend):
+    results = resolve_dois(found + missing + [broken], backend=backend, retries=1)
+    assert {doi for doi, result in results.items() if result['status'] == 'ok'} == set(found)
+    assert {doi for doi, result in results.items() if result['status'] == 'not_found'} == set(missing)
+    assert results[broken]['status'] == 'error'
+    assert results[broken]['reason'] == 'HTTP 500'
+    assert len(requested(server, broken)) == 2  # the first attempt and one retry
+
+    metadata = results[found[0]]['metadata']
+    assert metadata['title'] == f'Article {found[0]}'
+    assert metadata['year'] == 2020
+    assert results[missing[0]]['metadata'] is None
+
+def test_retry_after(server, backend):
+    results = resolve_dois([flaky], backend=backend)
+    assert results[flaky]['status'] == 'ok'
+    first, second = requested(server, flaky)
+    assert second - first >= 1.0  # the 503 carried Retry-After: 1
+
+
+###### CACHE ######
+def test_cache_hit(server, backend, tmp_path):
+    cache_path = str(tmp_path / 'responses.sqlite')
+    cold = resolve_dois(found + missing, backend=backend, cache_path=cache_path)
+    count = len(server.requests)
+    cached = resolve_dois(found + missing, backend=backend, cache_path=cache_path)
+    assert len(server.requests) == count
+    assert cached == cold
+
+def test_cache_ttl(server, backend, tmp_path):
+    cache_path = str(tmp_path / 'responses.sqlite')
+    resolve_dois(found + missing, backend=backend, cache_path=cache_path)
+    count = len(server.requests)
+
+    # past the TTL of DOIs the service didn't know, well within the TTL of found ones
+    age = doi_resolver.missing_ttl_days * 86400 + 60
+    db = sqlite3.connect(cache_path)
+    with db:
+        db.execute('UPDATE responses SET fetched = fetched - ?', (age,))
+    db.close()
+
+    results = resolve_dois(found + missing, backend=backend, cache_path=cache_path)
+    assert sorted(doi for t, doi in server.requests[count:]) == sorted(missing)
+    assert all(results[doi]['status'] == 'not_found' for doi in missing)
+
+    # and every response again once the TTL of found DOIs is over too
+    db = sqlite3.connect(cache_path)
+    with db:
+        db.execute('UPDATE responses SET fetched = fetched - ?', (doi_resolver.cache_ttl_days * 86400,))
+    db.close()
+    count = len(server.requests)
+    resolve_dois(found + missing, backend=backend, cache_path=cache_path)
+    assert len(server.requests) - count == len(found) + len(missing)
+
+
+###### LIMITS ######
+def test_concurrency_limit(server, backend):
+    results = resolve_dois(found + missing, backend=backend, concurrency=4)
+    assert len(results) == len(found) + len(missing)
+    assert server.max_in_flight <= 4
+    assert server.max_in_flight >= 2  # the limit was actually reached for
+
+def test_rate_limit(server, backend):
+    rate = 20
+    dois = [doi for doi in found if doi != flaky][:30]
+    resolve_dois(dois, backend=backend, concurrency=8, rate=rate)
+    times = requested(server)
+    assert len(times) == len(dois)
+    # request starts are spaced 1/rate apart, so no window of one second holds more than rate + 1
+    assert times[-1] - times[0] >= (len(times) - 1) / rate * 0.9
+    assert all(sum(1 for t in times if start <= t < start + 1) <= rate + 1 for start in times)